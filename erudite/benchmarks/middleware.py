@@ -0,0 +1,99 @@
+""" Compare BaseHTTPMiddleware `authorization` with pure ASGI AuthorizationMiddleware
+
+Run from the erudite directory:
+    python -m benchmarks.middleware
+"""
+
+import asyncio
+import time
+
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from core import middleware
+from core.middleware import AuthorizationMiddleware, authorization
+
+REQUESTS = 20000
+API_KEY = "benchmark-key"
+
+
+def create_app(wrap) -> FastAPI:
+    app = FastAPI(root_path="/api/erudite")
+    wrap(app)
+
+    @app.get("/rooms")
+    async def list_rooms():
+        return [{"ruz_auditorium_oid": 3308}]
+
+    @app.post("/rooms")
+    async def create_room():
+        return {"ruz_auditorium_oid": 3308}
+
+    return app
+
+
+async def call(app, method: str):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": "/rooms",
+        "raw_path": b"/rooms",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"key", API_KEY.encode())],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 6000),
+    }
+    status = None
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # Client stays connected until the response is sent
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    assert status == 200, status
+
+
+async def bench(name: str, app, method: str):
+    # Warm up routing and the API key cache
+    for _ in range(100):
+        await call(app, method)
+
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        await call(app, method)
+    elapsed = time.perf_counter() - start
+
+    print(f"{name:<20} {method:<5} {elapsed / REQUESTS * 1e6:8.1f} us/request")
+
+
+async def main():
+    # Valid key is served from the cache, so PostgreSQL is not needed
+    middleware.key_cache.set(API_KEY, True, ttl=3600)
+
+    apps = {
+        "none": create_app(lambda app: None),
+        "BaseHTTPMiddleware": create_app(
+            lambda app: app.add_middleware(BaseHTTPMiddleware, dispatch=authorization)
+        ),
+        "pure ASGI": create_app(lambda app: app.add_middleware(AuthorizationMiddleware)),
+    }
+
+    for method in ["GET", "POST"]:
+        for name, app in apps.items():
+            await bench(name, app, method)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+""" Compare response_model serialization with the FAST_JSON_ROUTERS path on 100k lessons
+
+Run from the erudite directory:
+    python -m benchmarks.serialization
+"""
+
+import asyncio
+import time
+from typing import List
+
+from bson.objectid import ObjectId
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from core.database.lessons import Lesson
+from core.database.utils import mongo_to_dict
+from core.responses import FastJSONResponse
+
+LESSONS = 100_000
+
+
+def make_lessons() -> List[dict]:
+    return [
+        mongo_to_dict(
+            {
+                "_id": ObjectId(),
+                "ruz_auditorium": "504",
+                "ruz_auditorium_oid": 3308 + i % 300,
+                "ruz_building": "Таллинская ул., д, 34",
+                "ruz_building_oid": 2211,
+                "ruz_discipline": "Физика",
+                "ruz_discipline_oid": 1337,
+                "ruz_kind_of_work": "Практическое занятие on-line",
+                "ruz_kind_of_work_oid": 969,
+                "ruz_lecturer_title": "Даниил Мирталибов",
+                "ruz_lecturer_email": "dimirtalibov@hse.ru",
+                "ruz_lesson_oid": 7735895 + i,
+                "ruz_url": "https://meet.miem.hse.ru/520",
+                "course_code": "Ф_Б2019_ИТСС_3",
+                "date": "2020-12-15",
+                "start_time": "9:30",
+                "end_time": "10:50",
+            }
+        )
+        for i in range(LESSONS)
+    ]
+
+
+async def response_model_path(lessons: List[dict]) -> bytes:
+    # What FastAPI does with a returned list when response_model is set
+    field = create_response_field(name="Response", type_=List[Lesson])
+    content = await serialize_response(field=field, response_content=lessons)
+    return JSONResponse(content).body
+
+
+async def fast_path(lessons: List[dict]) -> bytes:
+    return FastJSONResponse(lessons).body
+
+
+async def main():
+    lessons = make_lessons()
+
+    timings = {}
+    for name, path in [("response_model", response_model_path), ("fast json", fast_path)]:
+        start = time.perf_counter()
+        body = await path(lessons)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:<16} {timings[name] * 1000:8.1f} ms  {len(body) / 2 ** 20:6.1f} MiB")
+
+    print(f"speedup: {timings['response_model'] / timings['fast json']:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+""" In-process caches """
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after `ttl` seconds.
+
+    The cache lives in the worker process, it is not shared between workers.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.lookup(key)[0]
+
+    def lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        """ Return (found, value) pair, so that cached None values can be told from misses """
+
+        item = self._data.get(key)
+        if item is None:
+            return False, None
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return False, None
+
+        self._data.move_to_end(key)
+        return True, value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> int:
+        """ Store value, returns the number of entries evicted to stay within maxsize """
+
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+
+        evicted = 0
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            evicted += 1
+
+        return evicted
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
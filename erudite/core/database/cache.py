@@ -0,0 +1,81 @@
+""" Cache of reference documents (rooms, equipment, disciplines) """
+
+from typing import Any, Hashable, Optional, Tuple
+
+from prometheus_client import Counter
+
+from ..cache import TTLCache
+from ..settings import settings
+
+
+cache_requests = Counter(
+    "erudite_entity_cache_requests_total",
+    "Lookups in the in-process cache of reference documents",
+    ["collection", "result"],
+)
+cache_evictions = Counter(
+    "erudite_entity_cache_evictions_total",
+    "Documents evicted from the in-process cache to stay within its size",
+    ["collection"],
+)
+
+
+class EntityCache:
+    """LRU+TTL cache of documents, keyed both by db id and by a natural key.
+
+    Write functions of the collection module invalidate the document, documents
+    changed by other processes are seen after the TTL.
+    """
+
+    def __init__(self, collection: str, key_field: str, maxsize: int, ttl: float):
+        self.collection = collection
+        self.key_field = key_field
+        self._by_id = TTLCache(maxsize, ttl)
+        # Natural key -> db id, the document itself is kept only in _by_id
+        self._by_key = TTLCache(maxsize, ttl)
+
+    def _result(self, found: bool, document: Optional[dict]) -> Tuple[bool, Optional[dict]]:
+        cache_requests.labels(self.collection, "hit" if found else "miss").inc()
+        # Copy, so that callers can't change the cached document
+        return found, dict(document) if found else None
+
+    def get(self, document_id: Hashable) -> Tuple[bool, Optional[dict]]:
+        return self._result(*self._by_id.lookup(str(document_id)))
+
+    def get_by_key(self, key: Any) -> Tuple[bool, Optional[dict]]:
+        document_id = self._by_key.get(key)
+        if document_id is None:
+            return self._result(False, None)
+
+        found, document = self._by_id.lookup(document_id)
+        # Natural key could be changed by patch after it was cached
+        if not found or document.get(self.key_field) != key:
+            return self._result(False, None)
+
+        return self._result(True, document)
+
+    def set(self, document: dict):
+        document_id = document["id"]
+        evicted = self._by_id.set(document_id, dict(document))
+
+        key = document.get(self.key_field)
+        if key is not None:
+            evicted += self._by_key.set(key, document_id)
+
+        if evicted:
+            cache_evictions.labels(self.collection).inc(evicted)
+
+    def invalidate(self, document_id: Hashable):
+        document = self._by_id.pop(str(document_id))
+        if document is not None:
+            self._by_key.pop(document.get(self.key_field))
+
+    def clear(self):
+        self._by_id.clear()
+        self._by_key.clear()
+
+
+def create(collection: str, key_field: str) -> EntityCache:
+    return EntityCache(
+        collection, key_field, settings.entity_cache_size, settings.entity_cache_ttl
+    )
@@ -1,11 +1,19 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Optional, Union
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, IndexModel
 
-from ..database.models import db
+from ..database.models import Collection
+from ..database import cache, utils, versions
 from ..database.utils import mongo_to_dict
 
 
-disciplines_collection = db.get_collection("disciplines")
+disciplines_collection = Collection("disciplines")
+disciplines_cache = cache.create("disciplines", "course_code")
+
+indexes = [
+    IndexModel([("course_code", ASCENDING)], name="course_code", unique=True),
+]
 
 
 # Class of disciplines
@@ -21,60 +29,97 @@ class Discipline(BaseModel):
         extra = "allow"
 
 
-async def get_all() -> list:
-    """ Get all disciplines from db """
+async def get_all(
+    page_size: int = 0,
+    after: Optional[ObjectId] = None,
+    projection: Optional[dict] = None,
+) -> list:
+    """ Get all disciplines from db, page_size 0 means no limit """
+
+    return await utils.find_page(disciplines_collection, {}, page_size, after, projection)
+
+
+async def sort_many(
+    attributes: dict,
+    page_size: int = 0,
+    after: Optional[ObjectId] = None,
+    projection: Optional[dict] = None,
+) -> list:
+    """ Get disciplines by its db attributes """
+
+    return await utils.find_page(disciplines_collection, attributes, page_size, after, projection)
+
+
+async def count(attributes: dict) -> int:
+    """ Count disciplines with specified attributes """
 
-    return [
-        mongo_to_dict(discipline) async for discipline in disciplines_collection.find()
-    ]
+    return await utils.count(disciplines_collection, attributes)
 
 
-async def get(discipline_id: str) -> Discipline:
+async def get(discipline_id: str, projection: Optional[dict] = None) -> Discipline:
     """ Get discipline by its db id """
 
-    discipline = await disciplines_collection.find_one({"_id": discipline_id})
+    if projection is None:
+        found, discipline = disciplines_cache.get(discipline_id)
+        if found:
+            return discipline
+
+    discipline = await disciplines_collection.find_one({"_id": discipline_id}, projection)
     if discipline:
-        return mongo_to_dict(discipline)
+        discipline = mongo_to_dict(discipline)
+        if projection is None:
+            disciplines_cache.set(discipline)
+        return discipline
 
 
-async def get_by_cource_code(course_code: str) -> dict:
+async def get_by_cource_code(course_code: str, projection: Optional[dict] = None) -> dict:
     """ Get discipline by its course_code """
 
-    discipline = await disciplines_collection.find_one({"course_code": course_code})
+    if projection is None:
+        found, discipline = disciplines_cache.get_by_key(course_code)
+        if found:
+            return discipline
+
+    discipline = await disciplines_collection.find_one({"course_code": course_code}, projection)
     if discipline:
-        return mongo_to_dict(discipline)
+        discipline = mongo_to_dict(discipline)
+        if projection is None:
+            disciplines_cache.set(discipline)
+        return discipline
 
 
-async def add(discipline: dict) -> dict:
-    """ Add discipline to db """
+async def get_many(
+    field: str, values: List, projection: Optional[dict] = None
+) -> List[Optional[Dict[str, Union[str, int]]]]:
+    """ Get disciplines by db ids or course_code, in the order of values """
 
-    discipline_added = await disciplines_collection.insert_one(discipline)
-    new = await disciplines_collection.find_one({"_id": discipline_added.inserted_id})
-    return mongo_to_dict(new)
+    return await utils.find_by_values(disciplines_collection, field, values, projection)
 
 
-async def add_empty(discipline_id: str):
-    """ Add empty discipline with specified id to db """
+async def add(discipline: dict) -> dict:
+    """ Add discipline to db """
 
-    await disciplines_collection.insert_one({"_id": discipline_id})
+    # insert_one sets _id of the dict, so the document isn't read back
+    await disciplines_collection.insert_one(discipline)
+    await versions.bump("disciplines")
+    return mongo_to_dict(discipline)
 
 
-async def remove(discipline_id: str):
-    """ Delete discipline from db """
+async def remove(discipline_id: str) -> bool:
+    """ Delete discipline from db, False if it's not found """
 
-    await disciplines_collection.delete_one({"_id": discipline_id})
+    result = await disciplines_collection.delete_one({"_id": discipline_id})
+    disciplines_cache.invalidate(discipline_id)
+    if result.deleted_count:
+        await versions.bump("disciplines")
+    return result.deleted_count > 0
 
 
-async def patch_all(discipline_id: str, new_values: Discipline):
-    """ Patch discipline """
+async def put(discipline_id: str, new_values: dict) -> bool:
+    """ Replace discipline, False if it's not found """
 
-    await disciplines_collection.update_one(
-        {"_id": discipline_id},
-        {
-            "$set": {
-                "course_code": new_values.course_code,
-                "groups": new_values.groups,
-                "emails": new_values.emails,
-            }
-        },
-    )
+    result = await disciplines_collection.replace_one({"_id": discipline_id}, new_values)
+    disciplines_cache.invalidate(discipline_id)
+    if result.matched_count:
+        await versions.bump("disciplines")
+    return result.matched_count > 0
@@ -1,11 +1,51 @@
 from pydantic import BaseModel, Field
-from typing import Dict, Optional, List, Union
+from typing import AsyncIterator, Dict, Optional, List, Union
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, IndexModel
 
-from ..database.models import db
+from ..database.models import Collection
+from ..database import cache, utils, versions
 from ..database.utils import mongo_to_dict
 
 
-equipment_collection = db.get_collection("equipment")
+equipment_collection = Collection("equipment")
+equipment_cache = cache.create("equipment", "name")
+
+indexes = [
+    IndexModel([("name", ASCENDING)], name="name", unique=True),
+    IndexModel([("room_id", ASCENDING)], name="room_id"),
+    IndexModel([("type", ASCENDING)], name="type"),
+    IndexModel([("ip", ASCENDING)], name="ip"),
+    IndexModel([("room_name", ASCENDING)], name="room_name"),
+]
+
+# Stages which embed related documents for expand=
+relations = {
+    "room": [
+        {
+            "$addFields": {
+                "_room_id": {
+                    "$convert": {
+                        "input": "$room_id",
+                        "to": "objectId",
+                        "onError": None,
+                        "onNull": None,
+                    }
+                }
+            }
+        },
+        {
+            "$lookup": {
+                "from": "rooms",
+                "localField": "_room_id",
+                "foreignField": "_id",
+                "as": "room",
+            }
+        },
+        {"$unwind": {"path": "$room", "preserveNullAndEmptyArrays": True}},
+        {"$project": {"_room_id": 0}},
+    ],
+}
 
 
 class Equipment(BaseModel):
@@ -38,70 +78,131 @@ class Equipment(BaseModel):
         extra = "allow"
 
 
-async def get_all() -> List[Dict[str, Union[str, int]]]:
-    """ Get all equipment from db """
+async def get_all(
+    page_size: int = 0,
+    after: Optional[ObjectId] = None,
+    projection: Optional[dict] = None,
+    lookup: Optional[List[dict]] = None,
+) -> List[Dict[str, Union[str, int]]]:
+    """ Get all equipment from db, page_size 0 means no limit """
 
-    return [mongo_to_dict(equipment) async for equipment in equipment_collection.find()]
+    return await utils.find_page(equipment_collection, {}, page_size, after, projection, lookup)
 
 
-async def get(equipment_id: str) -> Optional[Dict[str, Union[str, int]]]:
+async def count(attributes: dict) -> int:
+    """ Count equipment with specified attributes """
+
+    return await utils.count(equipment_collection, attributes)
+
+
+async def get(
+    equipment_id: str, projection: Optional[dict] = None
+) -> Optional[Dict[str, Union[str, int]]]:
     """ Get equipment by its db id """
 
-    equipment = await equipment_collection.find_one({"_id": equipment_id})
+    if projection is None:
+        found, equipment = equipment_cache.get(equipment_id)
+        if found:
+            return equipment
+
+    equipment = await equipment_collection.find_one({"_id": equipment_id}, projection)
     if equipment:
-        return mongo_to_dict(equipment)
+        equipment = mongo_to_dict(equipment)
+        if projection is None:
+            equipment_cache.set(equipment)
+        return equipment
 
 
 async def get_by_name(name: str) -> Optional[Dict[str, Union[str, int]]]:
     """ Get equipment by its name """
 
+    found, equipment = equipment_cache.get_by_key(name)
+    if found:
+        return equipment
+
     equipment = await equipment_collection.find_one({"name": name})
     if equipment:
-        return mongo_to_dict(equipment)
+        equipment = mongo_to_dict(equipment)
+        equipment_cache.set(equipment)
+        return equipment
 
 
-async def add(equipment: dict) -> Optional[Dict[str, Union[str, int]]]:
-    """ Add equipment to db """
+async def get_many(
+    field: str, values: List, projection: Optional[dict] = None
+) -> List[Optional[Dict[str, Union[str, int]]]]:
+    """ Get equipment by db ids or names, in the order of values """
 
-    equipment_added = await equipment_collection.insert_one(equipment)
-    new = await equipment_collection.find_one({"_id": equipment_added.inserted_id})
-    return mongo_to_dict(new)
+    return await utils.find_by_values(equipment_collection, field, values, projection)
 
 
-async def add_empty(equipment_id: str):
-    """ Add empty equipment with specified id to db """
+async def add(equipment: dict) -> Optional[Dict[str, Union[str, int]]]:
+    """ Add equipment to db """
 
-    await equipment_collection.insert_one({"_id": equipment_id})
+    # insert_one sets _id of the dict, so the document isn't read back
+    await equipment_collection.insert_one(equipment)
+    await versions.bump("equipment")
+    return mongo_to_dict(equipment)
 
 
-async def remove(equipment_id: str):
-    """ Delete equipment from db """
+async def remove(equipment_id: str) -> bool:
+    """ Delete equipment from db, False if it's not found """
 
-    await equipment_collection.delete_one({"_id": equipment_id})
+    result = await equipment_collection.delete_one({"_id": equipment_id})
+    equipment_cache.invalidate(equipment_id)
+    if result.deleted_count:
+        await versions.bump("equipment")
+    return result.deleted_count > 0
 
 
-async def patch(equipment_id: str, new_values: dict):
-    """ Patch equipment """
+async def patch(equipment_id: str, new_values: dict) -> bool:
+    """ Patch equipment, False if it's not found """
 
-    await equipment_collection.update_one(
+    result = await equipment_collection.update_one(
         {"_id": equipment_id},
         {"$set": new_values},
     )
+    equipment_cache.invalidate(equipment_id)
+    if result.matched_count:
+        await versions.bump("equipment")
+    return result.matched_count > 0
+
 
+async def put(equipment_id: str, new_values: dict) -> bool:
+    """ Replace equipment, False if it's not found """
 
-async def sort(room_id: str) -> list:
+    result = await equipment_collection.replace_one({"_id": equipment_id}, new_values)
+    equipment_cache.invalidate(equipment_id)
+    if result.matched_count:
+        await versions.bump("equipment")
+    return result.matched_count > 0
+
+
+async def sort(room_id: str, projection: Optional[dict] = None) -> list:
     """ Get equipment by its db room_id """
 
     return [
         mongo_to_dict(equipment)
-        async for equipment in equipment_collection.find({"room_id": str(room_id)})
+        async for equipment in equipment_collection.find({"room_id": str(room_id)}, projection)
     ]
 
 
-async def sort_many(attributes: dict) -> list:
+def iter_many(
+    attributes: dict, projection: Optional[dict] = None, lookup: Optional[List[dict]] = None
+) -> AsyncIterator[dict]:
+    """ Iterate over equipment with specified attributes without loading all of them """
+
+    return utils.iter_documents(equipment_collection, attributes, projection, lookup)
+
+
+async def sort_many(
+    attributes: dict,
+    page_size: int = 0,
+    after: Optional[ObjectId] = None,
+    projection: Optional[dict] = None,
+    lookup: Optional[List[dict]] = None,
+) -> list:
     """ Get equipment by its db attributes """
 
-    return [
-        mongo_to_dict(equipment)
-        async for equipment in equipment_collection.find(attributes)
-    ]
+    return await utils.find_page(
+        equipment_collection, attributes, page_size, after, projection, lookup
+    )
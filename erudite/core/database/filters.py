@@ -0,0 +1,173 @@
+""" Filters of the list routes compiled from query parameters to one Mongo query
+
+`field__operator=value` is a condition on any field, also on fields which are not
+parameters of the route, with one of the operators:
+    eq      equal to the value
+    in      comma separated values, the parameter can be repeated
+    gt, gte, lt, lte
+    exists  true or false
+    prefix  beginning of a string, which is matched with the index
+
+Such filters are compiled only on fields which lead an index of the collection,
+so that a request can't make the db scan the whole collection. Parameters of the
+routes are equality as before, the ones on fields which aren't indexed are bounded
+by the query guard. Other query parameters without an operator are ignored.
+"""
+
+import re
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Set, Tuple, Type
+
+from bson.objectid import ObjectId
+from pydantic import BaseModel, ValidationError, parse_obj_as
+from pymongo import IndexModel
+
+SEPARATOR = "__"
+
+OPERATORS = {
+    "eq": "$eq",
+    "in": "$in",
+    "gt": "$gt",
+    "gte": "$gte",
+    "lt": "$lt",
+    "lte": "$lte",
+    "exists": "$exists",
+    "prefix": "$regex",
+}
+
+
+def indexed_fields(indexes: Iterable[IndexModel]) -> Set[str]:
+    """ Fields which lead an index, so a condition on them is resolved with the index """
+
+    fields = {"_id"}
+    for index in indexes:
+        fields.add(next(iter(index.document["key"])))
+    return fields
+
+
+def parse_value(model: Type[BaseModel], field: str, value: str) -> Any:
+    """ Value of the query parameter in the type of the model field """
+
+    if field == "_id":
+        try:
+            return ObjectId(value)
+        except Exception:
+            raise ValueError(f"{value} is not an ObjectId")
+
+    model_field = model.__fields__.get(field)
+    if model_field is None:
+        # Fields allowed by extra = "allow" have no type, numbers are taken as numbers
+        try:
+            return int(value)
+        except ValueError:
+            return value
+
+    try:
+        value = parse_obj_as(model_field.type_, value)
+    except ValidationError:
+        raise ValueError(f"{value} is not a valid value of {field}")
+
+    # Stored datetimes are naive, see datetime_fields
+    if isinstance(value, datetime):
+        value = value.replace(tzinfo=None)
+    return value
+
+
+def parse_condition(
+    model: Type[BaseModel], field: str, operator: str, value: str
+) -> Tuple[str, Any]:
+    if operator == "in":
+        return "$in", [parse_value(model, field, item) for item in value.split(",") if item]
+
+    if operator == "exists":
+        if value.lower() not in ("true", "false"):
+            raise ValueError(f"{field}{SEPARATOR}exists should be true or false")
+        return "$exists", value.lower() == "true"
+
+    if operator == "prefix":
+        # Anchored case sensitive regex is the only one which is bounded by the index
+        return "$regex", "^" + re.escape(value)
+
+    return OPERATORS[operator], parse_value(model, field, value)
+
+
+def merge(query: dict, conditions: dict) -> dict:
+    """ Add conditions to the query, conditions on a field of the query are applied both """
+
+    query = dict(query)
+    for field, condition in conditions.items():
+        if field not in query:
+            query[field] = condition
+            continue
+
+        current = query[field]
+        if (
+            isinstance(current, dict)
+            and isinstance(condition, dict)
+            and all(key.startswith("$") for key in [*current, *condition])
+            and not set(current) & set(condition)
+        ):
+            query[field] = {**current, **condition}
+        else:
+            query["$and"] = [*query.get("$and", []), {field: condition}]
+
+    return query
+
+
+def compile_filter(
+    query_params: Iterable[Tuple[str, str]],
+    attributes: dict,
+    params: Iterable[str],
+    model: Type[BaseModel],
+    indexes: Iterable[IndexModel],
+    unindexed: Iterable[str] = (),
+) -> dict:
+    """Add conditions of the query parameters to the attributes of the route parameters.
+
+    params are names of the route parameters, they aren't compiled. unindexed are fields
+    which are filtered without an index. Raises ValueError if a filter is written in the
+    wrong format or its field isn't indexed.
+    """
+
+    params = set(params)
+    allowed = indexed_fields(indexes) | set(unindexed)
+    conditions: Dict[str, Dict[str, Any]] = {}
+    rejected: List[str] = []
+
+    for name, value in query_params:
+        if name in params:
+            continue
+
+        # Unknown query parameters were always ignored, e.g. cache busters of clients
+        if SEPARATOR not in name:
+            continue
+
+        field, operator = name.rsplit(SEPARATOR, 1)
+        if operator not in OPERATORS:
+            raise ValueError(f"Unknown filter operator {operator}")
+
+        if not re.fullmatch(r"[A-Za-z_][\w.]*", field):
+            raise ValueError(f"Filter {name} is written in the wrong format")
+        if field == "id":
+            field = "_id"
+        if field not in allowed:
+            rejected.append(name)
+            continue
+
+        field_conditions = conditions.setdefault(field, {})
+        key, condition = parse_condition(model, field, operator, value)
+        if key == "$in" and "$in" in field_conditions:
+            condition = field_conditions["$in"] + condition
+        field_conditions[key] = condition
+
+    if rejected:
+        fields = ", ".join(sorted(allowed - {"_id"} | {"id"}))
+        raise ValueError(
+            f"Filters {', '.join(rejected)} are not on indexed fields, filter by {fields}"
+        )
+
+    compiled = {
+        field: field_conditions["$eq"] if list(field_conditions) == ["$eq"] else field_conditions
+        for field, field_conditions in conditions.items()
+    }
+    return merge(attributes, compiled)
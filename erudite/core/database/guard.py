@@ -0,0 +1,168 @@
+""" Guard of queries which the db resolves with a collection scan
+
+Every new shape of a query (its fields and operators, without values) is explained
+once and the winning plan is cached. A query is offending if its plan scans the
+whole collection and the collection has more documents than the examined budget.
+What happens to offending queries depends on QUERY_GUARD_POLICY:
+    off     queries aren't explained
+    log     shapes are logged and reported in /admin/query-guard
+    cap     as log, and queries are run with maxTimeMS
+    reject  as log, and queries are rejected, streams are capped as they have already started
+"""
+
+import json
+from datetime import datetime
+from loguru import logger
+from typing import Any, Dict, List, Optional, Set
+
+from prometheus_client import Counter
+from pydantic import BaseModel, Field
+from pymongo.errors import PyMongoError
+
+from ..cache import TTLCache
+from ..settings import settings
+
+
+guarded_queries = Counter(
+    "erudite_query_guard_total",
+    "Queries with a collection scan plan",
+    ["collection", "action"],
+)
+
+# Shape -> whether the query is offending, plans are explained again after the TTL,
+# so that new indexes are taken into account
+plans = TTLCache(settings.query_guard_cache_size, settings.query_guard_plan_ttl)
+
+offending: Dict[str, dict] = {}
+
+
+class QueryRejected(Exception):
+    pass
+
+
+class OffendingShape(BaseModel):
+    collection: str
+    shape: str = Field(..., description="Filter and sort of the query without values")
+    stage: str = Field(..., description="Stages of the winning plan")
+    queries: int = Field(..., description="Queries of this shape since the start")
+    first_seen: datetime
+    last_seen: datetime
+
+
+def shape(value: Any) -> Any:
+    """ Filter with values replaced, lists of conditions are kept """
+
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in sorted(value.items())}
+    if isinstance(value, list) and any(isinstance(item, dict) for item in value):
+        return [shape(item) for item in value]
+    return "?"
+
+
+def plan_stages(plan: Any, stages: Optional[Set[str]] = None) -> Set[str]:
+    """ Stages of every level of the plan, with both classic and SBE explain formats """
+
+    stages = set() if stages is None else stages
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.add(plan["stage"])
+        for item in plan.values():
+            plan_stages(item, stages)
+    elif isinstance(plan, list):
+        for item in plan:
+            plan_stages(item, stages)
+    return stages
+
+
+async def is_scan(collection, filter: dict, sort: Optional[list]) -> Optional[str]:
+    """ Stages of the winning plan if it's a collection scan over the budget """
+
+    cursor = collection.find(filter)
+    if sort:
+        cursor = cursor.sort(sort)
+
+    try:
+        explanation = await cursor.explain()
+        stages = plan_stages(explanation["queryPlanner"]["winningPlan"])
+        if "COLLSCAN" not in stages:
+            return None
+        size = await collection.estimated_document_count()
+    except (PyMongoError, AttributeError, KeyError) as error:
+        logger.info(f"Query on {collection.name} is not explained: {error}")
+        return None
+
+    if size <= settings.query_guard_docs_examined:
+        return None
+    return ",".join(sorted(stages))
+
+
+def report_shape(collection, key: str, query_shape: str, stage: str):
+    now = datetime.utcnow()
+    entry = offending.get(key)
+    if entry is None:
+        if len(offending) >= settings.query_guard_cache_size:
+            return
+        entry = offending[key] = {
+            "collection": collection.name,
+            "shape": query_shape,
+            "stage": stage,
+            "queries": 0,
+            "first_seen": now,
+        }
+        logger.warning(f"Query on {collection.name} scans the collection: {query_shape}")
+
+    entry["queries"] += 1
+    entry["last_seen"] = now
+
+
+async def check(
+    collection, filter: dict, sort: Optional[list] = None, stream: bool = False
+) -> Optional[int]:
+    """maxTimeMS of the query, None if it isn't limited.
+
+    Raises QueryRejected if the query is offending and the policy is reject.
+    """
+
+    policy = settings.query_guard_policy
+    if policy == "off":
+        return None
+
+    query_shape = json.dumps(shape(filter), ensure_ascii=False)
+    if sort:
+        query_shape += f" sort {list(sort)}"
+    key = f"{collection.name} {query_shape}"
+
+    found, stage = plans.lookup(key)
+    if not found:
+        stage = await is_scan(collection, filter, sort)
+        plans.set(key, stage)
+    if stage is None:
+        return None
+
+    report_shape(collection, key, query_shape, stage)
+
+    if policy == "reject" and not stream:
+        guarded_queries.labels(collection.name, "rejected").inc()
+        raise QueryRejected(
+            f"Query on {collection.name} would scan the whole collection, filter by indexed fields"
+        )
+    if policy in ("cap", "reject"):
+        guarded_queries.labels(collection.name, "capped").inc()
+        return settings.query_guard_max_time_ms
+
+    guarded_queries.labels(collection.name, "logged").inc()
+    return None
+
+
+def report() -> List[Dict]:
+    """ Offending shapes, the most frequent first """
+
+    return sorted(offending.values(), key=lambda entry: entry["queries"], reverse=True)
+
+
+async def log_report():
+    for entry in report():
+        logger.warning(
+            f"Query on {entry['collection']} scanned the collection {entry['queries']} times: "
+            f"{entry['shape']}"
+        )
@@ -0,0 +1,91 @@
+""" Indexes declared by the collection modules """
+
+from loguru import logger
+from typing import Dict, List
+from pydantic import BaseModel, Field
+
+from pymongo.errors import OperationFailure
+
+from . import disciplines, equipment, lessons, records, rooms
+
+
+# Collection with the indexes declared in its module
+declared_indexes = [
+    (rooms.rooms_collection, rooms.indexes),
+    (equipment.equipment_collection, equipment.indexes),
+    (disciplines.disciplines_collection, disciplines.indexes),
+    (lessons.lessons_collection, lessons.indexes),
+    (records.records_collection, records.indexes),
+]
+
+# Collection with the names of indexes which were declared before and are dropped
+dropped_indexes = [
+    (lessons.lessons_collection, lessons.dropped_indexes),
+]
+
+
+class IndexReport(BaseModel):
+    missing: List[str] = Field(..., description="Declared indexes which don't exist")
+    unused: List[str] = Field(
+        ..., description="Indexes without accesses since the last mongod restart"
+    )
+    undeclared: List[str] = Field(..., description="Existing indexes which are not declared")
+
+
+async def ensure_indexes():
+    """Create missing indexes, existing ones with the same spec are left as is.
+
+    Indexes which are not declared anymore are dropped.
+    """
+
+    for collection, indexes in declared_indexes:
+        # One by one, so that a failed index (e.g. duplicates in the data) doesn't block the rest
+        for index in indexes:
+            try:
+                await collection.create_indexes([index])
+            except OperationFailure as error:
+                logger.error(
+                    f"Index {index.document['name']} on {collection.name} is not created: {error}"
+                )
+
+    for collection, names in dropped_indexes:
+        existing = {index["name"] async for index in collection.list_indexes()}
+        for name in existing.intersection(names):
+            try:
+                await collection.drop_index(name)
+                logger.info(f"Index {name} on {collection.name} is dropped")
+            except OperationFailure as error:
+                logger.error(f"Index {name} on {collection.name} is not dropped: {error}")
+
+    logger.info("Indexes are ensured")
+
+
+async def report() -> Dict[str, Dict[str, List[str]]]:
+    """ Get missing, unused and undeclared indexes of every collection """
+
+    result = {}
+    for collection, indexes in declared_indexes:
+        declared = {index.document["name"] for index in indexes}
+        existing = {index["name"] async for index in collection.list_indexes()}
+        existing.discard("_id_")
+
+        # Usage counters are reset on mongod restart
+        try:
+            unused = sorted(
+                [
+                    stats["name"]
+                    async for stats in collection.aggregate([{"$indexStats": {}}])
+                    if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0
+                ]
+            )
+        except OperationFailure as error:
+            logger.info(f"Index stats of {collection.name} are not available: {error}")
+            unused = []
+
+        result[collection.name] = {
+            "missing": sorted(declared - existing),
+            "unused": unused,
+            "undeclared": sorted(existing - declared),
+        }
+
+    return result
@@ -1,12 +1,107 @@
+import hashlib
+import heapq
+import json
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 from loguru import logger
-from typing import Dict, Optional, List, Union
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Optional,
+    List,
+    Set,
+    Tuple,
+    Union,
+)
 from pydantic import BaseModel, Field
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, DeleteOne, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError
 
-from .models import db
+from .models import Collection
+from . import filters, schedule, timeouts, utils, versions
 from .utils import mongo_to_dict
+from ..settings import settings
+
+lessons_collection = Collection("lessons")
+
+# Fields of lessons in the conflicts report
+conflict_fields = [
+    "ruz_lesson_oid",
+    "ruz_auditorium_oid",
+    "ruz_discipline",
+    "ruz_lecturer_title",
+    "date",
+    "start_time",
+    "end_time",
+    "start_at",
+    "end_at",
+]
+
+indexes = [
+    IndexModel([("ruz_lesson_oid", ASCENDING)], name="ruz_lesson_oid", unique=True),
+    IndexModel(
+        [("ruz_building_oid", ASCENDING), ("date", ASCENDING)], name="ruz_building_oid_date"
+    ),
+    IndexModel(
+        [("ruz_auditorium_oid", ASCENDING), ("start_at", ASCENDING)],
+        name="ruz_auditorium_oid_start_at",
+    ),
+    IndexModel([("start_at", ASCENDING)], name="start_at"),
+    IndexModel([("ruz_lecturer_title", ASCENDING)], name="ruz_lecturer_title"),
+]
+
+# Times of lessons are queried by start_at, indexes of date and start_time strings only
+# slowed the writes down
+dropped_indexes = ["ruz_auditorium_oid_date_start_time", "date_start_time"]
+
+# date filters of clients are kept without an index, they are bounded by the query guard
+unindexed_filter_fields = ["date"]
+
+# Stages which embed related documents for expand=
+relations = {
+    "room": [
+        {
+            "$lookup": {
+                "from": "rooms",
+                "localField": "ruz_auditorium_oid",
+                "foreignField": "ruz_auditorium_oid",
+                "as": "room",
+            }
+        },
+        {"$unwind": {"path": "$room", "preserveNullAndEmptyArrays": True}},
+    ],
+    "discipline": [
+        {
+            "$lookup": {
+                "from": "disciplines",
+                "localField": "course_code",
+                "foreignField": "course_code",
+                "as": "discipline",
+            }
+        },
+        {"$unwind": {"path": "$discipline", "preserveNullAndEmptyArrays": True}},
+    ],
+}
+
+# Fields which are not a part of RUZ data, so they don't change the content hash
+unhashed_fields = frozenset(
+    [
+        "_id",
+        "id",
+        "content_hash",
+        "start_at",
+        "end_at",
+        "gcalendar_event_id",
+        "gcalendar_calendar_id",
+    ]
+)
+
 
-lessons_collection = db.get_collection("lessons")
+# Fields which are made on write, values sent by clients are dropped
+derived_fields = ("start_at", "end_at", "content_hash")
 
 
 class Lesson(BaseModel):
@@ -62,46 +157,196 @@ class Lesson(BaseModel):
     start_time: str = Field(..., description="Start time of the lesson", example="9:30")
     end_time: str = Field(..., description="End time of the lesson", example="10:50")
 
+    start_at: datetime = Field(
+        None, description="Start of the lesson, made of date and start_time on write"
+    )
+    end_at: datetime = Field(
+        None, description="End of the lesson, made of date and end_time on write"
+    )
+    content_hash: str = Field(
+        None, description="Hash of RUZ fields of the lesson, set by the db on write"
+    )
+
     class Config:
         extra = "allow"
 
 
-async def get_all() -> List[Dict[str, Union[str, int]]]:
-    """ Get all lessons from db """
+class RoomSchedule(BaseModel):
+    ruz_auditorium_oid: int = Field(..., description="Room id in RUZ", example=3308)
+    current: List[Lesson] = Field(..., description="Lessons which are going on at the moment")
+    next: Optional[Lesson] = Field(None, description="First lesson which starts after the moment")
 
-    return [mongo_to_dict(lesson) async for lesson in lessons_collection.find()]
 
+class Schedule(BaseModel):
+    fromdate: date = Field(..., description="First date of the schedule", example="2020-12-14")
+    todate: date = Field(..., description="Last date of the schedule", example="2020-12-20")
+    ruz_building_oid: int = Field(
+        ..., description="Building id in RUZ", example=2211
+    )
+    lessons: List[Lesson] = Field(
+        ..., description="All lessons of the building in the date range"
+    )
 
-async def sort_many(attributes: dict) -> Optional[List[Dict[str, Union[str, int]]]]:
-    """ Get lesson by its ruz name and datetime or any of it's attributes """
 
+class ReconcileError(BaseModel):
+    ruz_lesson_oid: int
+    message: str
+
+
+class ReconcileResult(BaseModel):
+    dry_run: bool = Field(..., description="If true, changes are only reported")
+    inserted: List[int] = Field(..., description="ruz_lesson_oid of new lessons")
+    updated: List[int] = Field(..., description="ruz_lesson_oid of changed lessons")
+    deleted: List[int] = Field(
+        ..., description="ruz_lesson_oid of lessons which are not in the schedule anymore"
+    )
+    unchanged: int = Field(..., description="Number of lessons which are left as is")
+    failed: List[ReconcileError] = Field(..., description="Lessons which are not written")
+
+
+def content_hash(lesson: dict) -> str:
+    """ Hash of lesson fields from RUZ, which doesn't depend on the order of the fields """
+
+    content = {key: value for key, value in lesson.items() if key not in unhashed_fields}
+    dump = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(dump.encode()).hexdigest()
+
+
+def written_fields(lesson: dict) -> dict:
+    """ Fields of the lesson which are written as sent, without the db id """
+
+    return {
+        key: value
+        for key, value in lesson.items()
+        if key not in ("_id", "id") and key not in derived_fields
+    }
+
+
+async def get_all(
+    page_size: int = 0,
+    after: Optional[ObjectId] = None,
+    projection: Optional[dict] = None,
+    lookup: Optional[List[dict]] = None,
+) -> List[Dict[str, Union[str, int]]]:
+    """ Get all lessons from db, page_size 0 means no limit """
+
+    return await utils.find_page(lessons_collection, {}, page_size, after, projection, lookup)
+
+
+def make_filter(attributes: dict) -> dict:
+    """ Make db filter from lesson attributes and fromdate/todate range """
+
+    attributes = dict(attributes)
     fromdate = attributes.pop("fromdate", None)
     todate = attributes.pop("todate", None)
 
-    if fromdate:
-        attributes["date"] = {
-            "$gte": str(fromdate.date()),
-        }
-        attributes["start_time"] = {"$gte": str(fromdate.time())}
+    # One range over start_at, so it's served by the (ruz_auditorium_oid, start_at) index
+    return filters.merge(attributes, utils.datetime_filter(fromdate, todate))
+
+
+async def count(attributes: dict) -> int:
+    """ Count lessons by its attributes and datetime """
+
+    return await utils.count(lessons_collection, make_filter(attributes))
 
-    if todate:
-        attributes.setdefault("date", {})
-        attributes["date"]["$lte"] = str(todate.date())
 
-        attributes.setdefault("start_time", {})
-        attributes["start_time"]["$lte"] = str(todate.time())
+def iter_many(
+    attributes: dict, projection: Optional[dict] = None, lookup: Optional[List[dict]] = None
+) -> AsyncIterator[dict]:
+    """ Iterate over lessons by its attributes and datetime without loading all of them """
+
+    return utils.iter_documents(lessons_collection, make_filter(attributes), projection, lookup)
+
+
+async def sort_many(
+    attributes: dict,
+    page_size: int = 0,
+    after: Optional[ObjectId] = None,
+    projection: Optional[dict] = None,
+    lookup: Optional[List[dict]] = None,
+) -> Optional[List[Dict[str, Union[str, int]]]]:
+    """ Get lesson by its ruz name and datetime or any of it's attributes """
 
+    attributes = make_filter(attributes)
     logger.info(f"lessons.sort_many got filter obj: {attributes}")
 
-    return [
-        mongo_to_dict(lesson) async for lesson in lessons_collection.find(attributes)
-    ]
+    return await utils.find_page(
+        lessons_collection, attributes, page_size, after, projection, lookup
+    )
+
+
+async def busy_rooms(
+    start: datetime, end: datetime, ruz_auditorium_oids: Iterable[int]
+) -> Set[int]:
+    """ Rooms which have lessons overlapping [start, end) """
+
+    if schedule.index.covers(start, end):
+        return {
+            lesson["ruz_auditorium_oid"]
+            for lesson in schedule.index.between(start, end, ruz_auditorium_oids)
+        }
+
+    # Lessons are shorter than a day, so start_at range of the index scan is bounded
+    rooms = await lessons_collection.distinct(
+        "ruz_auditorium_oid",
+        {
+            "ruz_auditorium_oid": {"$in": list(ruz_auditorium_oids)},
+            "start_at": {"$gt": start - timedelta(days=1), "$lt": end},
+            "end_at": {"$gt": start},
+        },
+        **timeouts.options(),
+    )
+    return set(rooms)
+
+
+async def overlapping_pairs(lessons: AsyncIterable[dict]) -> AsyncIterator[dict]:
+    """Pairs of lessons which overlap in the same room, lessons are sorted by start_at.
+
+    Lessons which haven't ended yet are kept in a heap by end for every room,
+    so it's O(n log n + pairs).
+    """
+
+    # Room -> (end_at, position, lesson) of lessons of the room which go on at the current start
+    going_on: Dict[int, List[Tuple[datetime, int, dict]]] = defaultdict(list)
+    position = 0
+    async for lesson in lessons:
+        lesson = mongo_to_dict(lesson)
+        room = lesson["ruz_auditorium_oid"]
+        room_going_on = going_on[room]
+
+        while room_going_on and room_going_on[0][0] <= lesson["start_at"]:
+            heapq.heappop(room_going_on)
+
+        for _, _, other in room_going_on:
+            yield {"ruz_auditorium_oid": room, "first": other, "second": lesson}
+
+        heapq.heappush(room_going_on, (lesson["end_at"], position, lesson))
+        position += 1
+
+
+def conflicts(start: datetime, end: datetime) -> AsyncIterator[dict]:
+    """Pairs of lessons which overlap in the same room, for lessons starting in [start, end).
 
+    Lessons come sorted by start from the start_at index, so only the range is read.
+    """
 
-async def get_by_id(lesson_id: ObjectId) -> Optional[Dict[str, Union[str, int]]]:
+    cursor = (
+        lessons_collection.find(
+            {"start_at": {"$gte": start, "$lt": end}},
+            {field: 1 for field in conflict_fields},
+        )
+        .sort("start_at", ASCENDING)
+        .batch_size(settings.stream_batch_size)
+    )
+    return overlapping_pairs(timeouts.apply(cursor))
+
+
+async def get_by_id(
+    lesson_id: ObjectId, projection: Optional[dict] = None
+) -> Optional[Dict[str, Union[str, int]]]:
     """ Get lesson by its db id """
 
-    lesson = await lessons_collection.find_one({"_id": lesson_id})
+    lesson = await lessons_collection.find_one({"_id": lesson_id}, projection)
     if lesson:
         return mongo_to_dict(lesson)
 
@@ -114,32 +359,222 @@ async def get_by_ruz_id(ruz_lesson_oid: int) -> Optional[Dict[str, Union[str, in
         return mongo_to_dict(lesson)
 
 
+async def get_many(
+    field: str, values: List, projection: Optional[dict] = None
+) -> List[Optional[Dict[str, Union[str, int]]]]:
+    """ Get lessons by db ids or ruz_lesson_oid, in the order of values """
+
+    return await utils.find_by_values(lessons_collection, field, values, projection)
+
+
 async def add(lesson: dict) -> Dict[str, Union[str, int]]:
     """ Add lesson to db """
 
-    lesson_added = await lessons_collection.insert_one(lesson)
-    new = await lessons_collection.find_one({"_id": lesson_added.inserted_id})
+    lesson = dict(
+        written_fields(lesson),
+        content_hash=content_hash(lesson),
+        **utils.datetime_fields(lesson),
+    )
+    # insert_one sets _id of the dict, so the document isn't read back
+    await lessons_collection.insert_one(lesson)
+
+    await versions.bump("lessons")
+    lesson = mongo_to_dict(lesson)
+    schedule.index.set(lesson)
+    return lesson
 
-    return mongo_to_dict(new)
 
+async def sync_schedule(ruz_lesson_oids: List[int]):
+    """ Update the schedule index with upserted lessons, their db ids are not known """
 
-async def add_empty(lesson_id: ObjectId):
-    """ Add empty lesson with specified id to db """
+    if not schedule.index.enabled or not ruz_lesson_oids:
+        return
 
-    await lessons_collection.insert_one({"_id": lesson_id})
+    async for lesson in lessons_collection.find({"ruz_lesson_oid": {"$in": ruz_lesson_oids}}):
+        schedule.index.set(mongo_to_dict(lesson))
 
 
-async def remove(lesson_id: ObjectId):
-    """ Delete lesson from db """
+def upsert_update(lesson: dict, lesson_hash: str) -> dict:
+    """ Update which sets fields of the lesson with its content hash and datetimes """
 
-    res = await lessons_collection.delete_one({"_id": lesson_id})
-    return res
+    # start_at and end_at of the client would conflict with $unset of wrong times
+    fields = written_fields(lesson)
+    fields["content_hash"] = lesson_hash
 
+    datetimes = utils.datetime_fields(lesson)
+    update = {"$set": {**fields, **datetimes}}
+    if not datetimes:
+        update["$unset"] = {"start_at": "", "end_at": ""}
 
-async def put(lesson_id: ObjectId, new_values: dict):
-    """ Update lesson """
+    return update
+
+
+async def upsert_many(batch: List[Tuple[int, dict]]) -> List[Dict[str, Union[str, int]]]:
+    """ Upsert (index, lesson) pairs by ruz_lesson_oid in one unordered bulk write """
+
+    operations = [
+        UpdateOne(
+            {"ruz_lesson_oid": lesson["ruz_lesson_oid"]},
+            upsert_update(lesson, content_hash(lesson)),
+            upsert=True,
+        )
+        for _, lesson in batch
+    ]
+
+    try:
+        result = (await lessons_collection.bulk_write(operations, ordered=False)).bulk_api_result
+    except BulkWriteError as error:
+        result = error.details
+    await versions.bump("lessons")
+    await sync_schedule([lesson["ruz_lesson_oid"] for _, lesson in batch])
+
+    # Positions in the batch of created and failed lessons, others are updated
+    upserted = {item["index"]: item["_id"] for item in result.get("upserted", [])}
+    errors = {item["index"]: item["errmsg"] for item in result.get("writeErrors", [])}
+
+    items = []
+    for position, (index, lesson) in enumerate(batch):
+        item = {"index": index, "ruz_lesson_oid": lesson["ruz_lesson_oid"]}
+        if position in errors:
+            item.update(status="failed", message=errors[position])
+        elif position in upserted:
+            item.update(status="created", id=str(upserted[position]))
+        else:
+            item["status"] = "updated"
+        items.append(item)
+
+    logger.info(f"lessons.upsert_many: {len(upserted)} created, {len(errors)} failed")
+    return items
+
+
+async def remove(lesson_id: ObjectId) -> bool:
+    """ Delete lesson from db, False if it's not found """
+
+    result = await lessons_collection.delete_one({"_id": lesson_id})
+    schedule.index.remove(str(lesson_id))
+    if result.deleted_count:
+        await versions.bump("lessons")
+    return result.deleted_count > 0
+
+
+async def put(lesson_id: ObjectId, new_values: dict) -> bool:
+    """ Replace lesson, False if it's not found """
+
+    lesson = dict(
+        written_fields(new_values),
+        content_hash=content_hash(new_values),
+        **utils.datetime_fields(new_values),
+    )
+    result = await lessons_collection.replace_one({"_id": lesson_id}, lesson)
+    if result.matched_count:
+        await versions.bump("lessons")
+        schedule.index.set(dict(lesson, id=str(lesson_id)))
+    return result.matched_count > 0
+
+
+def reconcile_plan(
+    incoming: Dict[int, dict], stored: Dict[int, Tuple[ObjectId, Optional[str]]], dry_run: bool
+) -> Tuple[dict, List[Tuple[int, Union[UpdateOne, DeleteOne]]]]:
+    """Result of the reconcile and its (ruz_lesson_oid, write) operations.
+
+    incoming are lessons of the schedule, stored are (db id, content hash) of the lessons
+    in the db, both by ruz_lesson_oid.
+    """
+
+    result = {"dry_run": dry_run, "inserted": [], "updated": [], "deleted": [], "failed": []}
+    operations = []
+    for oid, lesson in incoming.items():
+        new_hash = content_hash(lesson)
+        if oid not in stored:
+            result["inserted"].append(oid)
+        elif stored[oid][1] != new_hash:
+            result["updated"].append(oid)
+        else:
+            continue
+        operations.append(
+            (
+                oid,
+                UpdateOne(
+                    {"ruz_lesson_oid": oid},
+                    upsert_update(lesson, new_hash),
+                    upsert=True,
+                ),
+            )
+        )
+
+    for oid, (lesson_id, _) in stored.items():
+        if oid not in incoming:
+            result["deleted"].append(oid)
+            operations.append((oid, DeleteOne({"_id": lesson_id})))
+
+    result["unchanged"] = len(incoming) - len(result["inserted"]) - len(result["updated"])
+    return result, operations
+
+
+async def reconcile(
+    fromdate: date,
+    todate: date,
+    ruz_building_oid: int,
+    lessons_in_schedule: List[dict],
+    dry_run: bool,
+) -> dict:
+    """Make lessons of the building in the date range equal to the schedule.
+
+    Only lessons with a changed content hash are written, lessons which are not
+    in the schedule are deleted. Fields missing in the schedule (e.g. gcalendar_event_id)
+    are left as is.
+    """
+
+    incoming = {lesson["ruz_lesson_oid"]: lesson for lesson in lessons_in_schedule}
+
+    # ruz_lesson_oid -> (db id, content hash) of stored lessons
+    stored = {}
+    cursor = lessons_collection.find(
+        {
+            "ruz_building_oid": ruz_building_oid,
+            "date": {"$gte": str(fromdate), "$lte": str(todate)},
+        },
+        {"ruz_lesson_oid": 1, "content_hash": 1},
+    )
+    async for lesson in cursor:
+        if lesson.get("ruz_lesson_oid") is not None:
+            stored[lesson["ruz_lesson_oid"]] = (lesson["_id"], lesson.get("content_hash"))
+
+    # Lessons moved into the range from another date or building already exist
+    moved = [oid for oid in incoming if oid not in stored]
+    if moved:
+        cursor = lessons_collection.find(
+            {"ruz_lesson_oid": {"$in": moved}}, {"ruz_lesson_oid": 1, "content_hash": 1}
+        )
+        async for lesson in cursor:
+            stored[lesson["ruz_lesson_oid"]] = (lesson["_id"], lesson.get("content_hash"))
+
+    result, operations = reconcile_plan(incoming, stored, dry_run)
+    if dry_run or not operations:
+        return result
+
+    failed = {}
+    for start in range(0, len(operations), settings.bulk_batch_size):
+        batch = operations[start:start + settings.bulk_batch_size]
+        try:
+            await lessons_collection.bulk_write([op for _, op in batch], ordered=False)
+        except BulkWriteError as error:
+            for item in error.details.get("writeErrors", []):
+                failed[batch[item["index"]][0]] = item["errmsg"]
+    await versions.bump("lessons")
+
+    for status in ("inserted", "updated", "deleted"):
+        result[status] = [oid for oid in result[status] if oid not in failed]
+
+    await sync_schedule(result["inserted"] + result["updated"])
+    for oid in result["deleted"]:
+        schedule.index.remove(str(stored[oid][0]))
+    result["failed"] = [
+        {"ruz_lesson_oid": oid, "message": message} for oid, message in failed.items()
+    ]
 
-    await lessons_collection.update_one(
-        {"_id": lesson_id},
-        {"$set": new_values},
+    logger.info(
+        f"lessons.reconcile: {len(result['inserted'])} inserted, {len(result['updated'])} updated, "
+        f"{len(result['deleted'])} deleted, {len(failed)} failed"
     )
+    return result
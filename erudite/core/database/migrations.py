@@ -0,0 +1,239 @@
+""" Versioned migrations of existing documents, applied in batches alongside live traffic
+
+Run from the erudite directory:
+    python -m core.database.migrations status
+    python -m core.database.migrations run [--version 2]
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime
+from loguru import logger
+from typing import Callable, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+from pymongo import ASCENDING, UpdateOne
+
+from .models import db
+from . import lessons, records, versions
+from .utils import datetime_fields
+from ..settings import settings
+
+migrations_collection = db.get_collection("migrations")
+
+
+class Migration:
+    """Update of every document which matches the filter.
+
+    update gets a document with the projected fields and returns an update for it,
+    or None if the document is left as is.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        name: str,
+        collection,
+        filter: dict,
+        update: Callable[[dict], Optional[dict]],
+        projection: Optional[dict] = None,
+    ):
+        self.version = version
+        self.name = name
+        self.collection = collection
+        self.filter = filter
+        self.update = update
+        self.projection = projection
+
+
+class MigrationStatus(BaseModel):
+    version: int
+    name: str
+    collection: str
+    status: str = Field(..., description="pending, running or done")
+    processed: int = Field(..., description="Documents which were checked")
+    modified: int = Field(..., description="Documents which were updated")
+    last_id: str = Field(None, description="Migration is continued after this ObjectId")
+    started_at: datetime = Field(None)
+    finished_at: datetime = Field(None)
+
+
+def set_datetimes(document: dict) -> Optional[dict]:
+    datetimes = datetime_fields(document)
+    if datetimes:
+        return {"$set": datetimes}
+
+
+def set_content_hash(lesson: dict) -> Optional[dict]:
+    return {"$set": {"content_hash": lessons.content_hash(lesson)}}
+
+
+# Applied in the order of versions, versions are never reused
+migrations: List[Migration] = [
+    Migration(
+        1,
+        "lessons start_at and end_at",
+        lessons.lessons_collection,
+        {"start_at": {"$exists": False}},
+        set_datetimes,
+        {"date": 1, "start_time": 1, "end_time": 1},
+    ),
+    Migration(
+        2,
+        "records start_at and end_at",
+        records.records_collection,
+        {"start_at": {"$exists": False}},
+        set_datetimes,
+        {"date": 1, "start_time": 1, "end_time": 1},
+    ),
+    Migration(
+        3,
+        "lessons content_hash",
+        lessons.lessons_collection,
+        {"content_hash": {"$exists": False}},
+        set_content_hash,
+    ),
+]
+
+
+async def status() -> List[Dict]:
+    """ Progress of every migration """
+
+    states = {state["_id"]: state async for state in migrations_collection.find()}
+
+    result = []
+    for migration in migrations:
+        state = states.get(migration.version, {})
+        result.append(
+            {
+                "version": migration.version,
+                "name": migration.name,
+                "collection": migration.collection.name,
+                "status": state.get("status", "pending"),
+                "processed": state.get("processed", 0),
+                "modified": state.get("modified", 0),
+                "last_id": str(state["last_id"]) if state.get("last_id") else None,
+                "started_at": state.get("started_at"),
+                "finished_at": state.get("finished_at"),
+            }
+        )
+
+    return result
+
+
+async def apply(migration: Migration, batch_size: int, rate_limit: float):
+    """Apply the migration in batches ordered by _id, continuing after the last saved batch.
+
+    rate_limit is the number of documents per second, 0 means no limit.
+    """
+
+    state = await migrations_collection.find_one({"_id": migration.version}) or {}
+    if state.get("status") == "done":
+        return
+
+    last_id = state.get("last_id")
+    if not state:
+        await migrations_collection.insert_one(
+            {
+                "_id": migration.version,
+                "name": migration.name,
+                "status": "running",
+                "processed": 0,
+                "modified": 0,
+                "started_at": datetime.utcnow(),
+            }
+        )
+    logger.info(f"Migration {migration.version} ({migration.name}) is started after {last_id}")
+
+    while True:
+        started = time.monotonic()
+
+        query = migration.filter
+        if last_id is not None:
+            query = {"$and": [migration.filter, {"_id": {"$gt": last_id}}]}
+        cursor = (
+            migration.collection.find(query, migration.projection)
+            .sort("_id", ASCENDING)
+            .limit(batch_size)
+        )
+        batch = await cursor.to_list(length=batch_size)
+        if not batch:
+            break
+
+        operations = []
+        for document in batch:
+            update = migration.update(document)
+            if update is not None:
+                operations.append(UpdateOne({"_id": document["_id"]}, update))
+
+        modified = 0
+        if operations:
+            result = await migration.collection.bulk_write(operations, ordered=False)
+            modified = result.modified_count
+            await versions.bump(migration.collection.name)
+
+        # Progress is saved after every batch, so the migration can be stopped at any time
+        last_id = batch[-1]["_id"]
+        await migrations_collection.update_one(
+            {"_id": migration.version},
+            {
+                "$set": {"last_id": last_id, "status": "running"},
+                "$inc": {"processed": len(batch), "modified": modified},
+            },
+        )
+
+        if rate_limit > 0:
+            await asyncio.sleep(max(0, len(batch) / rate_limit - (time.monotonic() - started)))
+
+    await migrations_collection.update_one(
+        {"_id": migration.version},
+        {"$set": {"status": "done", "finished_at": datetime.utcnow()}},
+    )
+    logger.info(f"Migration {migration.version} ({migration.name}) is done")
+
+
+async def run(
+    version: Optional[int] = None,
+    batch_size: int = settings.migration_batch_size,
+    rate_limit: float = settings.migration_rate_limit,
+):
+    """ Apply pending migrations up to the version, all of them if it's None """
+
+    for migration in migrations:
+        if version is not None and migration.version > version:
+            break
+        await apply(migration, batch_size, rate_limit)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Erudite migrations")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("status", help="Show progress of every migration")
+
+    run_parser = commands.add_parser("run", help="Apply pending migrations")
+    run_parser.add_argument("--version", type=int, help="Last migration to apply")
+    run_parser.add_argument("--batch-size", type=int, default=settings.migration_batch_size)
+    run_parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=settings.migration_rate_limit,
+        help="Documents per second, 0 means no limit",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        await run(args.version, args.batch_size, args.rate_limit)
+
+    for migration in await status():
+        print(
+            f"{migration['version']:>3}  {migration['status']:<8} {migration['collection']:<12} "
+            f"{migration['processed']:>9} checked {migration['modified']:>9} updated  "
+            f"{migration['name']}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,11 +1,32 @@
-from pydantic import BaseModel
+from contextvars import ContextVar
+from pydantic import BaseModel, Field, StrictInt, StrictStr
+from typing import Any, List, Union
 import motor.motor_asyncio
+from pymongo import ReadPreference
 
 from ..settings import settings
 
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+client_options = {
+    "maxPoolSize": settings.mongo_max_pool_size,
+    "minPoolSize": settings.mongo_min_pool_size,
+}
+if settings.mongo_wait_queue_timeout_ms:
+    client_options["waitQueueTimeoutMS"] = settings.mongo_wait_queue_timeout_ms
+if settings.mongo_compressors:
+    client_options["compressors"] = settings.mongo_compressors
+if settings.mongo_read_concern:
+    client_options["readConcernLevel"] = settings.mongo_read_concern
 
 # Connection to a remote db:
-client = motor.motor_asyncio.AsyncIOMotorClient(settings.mongo_url)
+client = motor.motor_asyncio.AsyncIOMotorClient(settings.mongo_url, **client_options)
 
 # Check if it's a test run
 TESTING = settings.testing
@@ -16,6 +37,55 @@ if TESTING:
 else:
     db = client[settings.mongo_db_name]
 
+# The same db with the read preference of GET requests, writes always go to the primary
+read_db = client.get_database(
+    db.name, read_preference=READ_PREFERENCES[settings.mongo_read_preference]
+)
+
+# Set by ReadPreferenceMiddleware for requests which can read from secondaries
+secondary_reads: ContextVar[bool] = ContextVar("secondary_reads", default=False)
+
+
+class Collection:
+    """Collection which reads with the read preference of read_db in requests with
+    secondary_reads, and from the primary otherwise.
+    """
+
+    def __init__(self, name: str):
+        self.primary = db.get_collection(name)
+        self.secondary = read_db.get_collection(name)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.secondary if secondary_reads.get() else self.primary, name)
+
 
 class Message(BaseModel):
     message: str
+
+
+class BulkItem(BaseModel):
+    index: int = Field(..., description="Position of the item in the request")
+    status: str = Field(..., description="created, updated or failed")
+    id: str = Field(None, description="ObjectId of the created document")
+    message: str = Field(None, description="Why the item is failed")
+
+    class Config:
+        extra = "allow"
+
+
+class BulkResult(BaseModel):
+    created: int = Field(..., description="Number of created documents")
+    updated: int = Field(..., description="Number of updated documents")
+    failed: int = Field(..., description="Number of failed items")
+    items: List[BulkItem] = Field(..., description="Result of every item in request order")
+
+
+class BatchGet(BaseModel):
+    ids: List[str] = Field(
+        None, max_items=settings.page_size_max, description="ObjectIds of the documents"
+    )
+    keys: List[Union[StrictInt, StrictStr]] = Field(
+        None,
+        max_items=settings.page_size_max,
+        description="Natural keys of the documents, e.g. ruz_lesson_oid of lessons",
+    )
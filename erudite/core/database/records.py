@@ -1,13 +1,48 @@
 from loguru import logger
-from typing import Dict, Optional, List, Union
+from typing import Dict, Iterable, Optional, List, Tuple, Union
 from pydantic import BaseModel, Field
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import BulkWriteError
 from datetime import timedelta, datetime
 
-from .models import db
-from .utils import mongo_to_dict
-
-records_collection = db.get_collection("records")
+from .models import Collection
+from . import guard, timeouts, versions
+from .filters import merge
+from .utils import (
+    check_ObjectId,
+    datetime_fields,
+    datetime_filter,
+    encode_cursor,
+    find_by_values,
+    mongo_to_dict,
+)
+
+records_collection = Collection("records")
+
+# Newest records first, _id makes the order unique, so pages can be continued by a cursor.
+# start_at is compared as a datetime, date and start_time strings are not ordered as times
+records_order = [("start_at", DESCENDING), ("_id", DESCENDING)]
+
+# Attempts of a patch which changes start_at and end_at, when the record is changed concurrently
+PATCH_ATTEMPTS = 3
+
+indexes = [
+    # Records without url are allowed, so only non-empty urls have to be unique
+    IndexModel(
+        [("url", ASCENDING)],
+        name="url",
+        unique=True,
+        partialFilterExpression={"url": {"$type": "string", "$gt": ""}},
+    ),
+    # Also serves start_at ranges of a room, e.g. the search of the same capture
+    IndexModel([("room_name", ASCENDING), *records_order], name="room_name_start_at_id"),
+    IndexModel(records_order, name="start_at_id"),
+    IndexModel([("camera_ip", ASCENDING), *records_order], name="camera_ip_start_at_id"),
+]
+
+# Fields which start_at and end_at are made of
+datetime_source_fields = ("date", "start_time", "end_time")
 
 
 class Record(BaseModel):
@@ -26,6 +61,11 @@ class Record(BaseModel):
 
     keywords: List[str] = Field(None, description="Keywords from record audio")
 
+    start_at: datetime = Field(
+        None, description="Start of record, made of date and start_time on write"
+    )
+    end_at: datetime = Field(None, description="End of record, made of date and end_time on write")
+
     class Config:
         extra = "allow"
 
@@ -33,11 +73,75 @@ class Record(BaseModel):
 rec_types = ["Jitsi", "MS Teams", "Offline", "Autorecord"]
 
 
+def after_cursor(after: list) -> Optional[dict]:
+    """ Filter for records which go after the (start_at, id) decoded from a cursor """
+
+    start_at, record_id = after
+    record_id = check_ObjectId(record_id)
+    if not record_id:
+        return None
+
+    # Records without start_at (wrong date or time) go after all others
+    if start_at is None:
+        return {"start_at": None, "_id": {"$lt": record_id}}
+
+    try:
+        start_at = datetime.fromisoformat(start_at)
+    except (TypeError, ValueError):
+        logger.info("Cursor is written in the wrong format")
+        return None
+
+    return {
+        "$or": [
+            {"start_at": {"$lt": start_at}},
+            {"start_at": start_at, "_id": {"$lt": record_id}},
+            {"start_at": None},
+        ]
+    }
+
+
+def next_cursor(page: List[Dict[str, str]], page_size: int) -> Optional[str]:
+    """ Cursor for the page after the given one, None if it was the last page """
+
+    if len(page) < page_size:
+        return None
+
+    start_at = page[-1].get("start_at")
+    return encode_cursor([start_at.isoformat() if start_at else None, page[-1]["id"]])
+
+
+async def find_page(
+    attributes: dict,
+    page_number: int,
+    page_size: int,
+    after: Optional[dict],
+    projection: Optional[dict] = None,
+) -> List[Dict[str, str]]:
+    # Sort keys are always returned, next_cursor is made of them
+    if projection is not None:
+        projection = {**projection, "start_at": 1}
+
+    # Index range seek after the cursor, skip is left for clients which use page_number
+    if after is not None:
+        attributes = {"$and": [attributes, after]}
+        cursor = records_collection.find(attributes, projection)
+    else:
+        cursor = records_collection.find(attributes, projection).skip(
+            page_number * page_size if page_number > 0 else 0
+        )
+
+    max_time_ms = await guard.check(records_collection, attributes, records_order)
+    cursor = timeouts.apply(cursor.sort(records_order).limit(page_size), max_time_ms)
+    return [mongo_to_dict(record) async for record in cursor]
+
+
 async def get_all(
     page_number: int,
     page_size: int = 50,
     with_keywords_only: bool = False,
     ignore_autorec: bool = False,
+    after: Optional[dict] = None,
+    projection: Optional[dict] = None,
 ) -> List[Dict[str, str]]:
     attributes = {}
     if ignore_autorec:
@@ -45,14 +149,7 @@ async def get_all(
     if with_keywords_only:
         attributes["keywords"] = {"$type": "array", "$not": {"$size": 0}}
 
-    return [
-        mongo_to_dict(record)
-        async for record in records_collection.find(attributes)
-        .sort("_id", 1)
-        .sort("date", -1)
-        .skip(page_number * page_size if page_number > 0 else 0)
-        .limit(page_size)
-    ]
+    return await find_page(attributes, page_number, page_size, after, projection)
 
 
 async def get_by_url(url: str) -> Optional[Dict[str, Union[str, int]]]:
@@ -67,27 +164,16 @@ async def sort_many(
     page_size: int = 50,
     with_keywords_only: bool = False,
     ignore_autorec: bool = False,
+    after: Optional[dict] = None,
+    projection: Optional[dict] = None,
 ) -> Optional[List[Dict[str, str]]]:
     fromdate = attributes.pop("fromdate", None)
     todate = attributes.pop("todate", None)
 
+    # Records which started a minute before fromdate are found too
     if fromdate is not None:
-        attributes["date"] = {
-            "$gte": str(fromdate.date()),
-        }
-        time = fromdate.time()
-        attributes["start_time"] = {
-            "$gte": str(
-                timedelta(hours=time.hour, minutes=time.minute) - timedelta(minutes=1)
-            )
-        }
-
-    if todate is not None:
-        attributes.setdefault("date", {})
-        attributes["date"]["$lte"] = str(todate.date())
-
-        attributes.setdefault("start_time", {})
-        attributes["start_time"]["$lte"] = str(todate.time())
+        fromdate -= timedelta(minutes=1)
+    attributes = merge(attributes, datetime_filter(fromdate, todate))
 
     logger.info(
         f"records.sort_many got filter obj: {attributes}, page_number: {page_number}, page_size: {page_size}, "
@@ -95,40 +181,181 @@ async def sort_many(
     )
 
     if ignore_autorec:
-        attributes["type"] = {"$in": rec_types[:-1]}
+        attributes = merge(attributes, {"type": {"$in": rec_types[:-1]}})
     if with_keywords_only:
-        attributes["keywords"] = {"$type": "array", "$not": {"$size": 0}}
+        attributes = merge(attributes, {"keywords": {"$type": "array", "$not": {"$size": 0}}})
 
-    return [
-        mongo_to_dict(record)
-        async for record in records_collection.find(attributes)
-        .sort("_id", 1)
-        .sort("date", -1)
-        .skip(page_number * page_size if page_number > 0 else 0)
-        .limit(page_size)
-    ]
+    return await find_page(attributes, page_number, page_size, after, projection)
 
 
-async def get_by_id(record_id: ObjectId) -> Optional[Dict[str, str]]:
-    record = await records_collection.find_one({"_id": record_id})
+async def get_by_id(
+    record_id: ObjectId, projection: Optional[dict] = None
+) -> Optional[Dict[str, str]]:
+    record = await records_collection.find_one({"_id": record_id}, projection)
     if record:
         return mongo_to_dict(record)
 
 
+async def get_many(
+    field: str, values: List, projection: Optional[dict] = None
+) -> List[Optional[Dict[str, Union[str, int]]]]:
+    """ Get records by db ids or urls, in the order of values """
+
+    return await find_by_values(records_collection, field, values, projection)
+
+
 async def add(record: Dict[str, str]) -> Dict[str, str]:
-    record_added = await records_collection.insert_one(record)
-    new_record = await records_collection.find_one({"_id": record_added.inserted_id})
+    record.update(datetime_fields(record))
+    # insert_one sets _id of the dict, so the document isn't read back
+    await records_collection.insert_one(record)
+
+    await versions.bump("records")
+    return mongo_to_dict(record)
+
+
+async def remove(record_id: ObjectId) -> bool:
+    result = await records_collection.delete_one({"_id": record_id})
+    if result.deleted_count:
+        await versions.bump("records")
+    return result.deleted_count > 0
 
-    return mongo_to_dict(new_record)
 
+class PatchConflict(Exception):
+    pass
 
-async def add_empty(record_id: ObjectId):
-    await records_collection.insert_one({"_id": record_id})
 
+async def patch(record_id: ObjectId, new_values: Dict[str, str]) -> bool:
+    if not any(field in new_values for field in datetime_source_fields):
+        result = await records_collection.update_one({"_id": record_id}, {"$set": new_values})
+        if result.matched_count:
+            await versions.bump("records")
+        return result.matched_count > 0
 
-async def remove(record_id: ObjectId):
-    await records_collection.delete_one({"_id": record_id})
+    # start_at and end_at depend on the fields which are not patched too, so they are
+    # read first, and the update is applied only if they haven't changed since then
+    for _ in range(PATCH_ATTEMPTS):
+        record = await records_collection.find_one(
+            {"_id": record_id}, {field: 1 for field in datetime_source_fields}
+        )
+        if record is None:
+            return False
 
+        source = {field: record.get(field) for field in datetime_source_fields}
+        datetimes = datetime_fields({**source, **new_values})
+        update = {"$set": {**new_values, **datetimes}}
+        if not datetimes:
+            update["$set"] = {
+                field: value
+                for field, value in new_values.items()
+                if field not in ("start_at", "end_at")
+            }
+            update["$unset"] = {"start_at": "", "end_at": ""}
 
-async def patch(record_id: ObjectId, new_values: Dict[str, str]):
-    await records_collection.update_one({"_id": record_id}, {"$set": new_values})
+        result = await records_collection.update_one({"_id": record_id, **source}, update)
+        if result.matched_count:
+            await versions.bump("records")
+            return True
+
+    raise PatchConflict(f"Record {record_id} is changed concurrently")
+
+
+def is_same_capture(record: dict, other: dict) -> bool:
+    """ Records by the same camera overlap in time, records which only touch don't """
+
+    if record.get("camera_ip") != other.get("camera_ip"):
+        return False
+
+    return other["start_at"] < record["end_at"] and record["start_at"] < other["end_at"]
+
+
+async def find_captures(room_name: str, dates: Iterable[str]) -> List[dict]:
+    """ Records of the room on the dates, which Autorecords are compared with """
+
+    cursor = records_collection.find(
+        {"room_name": room_name, "date": {"$in": list(dates)}},
+        {"camera_ip": 1, "date": 1, "start_time": 1, "end_time": 1},
+    )
+    captures = []
+    async for record in cursor:
+        # Datetimes are made of strings, so records without start_at are compared too
+        record.update(datetime_fields(record))
+        if "start_at" in record:
+            captures.append(record)
+    return captures
+
+
+async def is_captured(record: dict) -> bool:
+    """ Record with start_at and end_at overlaps a record of the same room and camera """
+
+    captures = await find_captures(record["room_name"], [record["date"]])
+    return any(is_same_capture(record, other) for other in captures)
+
+
+async def add_many(batch: List[Tuple[int, dict]]) -> List[Dict[str, str]]:
+    """Insert (index, record) pairs which are not duplicates in one unordered insert_many.
+
+    Duplicates are records with an existing url and Autorecords which were captured
+    in the same room by the same camera at the same time, both in the db and in the batch.
+    """
+
+    items = {}
+
+    urls = {record["url"] for _, record in batch if record.get("url")}
+    existing_urls = set()
+    if urls:
+        cursor = records_collection.find({"url": {"$in": list(urls)}}, {"url": 1})
+        existing_urls = {record["url"] async for record in cursor}
+
+    # room_name -> records which Autorecords of the batch are compared with
+    captures = {}
+    autorecords = {}
+    for index, record in batch:
+        if record.get("type") == "Autorecord":
+            autorecords.setdefault(record["room_name"], set()).add(record["date"])
+    for room_name, dates in autorecords.items():
+        captures[room_name] = await find_captures(room_name, dates)
+
+    to_insert = []
+    for index, record in batch:
+        record.update(datetime_fields(record))
+        url = record.get("url")
+        if url and url in existing_urls:
+            items[index] = f"Record with url: {url}  -  already exists"
+            continue
+
+        if record.get("type") == "Autorecord":
+            if "start_at" not in record:
+                items[index] = "Date or time is written in the wrong format"
+                continue
+
+            room_captures = captures[record["room_name"]]
+            if any(is_same_capture(record, other) for other in room_captures):
+                items[index] = (
+                    "Record that was done in the same room, by the same camera, "
+                    "at the same time already exists"
+                )
+                continue
+            room_captures.append(record)
+
+        if url:
+            existing_urls.add(url)
+        to_insert.append((index, record))
+
+    if to_insert:
+        documents = [record for _, record in to_insert]
+        try:
+            await records_collection.insert_many(documents, ordered=False)
+        except BulkWriteError as error:
+            for item in error.details.get("writeErrors", []):
+                items[to_insert[item["index"]][0]] = item["errmsg"]
+        await versions.bump("records")
+
+    result = []
+    for index, record in batch:
+        if index in items:
+            result.append({"index": index, "status": "failed", "message": items[index]})
+        else:
+            result.append({"index": index, "status": "created", "id": str(record["_id"])})
+
+    logger.info(f"records.add_many: {len(to_insert)} inserted, {len(items)} failed")
+    return result
@@ -1,12 +1,38 @@
 from pydantic import BaseModel, Field
-from typing import Dict, List, Union
+from typing import AsyncIterator, Dict, List, Optional, Union
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, IndexModel
 
-from ..database.models import db
+from ..database.models import Collection
+from ..database import cache, utils, versions
 from ..database.utils import mongo_to_dict
 
 
-rooms_collection = db.get_collection("rooms")
+rooms_collection = Collection("rooms")
+rooms_cache = cache.create("rooms", "ruz_auditorium_oid")
+
+indexes = [
+    IndexModel([("ruz_auditorium_oid", ASCENDING)], name="ruz_auditorium_oid", unique=True),
+    # Filter parameters of GET /rooms, e.g. rooms of a building for the free rooms search
+    IndexModel([("ruz_building_gid", ASCENDING)], name="ruz_building_gid"),
+]
+
+# Stages which embed related documents for expand=
+relations = {
+    "equipment": [
+        # room_id of equipment is a string, so it's matched with the string of the room id
+        {"$addFields": {"_room_id": {"$toString": "$_id"}}},
+        {
+            "$lookup": {
+                "from": "equipment",
+                "localField": "_room_id",
+                "foreignField": "room_id",
+                "as": "equipment",
+            }
+        },
+        {"$project": {"_room_id": 0}},
+    ],
+}
 
 
 class Room(BaseModel):
@@ -32,67 +58,117 @@ class Room(BaseModel):
         extra = "allow"
 
 
-async def get_all() -> List[Dict[str, Union[str, int]]]:
-    """ Get all rooms from db """
+async def get_all(
+    page_size: int = 0,
+    after: Optional[ObjectId] = None,
+    projection: Optional[dict] = None,
+    lookup: Optional[List[dict]] = None,
+) -> List[Dict[str, Union[str, int]]]:
+    """ Get all rooms from db, page_size 0 means no limit """
 
-    return [mongo_to_dict(room) async for room in rooms_collection.find()]
+    return await utils.find_page(rooms_collection, {}, page_size, after, projection, lookup)
 
 
-async def get(room_id: ObjectId) -> List[Dict[str, Union[str, int]]]:
+async def count(attributes: dict) -> int:
+    """ Count rooms with specified attributes """
+
+    return await utils.count(rooms_collection, attributes)
+
+
+async def get(
+    room_id: ObjectId, projection: Optional[dict] = None
+) -> List[Dict[str, Union[str, int]]]:
     """ Get room by its db id """
 
-    room = await rooms_collection.find_one({"_id": room_id})
+    if projection is None:
+        found, room = rooms_cache.get(room_id)
+        if found:
+            return room
+
+    room = await rooms_collection.find_one({"_id": room_id}, projection)
     if room:
-        return mongo_to_dict(room)
+        room = mongo_to_dict(room)
+        if projection is None:
+            rooms_cache.set(room)
+        return room
 
 
 async def get_by_ruz_id(ruz_auditorium_oid: int) -> dict:
     """ Get room by its ruz_auditorium_oid """
 
+    found, room = rooms_cache.get_by_key(ruz_auditorium_oid)
+    if found:
+        return room
+
     room = await rooms_collection.find_one({"ruz_auditorium_oid": ruz_auditorium_oid})
     if room:
-        return mongo_to_dict(room)
+        room = mongo_to_dict(room)
+        rooms_cache.set(room)
+        return room
+
+
+async def get_many(
+    field: str, values: List, projection: Optional[dict] = None
+) -> List[Optional[Dict[str, Union[str, int]]]]:
+    """ Get rooms by db ids or ruz_auditorium_oid, in the order of values """
+
+    return await utils.find_by_values(rooms_collection, field, values, projection)
 
 
 async def add(room: dict):
     """ Add room to db """
 
-    room_added = await rooms_collection.insert_one(room)
-    new = await rooms_collection.find_one({"_id": room_added.inserted_id})
-    return mongo_to_dict(new)
+    # insert_one sets _id of the dict, so the document isn't read back
+    await rooms_collection.insert_one(room)
+    await versions.bump("rooms")
+    return mongo_to_dict(room)
 
 
-async def add_empty(room_id: ObjectId):
-    """ Add empty room with specified id to db """
+async def remove(room_id: ObjectId) -> bool:
+    """ Delete room from db, False if it's not found """
 
-    await rooms_collection.insert_one({"_id": room_id})
+    result = await rooms_collection.delete_one({"_id": room_id})
+    rooms_cache.invalidate(room_id)
+    if result.deleted_count:
+        await versions.bump("rooms")
+    return result.deleted_count > 0
 
 
-async def remove(room_id: ObjectId):
-    """ Delete room from db """
+async def patch(room_id: ObjectId, new_values: dict) -> bool:
+    """ Patch room, False if it's not found """
 
-    await rooms_collection.delete_one({"_id": room_id})
+    result = await rooms_collection.update_one({"_id": room_id}, {"$set": new_values})
+    rooms_cache.invalidate(room_id)
+    if result.matched_count:
+        await versions.bump("rooms")
+    return result.matched_count > 0
 
 
-async def patch(room_id: ObjectId, new_values: dict):
-    """ Patch room """
+async def put(room_id: ObjectId, new_values: dict) -> bool:
+    """ Replace room, False if it's not found """
 
-    await rooms_collection.update_one({"_id": room_id}, {"$set": new_values})
+    result = await rooms_collection.replace_one({"_id": room_id}, new_values)
+    rooms_cache.invalidate(room_id)
+    if result.matched_count:
+        await versions.bump("rooms")
+    return result.matched_count > 0
 
 
-async def put(room_id: ObjectId, new_values: dict):
-    """ Update room """
+def iter_many(
+    attributes: dict, projection: Optional[dict] = None, lookup: Optional[List[dict]] = None
+) -> AsyncIterator[dict]:
+    """ Iterate over rooms with specified attributes without loading all of them """
 
-    await rooms_collection.update_one(
-        {"_id": room_id},
-        {"$set": new_values},
-    )
+    return utils.iter_documents(rooms_collection, attributes, projection, lookup)
 
 
-async def sort_many(attributes: dict) -> list:
-    """ Get equipment by its db attributes """
+async def sort_many(
+    attributes: dict,
+    page_size: int = 0,
+    after: Optional[ObjectId] = None,
+    projection: Optional[dict] = None,
+    lookup: Optional[List[dict]] = None,
+) -> list:
+    """ Get rooms by its db attributes """
 
-    return [
-        mongo_to_dict(equipment)
-        async for equipment in rooms_collection.find(attributes)
-    ]
+    return await utils.find_page(rooms_collection, attributes, page_size, after, projection, lookup)
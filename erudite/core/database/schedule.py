@@ -0,0 +1,211 @@
+""" In-process index of lessons in a rolling window, for lookups of what is happening in rooms """
+
+import asyncio
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from loguru import logger
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client import Gauge
+
+from .utils import mongo_to_dict
+from ..settings import settings
+
+
+indexed_lessons = Gauge(
+    "erudite_schedule_index_lessons", "Lessons in the in-process schedule index"
+)
+
+
+def local_now() -> datetime:
+    """ Current time in the local time of the schedule, as lessons start_at """
+
+    return datetime.utcnow() + timedelta(hours=settings.schedule_utc_offset)
+
+
+class RoomLessons:
+    """ Lessons of one room, sorted by (start_at, id) """
+
+    def __init__(self):
+        self.keys: List[Tuple[datetime, str]] = []
+        self.lessons: List[dict] = []
+
+    def add(self, lesson: dict):
+        key = (lesson["start_at"], lesson["id"])
+        position = bisect_left(self.keys, key)
+        self.keys.insert(position, key)
+        self.lessons.insert(position, lesson)
+
+    def remove(self, lesson: dict):
+        position = bisect_left(self.keys, (lesson["start_at"], lesson["id"]))
+        del self.keys[position]
+        del self.lessons[position]
+
+    def between(self, start: datetime, end: datetime, max_duration: timedelta) -> List[dict]:
+        # Only lessons which start less than the longest lesson before `start` can overlap it
+        low = bisect_left(self.keys, (start - max_duration, ""))
+        high = bisect_left(self.keys, (end, ""))
+        return [lesson for lesson in self.lessons[low:high] if lesson["end_at"] > start]
+
+    def after(self, moment: datetime) -> Optional[dict]:
+        position = bisect_right(self.keys, (moment, "\uffff"))
+        if position < len(self.lessons):
+            return self.lessons[position]
+
+
+class ScheduleIndex:
+    """Lessons with start_at in [start, end) by ruz_auditorium_oid.
+
+    Lesson write functions update the index, lessons written by other processes
+    are seen after the next rebuild.
+    """
+
+    def __init__(self):
+        self.start = self.end = datetime.min
+        self.enabled = False
+        self._rooms: Dict[int, RoomLessons] = {}
+        self._lessons: Dict[str, dict] = {}
+        self._max_duration = timedelta(0)
+        # Writes which happen during a rebuild, they are applied to the new lessons too
+        self._writes: Optional[List[Tuple[str, dict]]] = None
+
+    def __len__(self) -> int:
+        return len(self._lessons)
+
+    def covers(self, start: datetime, end: datetime) -> bool:
+        return self.enabled and self.start <= start and end <= self.end
+
+    def rooms(self) -> List[int]:
+        return sorted(self._rooms)
+
+    def _set(self, lesson: dict):
+        self._remove(lesson["id"])
+
+        start_at, end_at = lesson.get("start_at"), lesson.get("end_at")
+        room = lesson.get("ruz_auditorium_oid")
+        if start_at is None or end_at is None or room is None:
+            return
+        if not self.start <= start_at < self.end:
+            return
+
+        self._lessons[lesson["id"]] = lesson
+        self._rooms.setdefault(room, RoomLessons()).add(lesson)
+        self._max_duration = max(self._max_duration, end_at - start_at)
+
+    def _remove(self, lesson_id: str):
+        lesson = self._lessons.pop(lesson_id, None)
+        if lesson is not None:
+            self._rooms[lesson["ruz_auditorium_oid"]].remove(lesson)
+
+    def set(self, lesson: dict):
+        """ Add or replace the lesson, which is a document in the form of mongo_to_dict """
+
+        lesson = dict(lesson)
+        if self._writes is not None:
+            self._writes.append(("set", lesson))
+        self._set(lesson)
+        indexed_lessons.set(len(self._lessons))
+
+    def remove(self, lesson_id: str):
+        if self._writes is not None:
+            self._writes.append(("remove", lesson_id))
+        self._remove(lesson_id)
+        indexed_lessons.set(len(self._lessons))
+
+    async def rebuild(self, collection):
+        """ Load lessons of the window which ends schedule_days_after days after today """
+
+        today = local_now().replace(hour=0, minute=0, second=0, microsecond=0)
+        start = today - timedelta(days=settings.schedule_days_before)
+        end = today + timedelta(days=settings.schedule_days_after + 1)
+
+        self._writes = []
+        try:
+            cursor = collection.find({"start_at": {"$gte": start, "$lt": end}})
+            lessons = [mongo_to_dict(lesson) async for lesson in cursor]
+            writes = self._writes
+        finally:
+            self._writes = None
+
+        self.start, self.end = start, end
+        self._rooms, self._lessons = {}, {}
+        self._max_duration = timedelta(0)
+        for lesson in lessons:
+            self._set(lesson)
+        for operation, value in writes:
+            if operation == "set":
+                self._set(value)
+            else:
+                self._remove(value)
+
+        self.enabled = True
+        indexed_lessons.set(len(self._lessons))
+        logger.info(f"Schedule index is built: {len(self._lessons)} lessons from {start} to {end}")
+
+    def between(
+        self, start: datetime, end: datetime, rooms: Optional[Iterable[int]] = None
+    ) -> List[dict]:
+        """ Lessons which overlap [start, end), sorted by room and start """
+
+        result = []
+        for room in self.rooms() if rooms is None else rooms:
+            if room in self._rooms:
+                result += self._rooms[room].between(start, end, self._max_duration)
+        return result
+
+    def at(
+        self, moment: datetime, rooms: Optional[Iterable[int]] = None
+    ) -> List[Dict[str, object]]:
+        """ Current and next lessons of every room at the moment """
+
+        result = []
+        for room in self.rooms() if rooms is None else rooms:
+            lessons = self._rooms.get(room)
+            if lessons is None:
+                result.append({"ruz_auditorium_oid": room, "current": [], "next": None})
+                continue
+
+            result.append(
+                {
+                    "ruz_auditorium_oid": room,
+                    "current": lessons.between(
+                        moment, moment + timedelta(microseconds=1), self._max_duration
+                    ),
+                    "next": lessons.after(moment),
+                }
+            )
+        return result
+
+
+index = ScheduleIndex()
+
+refresh_task: Optional[asyncio.Task] = None
+
+
+async def refresh(collection):
+    """ Rebuild the index, so that the window rolls and writes of other processes are seen """
+
+    while True:
+        try:
+            await index.rebuild(collection)
+        except Exception as error:
+            logger.error(f"Schedule index is not rebuilt: {error}")
+        await asyncio.sleep(settings.schedule_refresh_interval)
+
+
+async def start():
+    """ Build the index in background, it isn't used until it's built """
+
+    global refresh_task
+
+    from .lessons import lessons_collection
+
+    refresh_task = asyncio.create_task(refresh(lessons_collection))
+
+
+async def stop():
+    global refresh_task
+
+    if refresh_task is not None:
+        refresh_task.cancel()
+        refresh_task = None
@@ -0,0 +1,97 @@
+""" Time limits of the queries of the current request
+
+The limits are set by TimeoutMiddleware for every request. Queries are tagged with
+the comment of the request, so that the ones which are still running on the server
+can be killed when the client disconnects.
+"""
+
+import time
+from contextvars import ContextVar
+from loguru import logger
+from typing import Optional
+
+from prometheus_client import Histogram
+from pymongo.errors import PyMongoError
+
+from .models import client
+
+# maxTimeMS of the queries of the request, None means no limit
+request_max_time_ms: ContextVar[Optional[int]] = ContextVar("request_max_time_ms", default=None)
+request_comment: ContextVar[Optional[str]] = ContextVar("request_comment", default=None)
+# First segment of the path, which QUERY_TIMEOUTS are keyed by
+request_endpoint: ContextVar[str] = ContextVar("request_endpoint", default="")
+request_started: ContextVar[Optional[float]] = ContextVar("request_started", default=None)
+
+aborted_requests = Histogram(
+    "erudite_aborted_request_seconds",
+    "Time until a request was aborted by a query timeout, an unavailable db or a client disconnect",
+    ["endpoint", "reason"],
+)
+
+
+def aborted(reason: str):
+    started = request_started.get()
+    if started is not None:
+        aborted_requests.labels(request_endpoint.get(), reason).observe(
+            time.monotonic() - started
+        )
+
+
+def max_time_ms(limit: Optional[int] = None) -> Optional[int]:
+    """ The shortest of the limit (e.g. of the query guard) and the limit of the request """
+
+    limits = [value for value in (limit, request_max_time_ms.get()) if value]
+    return min(limits) if limits else None
+
+
+def options(limit: Optional[int] = None) -> dict:
+    """ Keyword arguments of aggregate, count_documents and distinct """
+
+    result = {}
+    time_limit = max_time_ms(limit)
+    if time_limit is not None:
+        result["maxTimeMS"] = time_limit
+
+    comment = request_comment.get()
+    if comment is not None:
+        result["comment"] = comment
+
+    return result
+
+
+def apply(cursor, limit: Optional[int] = None):
+    """ Set the limit and the comment of the request to a find cursor """
+
+    time_limit = max_time_ms(limit)
+    if time_limit is not None:
+        cursor = cursor.max_time_ms(time_limit)
+
+    comment = request_comment.get()
+    if comment is not None:
+        cursor = cursor.comment(comment)
+
+    return cursor
+
+
+async def kill(comment: str):
+    """ Kill queries and getMores with the comment, needs the killop privilege """
+
+    try:
+        operations = client.admin.aggregate(
+            [
+                {"$currentOp": {}},
+                {
+                    "$match": {
+                        "$or": [
+                            {"command.comment": comment},
+                            {"cursor.originatingCommand.comment": comment},
+                        ]
+                    }
+                },
+            ]
+        )
+        async for operation in operations:
+            await client.admin.command("killOp", op=operation["opid"])
+            logger.info(f"Query {operation['opid']} of a disconnected client is killed")
+    except PyMongoError as error:
+        logger.info(f"Queries of a disconnected client are not killed: {error}")
@@ -1,9 +1,32 @@
 """ Вспомогательные функции """
 
+import base64
+import json
+import re
+from datetime import datetime, timedelta
 from loguru import logger
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
 
 from bson.objectid import ObjectId
 
+from . import guard, timeouts
+from ..settings import settings
+
+
+# Arguments of list routes which are not attributes of documents
+list_args = (
+    "request",
+    "response",
+    "page_size",
+    "cursor",
+    "after",
+    "stream",
+    "fields",
+    "projection",
+    "expand",
+    "lookup",
+)
+
 
 # Schemas to dictionary
 def mongo_to_dict(obj):
@@ -16,6 +39,46 @@ def mongo_to_dict(obj):
     return res
 
 
+def datetime_fields(document: dict) -> Dict[str, datetime]:
+    """start_at and end_at made of date, start_time and end_time strings of the document.
+
+    Times are kept in the local time of the schedule, as in the strings. Empty dict
+    if the strings are missing or written in the wrong format.
+    """
+
+    try:
+        start_at, end_at = (
+            datetime.strptime(document["date"], "%Y-%m-%d").replace(
+                hour=int(document[field].split(":")[0]),
+                minute=int(document[field].split(":")[1]),
+            )
+            for field in ("start_time", "end_time")
+        )
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return {}
+
+    # Ends after midnight
+    if end_at < start_at:
+        end_at += timedelta(days=1)
+
+    return {"start_at": start_at, "end_at": end_at}
+
+
+def datetime_filter(
+    fromdate: Optional[datetime], todate: Optional[datetime], field: str = "start_at"
+) -> dict:
+    """ Filter for documents with field between fromdate and todate, both are optional """
+
+    value_range = {}
+    # Stored datetimes are naive, see datetime_fields
+    if fromdate is not None:
+        value_range["$gte"] = fromdate.replace(tzinfo=None)
+    if todate is not None:
+        value_range["$lte"] = todate.replace(tzinfo=None)
+
+    return {field: value_range} if value_range else {}
+
+
 # Check if ObjectId is in the right format
 def check_ObjectId(id: str) -> ObjectId:
     try:
@@ -27,13 +90,226 @@ def check_ObjectId(id: str) -> ObjectId:
         return False
 
 
+# Check a batch of ObjectIds, returns the valid ones and the ids in the wrong format
+def check_ObjectIds(ids: Iterable[str]) -> Tuple[List[ObjectId], List[str]]:
+    valid, invalid = [], []
+    for id in ids:
+        new_id = check_ObjectId(id)
+        if new_id:
+            valid.append(new_id)
+        else:
+            invalid.append(id)
+
+    return valid, invalid
+
+
 # Get all arguments from a function witch are not None
-def get_not_None_args(all_args: dict) -> dict:
+def get_not_None_args(all_args: dict, exclude: Iterable[str] = ()) -> dict:
     filter_list = {
         element: all_args[element]
         for element in all_args
-        if all_args[element] is not None
+        if all_args[element] is not None and element not in exclude
     }
     del all_args
 
     return filter_list
+
+
+# Make db projection from comma separated field names, False if names are wrong
+def get_projection(fields: str) -> Union[Dict[str, int], bool]:
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    if not names or not all(re.fullmatch(r"[A-Za-z_][\w.]*", name) for name in names):
+        message = "Fields are written in the wrong format"
+        logger.info(message)
+        return False
+
+    return {name: 1 for name in names}
+
+
+def get_lookup(expand: str, relations: Dict[str, List[dict]]) -> Union[List[dict], bool]:
+    """ Aggregation stages which embed the comma separated relations, False if one is unknown """
+
+    names = [name.strip() for name in expand.split(",") if name.strip()]
+    if not names or not all(name in relations for name in names):
+        message = f"Relations are written in the wrong format, known ones: {list(relations)}"
+        logger.info(message)
+        return False
+
+    return [stage for name in dict.fromkeys(names) for stage in relations[name]]
+
+
+def lookup_fields(lookup: List[dict]) -> List[str]:
+    """ Fields which documents are embedded into by the lookup stages """
+
+    return [stage["$lookup"]["as"] for stage in lookup if "$lookup" in stage]
+
+
+def expanded_to_dict(document: dict, fields: List[str]) -> dict:
+    """ mongo_to_dict of the document and of the documents embedded into it """
+
+    document = mongo_to_dict(document)
+    for field in fields:
+        value = document.get(field)
+        if isinstance(value, list):
+            document[field] = [mongo_to_dict(embedded) for embedded in value]
+        elif isinstance(value, dict):
+            document[field] = mongo_to_dict(value)
+
+    return document
+
+
+def lookup_pipeline(
+    attributes: dict,
+    lookup: List[dict],
+    projection: Optional[dict] = None,
+    page_size: int = 0,
+    sort: bool = False,
+) -> List[dict]:
+    """ Pipeline which embeds relations into the documents, after they are limited to a page """
+
+    pipeline = [{"$match": attributes}]
+    if sort:
+        pipeline.append({"$sort": {"_id": 1}})
+    if page_size:
+        pipeline.append({"$limit": page_size})
+    pipeline += lookup
+    if projection is not None:
+        pipeline.append({"$project": {**projection, **dict.fromkeys(lookup_fields(lookup), 1)}})
+
+    return pipeline
+
+
+# Encode sort key values of the last document on a page into an opaque token
+def encode_cursor(values: list) -> str:
+    raw = json.dumps([str(v) if isinstance(v, ObjectId) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+# Decode token made by encode_cursor, None if it's broken
+def decode_cursor(cursor: str, length: int) -> Optional[List]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        logger.info("Cursor is written in the wrong format")
+        return None
+
+    if not isinstance(values, list) or len(values) != length:
+        logger.info("Cursor is written in the wrong format")
+        return None
+
+    return values
+
+
+# Decode cursor made by next_id_cursor into the ObjectId of the last document of a page
+def decode_id_cursor(cursor: str) -> Optional[ObjectId]:
+    values = decode_cursor(cursor, 1)
+    if values is None:
+        return None
+
+    return check_ObjectId(values[0]) or None
+
+
+# Cursor for the page after the given one, None if it was the last page
+def next_id_cursor(page: List[dict], page_size: int) -> Optional[str]:
+    if page_size == 0 or len(page) < page_size:
+        return None
+
+    return encode_cursor([page[-1]["id"]])
+
+
+# Headers with the total number of documents and cursor for the next page
+def page_headers(page: List[dict], page_size: int, total: int) -> Dict[str, str]:
+    headers = {"X-Total-Count": str(total)}
+
+    next_cursor = next_id_cursor(page, page_size)
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+
+    return headers
+
+
+# Get a page of documents ordered by _id, page_size 0 means no limit
+async def find_page(
+    collection,
+    attributes: dict,
+    page_size: int = 0,
+    after: Optional[ObjectId] = None,
+    projection: Optional[dict] = None,
+    lookup: Optional[List[dict]] = None,
+) -> List[dict]:
+    if after is not None:
+        attributes = {"$and": [attributes, {"_id": {"$gt": after}}]}
+
+    max_time_ms = await guard.check(collection, attributes, [("_id", 1)])
+
+    if lookup:
+        fields = lookup_fields(lookup)
+        cursor = collection.aggregate(
+            lookup_pipeline(attributes, lookup, projection, page_size, sort=True),
+            **timeouts.options(max_time_ms),
+        )
+        return [expanded_to_dict(document, fields) async for document in cursor]
+
+    cursor = collection.find(attributes, projection).sort("_id", 1).limit(page_size)
+    cursor = timeouts.apply(cursor, max_time_ms)
+    return [mongo_to_dict(document) async for document in cursor]
+
+
+# Count documents, the unfiltered count is taken from collection metadata
+async def count(collection, attributes: dict) -> int:
+    if not attributes:
+        return await collection.estimated_document_count()
+
+    max_time_ms = await guard.check(collection, attributes)
+    return await collection.count_documents(attributes, **timeouts.options(max_time_ms))
+
+
+# Iterate over documents fetching them from db in batches, instead of building a list
+async def iter_documents(
+    collection,
+    attributes: dict,
+    projection: Optional[dict] = None,
+    lookup: Optional[List[dict]] = None,
+) -> AsyncIterator[dict]:
+    max_time_ms = await guard.check(collection, attributes, stream=True)
+
+    if lookup:
+        fields = lookup_fields(lookup)
+        cursor = collection.aggregate(
+            lookup_pipeline(attributes, lookup, projection),
+            batchSize=settings.stream_batch_size,
+            **timeouts.options(max_time_ms),
+        )
+        async for document in cursor:
+            yield expanded_to_dict(document, fields)
+        return
+
+    cursor = collection.find(attributes, projection).batch_size(settings.stream_batch_size)
+    cursor = timeouts.apply(cursor, max_time_ms)
+    async for document in cursor:
+        yield mongo_to_dict(document)
+
+
+# Get documents by values of the field with one $in query, in the order of values,
+# with None for the values which aren't found
+async def find_by_values(
+    collection,
+    field: str,
+    values: List,
+    projection: Optional[dict] = None,
+) -> List[Optional[dict]]:
+    if not values:
+        return []
+
+    # The field is needed to put documents in order, even if it wasn't asked for
+    drop_field = projection is not None and field != "_id" and field not in projection
+    if drop_field:
+        projection = {**projection, field: 1}
+
+    found = {}
+    cursor = collection.find({field: {"$in": list(set(values))}}, projection)
+    async for document in timeouts.apply(cursor):
+        key = document.pop(field) if drop_field else document[field]
+        found[key] = mongo_to_dict(document)
+
+    return [found.get(value) for value in values]
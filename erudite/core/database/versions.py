@@ -0,0 +1,39 @@
+""" Versions of collections, bumped by every write function
+
+Versions are kept in the db, so writes of every worker and of the migrations CLI
+are seen by all of them. Writes which don't go through the write functions (e.g.
+by hand in the mongo shell) have to bump the version too:
+    db.versions.updateOne({_id: "<collection>"}, {$inc: {version: 1}}, {upsert: true})
+"""
+
+from typing import Iterable, Tuple
+
+from bson.objectid import ObjectId
+from pymongo import ReadPreference
+
+from .models import db
+
+# Always read from the primary, a version from a lagging secondary would be older than the data
+versions_collection = db.get_collection("versions", read_preference=ReadPreference.PRIMARY)
+
+
+async def bump(collection: str):
+    """ Mark collection as changed """
+
+    # Epoch tells apart versions of a dropped and recreated versions collection
+    await versions_collection.update_one(
+        {"_id": collection},
+        {"$inc": {"version": 1}, "$setOnInsert": {"epoch": str(ObjectId())}},
+        upsert=True,
+    )
+
+
+async def get(collections: Iterable[str]) -> Tuple[Tuple[str, int], ...]:
+    """ Get current version of the collections """
+
+    collections = list(collections)
+    found = {
+        document["_id"]: (document.get("epoch", ""), document["version"])
+        async for document in versions_collection.find({"_id": {"$in": collections}})
+    }
+    return tuple(found.get(collection, ("", 0)) for collection in collections)
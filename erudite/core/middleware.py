@@ -1,35 +1,337 @@
+import asyncio
+import hashlib
 import logging
+import time
+import uuid
 from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs
 
 from fastapi import Request, Response
 from fastapi.responses import JSONResponse
+from prometheus_client import Counter
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match, Route
+from starlette.types import ASGIApp, Receive, Scope, Send
 import asyncpg
 
+from .cache import TTLCache
+from .database import timeouts, versions
+from .database.models import secondary_reads
 from .settings import settings
 
 PSQL_DATABASE_ADRESS: str = settings.psql_url
 
+# Only the key column is needed to tell if the key is valid
+API_KEY_QUERY = "SELECT api_key FROM users WHERE api_key = $1"
+
+# Paths which are accessible without API key
+PUBLIC_PATHS = frozenset(
+    [
+        "/api/erudite/docs",
+        "/api/erudite/redoc",
+        "/api/erudite/openapi.json",
+    ]
+)
+
+# POST routes which only read, they are as accessible as GET
+READ_ONLY_PATHS = frozenset(
+    [
+        "/rooms/batch-get",
+        "/equipment/batch-get",
+        "/disciplines/batch-get",
+        "/lessons/batch-get",
+        "/records/batch-get",
+    ]
+)
+
+# Collections which GET responses depend on, by the path of the route
+ETAG_COLLECTIONS: Dict[str, Tuple[str, ...]] = {
+    "/rooms": ("rooms",),
+    "/rooms/free": ("rooms", "lessons"),
+    "/rooms/{room_id}": ("rooms",),
+    "/rooms/{room_id}/equipment": ("rooms", "equipment"),
+    "/equipment": ("equipment",),
+    "/equipment/{equipment_id}": ("equipment",),
+    "/disciplines": ("disciplines",),
+    "/disciplines/{discipline_id}": ("disciplines",),
+    "/lessons": ("lessons",),
+    "/lessons/conflicts": ("lessons",),
+    "/lessons/{lesson_id}": ("lessons",),
+    "/records": ("records",),
+    "/records/{record_id}": ("records",),
+}
+
+# Collections of the relations embedded with expand=, by the path of the route
+ETAG_RELATIONS: Dict[str, Dict[str, str]] = {
+    "/rooms": {"equipment": "equipment"},
+    "/equipment": {"room": "rooms"},
+    "/lessons": {"room": "rooms", "discipline": "disciplines"},
+}
+
 logger = logging.getLogger("erudite")
 
+pool: Optional[asyncpg.pool.Pool] = None
+
+# Both valid and invalid keys are cached, invalid ones for a shorter time
+key_cache = TTLCache(settings.api_key_cache_size, settings.api_key_cache_ttl)
+
+key_cache_requests = Counter(
+    "erudite_api_key_cache_requests_total",
+    "API key lookups in the in-process cache",
+    ["result"],
+)
+
+
+def route_path(scope: Scope) -> Optional[str]:
+    """ Path of the route which the request goes to, e.g. /rooms/{room_id} """
+
+    for route in scope["app"].router.routes:
+        if isinstance(route, Route) and route.matches(scope)[0] == Match.FULL:
+            return route.path
+    return None
+
+
+def etag_collections(scope: Scope) -> Optional[Tuple[str, ...]]:
+    """ Collections which the response depends on, None if it doesn't have an ETag """
+
+    path = route_path(scope)
+    collections = ETAG_COLLECTIONS.get(path)
+    if collections is None:
+        return None
+
+    relations = ETAG_RELATIONS.get(path, {})
+    for expand in parse_qs(scope["query_string"].decode()).get("expand", []):
+        for name in expand.split(","):
+            collection = relations.get(name.strip())
+            if collection is not None and collection not in collections:
+                collections += (collection,)
+    return collections
+
+
+def endpoint(scope: Scope) -> str:
+    """ First segment of the path, which settings of endpoints are keyed by """
+
+    return scope["path"].strip("/").split("/")[0]
+
+
+async def create_pool():
+    global pool
+
+    pool = await asyncpg.create_pool(
+        PSQL_DATABASE_ADRESS,
+        min_size=settings.psql_pool_min_size,
+        max_size=settings.psql_pool_max_size,
+    )
+    logger.info("PostgreSQL connection pool created")
+
+
+async def close_pool():
+    global pool
+
+    if pool is not None:
+        await pool.close()
+        pool = None
+
 
 @asynccontextmanager
 async def db_connect():
-    conn = await asyncpg.connect(PSQL_DATABASE_ADRESS)
-    try:
+    # Fall back to a short-lived connection if the pool wasn't created on startup
+    if pool is None:
+        conn = await asyncpg.connect(PSQL_DATABASE_ADRESS)
+        try:
+            yield conn
+        finally:
+            await conn.close()
+        return
+
+    async with pool.acquire() as conn:
         yield conn
-    finally:
-        await conn.close()
+
+
+class AuthorizationMiddleware:
+    """Pure ASGI version of `authorization`.
+
+    GET requests and docs are passed to the app untouched, so request and
+    response bodies are streamed as is.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] == "GET"
+            or (scope["method"] == "POST" and scope["path"] in READ_ONLY_PATHS)
+            or scope.get("root_path", "") + scope["path"] in PUBLIC_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        api_key = Headers(scope=scope).get("key")
+        if api_key is None:
+            response = JSONResponse(status_code=401, content={"message": "No API key provided"})
+        else:
+            response = await check_key(api_key)
+
+        if not response.status_code == 200:
+            await response(scope, receive, send)
+            return
+
+        await self.app(scope, receive, send)
+
+
+class ConditionalGetMiddleware:
+    """Adds ETag to GET responses and answers If-None-Match with 304.
+
+    ETag is made of the versions of the collections which the route and its expand=
+    relations read, they are bumped by the write functions, so 304 is sent after one
+    lookup of the versions instead of the query.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        collections = etag_collections(scope)
+        if collections is None:
+            await self.app(scope, receive, send)
+            return
+
+        # Version is taken before the query, so a concurrent write can only make ETag older
+        headers = Headers(scope=scope)
+        etag = make_etag(collections, await versions.get(collections), headers.get("accept", ""))
+
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None and (
+            if_none_match.strip() == "*"
+            or etag in [tag.strip() for tag in if_none_match.split(",")]
+        ):
+            response = Response(status_code=304, headers={"ETag": etag})
+            await response(scope, receive, send)
+            return
+
+        async def send_with_etag(message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                response_headers = MutableHeaders(scope=message)
+                response_headers["ETag"] = etag
+                response_headers.append("Vary", "Accept")
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
+
+
+class TimeoutMiddleware:
+    """Sets the time limit of the queries of the request, see core.database.timeouts.
+
+    GET requests are cancelled when the client disconnects, and their queries which
+    are still running on the server are killed.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        name = endpoint(scope)
+        comment = f"erudite {uuid.uuid4().hex}"
+        timeouts.request_endpoint.set(name)
+        timeouts.request_started.set(time.monotonic())
+        timeouts.request_max_time_ms.set(
+            settings.query_timeouts.get(name, settings.query_timeout_ms)
+        )
+        timeouts.request_comment.set(comment)
+
+        if scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        # Messages are passed to the app through the queue, so that the disconnect
+        # is seen even if the app doesn't read them while it waits for the db
+        messages: asyncio.Queue = asyncio.Queue()
+
+        async def watch_disconnect():
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    return
+
+        app_task = asyncio.ensure_future(self.app(scope, messages.get, send))
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await asyncio.wait([app_task, watcher], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            app_task.cancel()
+            raise
+        finally:
+            watcher.cancel()
+
+        if app_task.done():
+            app_task.result()
+            return
+
+        app_task.cancel()
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            pass
+        await timeouts.kill(comment)
+
+        timeouts.aborted("disconnect")
+        logger.info(f"Request {scope['path']} is cancelled, the client is disconnected")
+
+
+class ReadPreferenceMiddleware:
+    """GET requests read with MONGO_READ_PREFERENCE, other requests read from the primary.
+
+    Header `X-Read-Preference: primary` makes a GET read from the primary too, e.g. to read
+    back a document right after it was written. With ETags all reads stay on the primary,
+    because versions are read from the primary, and a response read from a lagging
+    secondary would be cached with the ETag of the new version.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] not in ("GET", "HEAD")
+            or settings.etag_enabled
+            or Headers(scope=scope).get("x-read-preference", "").lower() == "primary"
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        token = secondary_reads.set(True)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            secondary_reads.reset(token)
+
+
+def make_etag(collections: Tuple[str, ...], version: Tuple, accept: str) -> str:
+    # Accept is a part of ETag, because the same url can be returned as JSON or NDJSON
+    digest = hashlib.sha1(f"{collections}{version}{accept}".encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
 
 
 async def authorization(request: Request, call_next):
+    """ BaseHTTPMiddleware dispatch function, kept for comparison with AuthorizationMiddleware """
+
     if (
-        request.url.path
-        in [
-            "/api/erudite/docs",
-            "/api/erudite/redoc",
-            "/api/erudite/openapi.json",
-        ]
+        request.url.path in PUBLIC_PATHS
         or request.method == "GET"
+        or (request.method == "POST" and request.scope["path"] in READ_ONLY_PATHS)
     ):
         return await call_next(request)
 
@@ -44,11 +346,28 @@ async def authorization(request: Request, call_next):
     return await call_next(request)
 
 
-async def check_key(key: str):
+async def is_valid_key(key: str) -> bool:
+    found, valid = key_cache.lookup(key)
+    if found:
+        key_cache_requests.labels("hit").inc()
+        return valid
+
+    key_cache_requests.labels("miss").inc()
+
+    # asyncpg prepares the statement once per pooled connection and reuses it
     async with db_connect() as conn:
-        user = await conn.fetchrow("SELECT * FROM users WHERE api_key = $1", key)
+        valid = await conn.fetchval(API_KEY_QUERY, key) is not None
 
-    if not user:
+    if valid:
+        key_cache.set(key, True)
+    else:
+        key_cache.set(key, False, ttl=settings.api_key_negative_cache_ttl)
+
+    return valid
+
+
+async def check_key(key: str):
+    if not await is_valid_key(key):
         return JSONResponse(status_code=401, content={"message": "Invalid API key"})
 
     return Response(status_code=200)
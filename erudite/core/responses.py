@@ -0,0 +1,268 @@
+""" Request and response helpers shared by the routers """
+
+from functools import lru_cache
+from loguru import logger
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError, create_model
+from bson.objectid import ObjectId
+import orjson
+
+from .database import timeouts
+from .database.models import BatchGet
+from .database.utils import check_ObjectIds
+from .settings import settings
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def orjson_default(obj: Any) -> Any:
+    """ Types which orjson can't serialize by itself (datetime it can) """
+
+    if isinstance(obj, ObjectId):
+        return str(obj)
+
+    raise TypeError(f"Type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class FastJSONResponse(JSONResponse):
+    """ JSONResponse rendered by orjson """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def fast_json(router: str) -> bool:
+    """ Check if router is configured to skip response_model validation """
+
+    return router in settings.fast_json_routers
+
+
+async def iter_request_items(request: Request) -> AsyncIterator[Tuple[Any, Optional[str]]]:
+    """Iterate over items of JSON array or NDJSON request body.
+
+    Yields (item, None), or (None, error) for a line which is not valid JSON.
+    NDJSON body is parsed line by line as it's received. Raises ValueError
+    if JSON body is not an array.
+    """
+
+    if NDJSON_MEDIA_TYPE not in request.headers.get("content-type", ""):
+        try:
+            items = orjson.loads(await request.body())
+        except orjson.JSONDecodeError as error:
+            raise ValueError(f"Body is not valid JSON: {error}")
+
+        if not isinstance(items, list):
+            raise ValueError("Body should be a JSON array")
+
+        for item in items:
+            yield item, None
+        return
+
+    buffer = b""
+    async for chunk in request.stream():
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse_line(line)
+
+    if buffer.strip():
+        yield parse_line(buffer)
+
+
+def parse_line(line: bytes) -> Tuple[Any, Optional[str]]:
+    try:
+        return orjson.loads(line), None
+    except orjson.JSONDecodeError as error:
+        return None, f"Line is not valid JSON: {error}"
+
+
+async def bulk_write(
+    request: Request,
+    model: Type[BaseModel],
+    write: Callable[[List[Tuple[int, dict]]], Awaitable[List[dict]]],
+) -> List[dict]:
+    """Validate items of the request body and pass (index, item) batches to write.
+
+    Items are written as the model parsed them, so values are coerced to the field
+    types, fields allowed by extra = "allow" are kept. Items which are not valid are
+    failed without writing. Returns results of all items in the request order.
+    Raises ValueError as iter_request_items.
+    """
+
+    items = []
+    batch = []
+    index = 0
+
+    async for item, error in iter_request_items(request):
+        if error is None:
+            try:
+                item = model.parse_obj(item).dict(exclude_unset=True)
+            except ValidationError as validation_error:
+                error = "; ".join(
+                    f"{'.'.join(map(str, e['loc']))}: {e['msg']}"
+                    for e in validation_error.errors()
+                )
+
+        if error is not None:
+            items.append({"index": index, "status": "failed", "message": error})
+        else:
+            batch.append((index, item))
+
+        if len(batch) >= settings.bulk_batch_size:
+            items += await write(batch)
+            batch = []
+        index += 1
+
+    if batch:
+        items += await write(batch)
+
+    items.sort(key=lambda item: item["index"])
+    return items
+
+
+def bulk_response(items: List[dict]) -> JSONResponse:
+    result: Dict[str, Any] = {
+        status: sum(item["status"] == status for item in items)
+        for status in ("created", "updated", "failed")
+    }
+
+    # Result can be as long as the request, so it isn't validated by response_model
+    return FastJSONResponse({**result, "items": items})
+
+
+def accepts_ndjson(request: Request) -> bool:
+    """ Check if client asked for newline delimited JSON """
+
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def ndjson_lines(documents: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    async for document in documents:
+        yield dumps(document) + b"\n"
+
+
+def ndjson_response(documents: AsyncIterator[dict]) -> StreamingResponse:
+    """ Stream documents one JSON object per line, as they come from the db cursor """
+
+    return StreamingResponse(ndjson_lines(documents), media_type=NDJSON_MEDIA_TYPE)
+
+
+@lru_cache(maxsize=256)
+def partial_model(model: Type[BaseModel], fields: FrozenSet[str]) -> Type[BaseModel]:
+    """ Model with only the given fields of `model`, all of them optional """
+
+    definitions = {
+        name: (Optional[field.outer_type_], None)
+        for name, field in model.__fields__.items()
+        if name in fields
+    }
+    return create_model(f"Partial{model.__name__}", __config__=model.__config__, **definitions)
+
+
+def projected(
+    model: Type[BaseModel],
+    projection: Optional[dict],
+    content: Union[dict, List[dict]],
+    response: Optional[Response] = None,
+    fast: bool = False,
+):
+    """Return content for response_model validation, or if it was projected,
+    validate only the fields which were asked for.
+
+    With `fast` documents are serialized as they are, without any validation.
+    """
+
+    headers = dict(response.headers) if response is not None else None
+    if fast:
+        return FastJSONResponse(content=content, headers=headers)
+
+    if projection is None:
+        return content
+
+    partial = partial_model(model, frozenset(name.split(".")[0] for name in projection))
+    if isinstance(content, list):
+        data = [
+            partial(**document).dict(exclude_unset=True) if document is not None else None
+            for document in content
+        ]
+    else:
+        data = partial(**content).dict(exclude_unset=True)
+
+    return JSONResponse(content=jsonable_encoder(data), headers=headers)
+
+
+async def batch_get(
+    body: BatchGet,
+    key_field: str,
+    get_many: Callable[[str, List, Optional[dict]], Awaitable[List[Optional[dict]]]],
+    model: Type[BaseModel],
+    projection: Optional[dict] = None,
+    fast: bool = False,
+):
+    """Documents of the ids or natural keys of the body, in the order of the body
+    with null for the ones which aren't found.
+    """
+
+    if (body.ids is None) == (body.keys is None):
+        message = "Either ids or keys should be provided"
+        logger.info(message)
+        return JSONResponse(status_code=400, content={"message": message})
+
+    if body.ids is not None:
+        values, invalid = check_ObjectIds(body.ids)
+        if invalid:
+            message = "ObjectIds are written in the wrong format"
+            logger.info(f"{message}: {invalid}")
+            return JSONResponse(status_code=400, content={"message": message, "ids": invalid})
+        field = "_id"
+    else:
+        field, values = key_field, body.keys
+
+    documents = await get_many(field, values, projection)
+    return projected(model, projection, documents, fast=fast)
+
+
+async def query_rejected(request: Request, error: Exception) -> JSONResponse:
+    """ Exception handler of queries rejected by the query guard """
+
+    message = str(error)
+    logger.info(message)
+    return JSONResponse(status_code=400, content={"message": message})
+
+
+async def query_timeout(request: Request, error: Exception) -> JSONResponse:
+    """ Exception handler of queries which exceeded maxTimeMS """
+
+    timeouts.aborted("timeout")
+    message = "The query took too long, narrow down the filter"
+    logger.info(f"{message}: {request.url.path}, {error}")
+    return JSONResponse(status_code=504, content={"message": message})
+
+
+async def database_unavailable(request: Request, error: Exception) -> JSONResponse:
+    """ Exception handler of connection errors of the db """
+
+    timeouts.aborted("unavailable")
+    message = "Database is not available, try again later"
+    logger.warning(f"{message}: {request.url.path}, {error}")
+    return JSONResponse(status_code=503, content={"message": message})
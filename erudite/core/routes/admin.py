@@ -0,0 +1,46 @@
+from fastapi import APIRouter
+from typing import Dict, List
+
+from ..database import guard, indexes, migrations
+
+
+router = APIRouter()
+
+
+@router.get(
+    "/admin/indexes",
+    summary="Get index report",
+    description=(
+        "Get missing, unused and undeclared indexes of every collection. "
+        "Usage is counted since the last restart of the database"
+    ),
+    response_model=Dict[str, indexes.IndexReport],
+)
+async def get_index_report():
+    return await indexes.report()
+
+
+@router.get(
+    "/admin/migrations",
+    summary="Get migrations status",
+    description=(
+        "Get progress of every migration. Migrations are applied with "
+        "`python -m core.database.migrations run`"
+    ),
+    response_model=List[migrations.MigrationStatus],
+)
+async def get_migrations_status():
+    return await migrations.status()
+
+
+@router.get(
+    "/admin/query-guard",
+    summary="Get collection scans",
+    description=(
+        "Get shapes of queries which are resolved with a collection scan, "
+        "see QUERY_GUARD_POLICY for what is done with them"
+    ),
+    response_model=List[guard.OffendingShape],
+)
+async def get_query_guard_report():
+    return guard.report()
@@ -1,38 +1,144 @@
 from loguru import logger
+from pymongo.errors import DuplicateKeyError
 from typing import Optional, List
 
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Query, Request, Response
 from fastapi.responses import JSONResponse
 
-from ..database.models import Message
-from ..database.utils import check_ObjectId
+from ..database.models import BatchGet, Message
+from ..database.filters import compile_filter
+from ..database.utils import (
+    check_ObjectId,
+    decode_id_cursor,
+    get_not_None_args,
+    get_projection,
+    list_args,
+    page_headers,
+)
+from ..responses import batch_get, fast_json, projected
 from ..database import disciplines
+from ..settings import settings
 
 
 router = APIRouter()
 
+FAST_JSON = fast_json("disciplines")
+
 
 @router.get(
     "/disciplines",
     summary="Get all disciplines/discipline by it's course code",
     description=(
-        "Get a list of all disciplines in the database, or a discipline by it's course code"
+        "Get a page of disciplines in the database, or a discipline by it's course code. "
+        "X-Total-Count header contains the number of disciplines, "
+        "X-Next-Cursor header contains a cursor for the next page"
     ),
     response_model=List[disciplines.Discipline],
-    responses={404: {"model": Message}},
+    responses={400: {"model": Message}, 404: {"model": Message}},
 )
-async def get_disciplines(course_code: Optional[str] = None):
-    if course_code is None:
-        return await disciplines.get_all()
-
-    discipline = await disciplines.get_by_cource_code(course_code)
-    if discipline:
-        logger.info(f"Discipline {course_code}: {discipline}")
-        return [discipline]
-    else:
-        message = "This discipline is not found"
+async def get_disciplines(
+    request: Request,
+    response: Response,
+    page_size: int = Query(settings.page_size_default, ge=1, le=settings.page_size_max),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. ip,rtsp_main"
+    ),
+    course_code: Optional[str] = None,
+):
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    after = None
+    if cursor is not None:
+        after = decode_id_cursor(cursor)
+        if after is None:
+            message = "Cursor is written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    all_args = locals()
+    try:
+        filter_args = compile_filter(
+            request.query_params.multi_items(),
+            get_not_None_args(all_args, exclude=list_args),
+            all_args,
+            disciplines.Discipline,
+            disciplines.indexes,
+        )
+    except ValueError as error:
+        message = str(error)
         logger.info(message)
-        return JSONResponse(status_code=404, content={"message": message})
+        return JSONResponse(status_code=400, content={"message": message})
+
+    if not filter_args:
+        disciplines_found = await disciplines.get_all(page_size, after, projection)
+        response.headers.update(
+            page_headers(disciplines_found, page_size, await disciplines.count({}))
+        )
+        return projected(
+            disciplines.Discipline, projection, disciplines_found, response, fast=FAST_JSON
+        )
+
+    if filter_args == {"course_code": course_code}:
+        discipline = await disciplines.get_by_cource_code(course_code, projection)
+        if discipline:
+            logger.info(f"Discipline {course_code}: {discipline}")
+            return projected(disciplines.Discipline, projection, [discipline], fast=FAST_JSON)
+        else:
+            message = "This discipline is not found"
+            logger.info(message)
+            return JSONResponse(status_code=404, content={"message": message})
+
+    disciplines_found = await disciplines.sort_many(filter_args, page_size, after, projection)
+    if disciplines_found or cursor is not None:
+        logger.info("Disciplines found")
+        response.headers.update(
+            page_headers(disciplines_found, page_size, await disciplines.count(filter_args))
+        )
+        return projected(
+            disciplines.Discipline, projection, disciplines_found, response, fast=FAST_JSON
+        )
+
+    message = "Disciplines are not found"
+    logger.info(message)
+    return JSONResponse(status_code=404, content={"message": message})
+
+
+@router.post(
+    "/disciplines/batch-get",
+    summary="Get disciplines by ids",
+    description=(
+        "Get disciplines by ObjectIds (ids) or by course_code (keys) with one query. "
+        "Documents are returned in the order of the request, null for the ones which aren't found"
+    ),
+    response_model=List[Optional[disciplines.Discipline]],
+    responses={400: {"model": Message}},
+)
+async def batch_get_disciplines(
+    body: BatchGet,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. course_code"
+    ),
+):
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    return await batch_get(
+        body,
+        "course_code",
+        disciplines.get_many,
+        disciplines.Discipline,
+        projection,
+        fast=FAST_JSON,
+    )
 
 
 @router.get(
@@ -42,7 +148,12 @@ async def get_disciplines(course_code: Optional[str] = None):
     response_model=disciplines.Discipline,
     responses={404: {"model": Message}, 400: {"model": Message}},
 )
-async def find_discipline(discipline_id: str):
+async def find_discipline(
+    discipline_id: str,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. ip,rtsp_main"
+    ),
+):
     # Check if ObjectId is in the right format
     id = check_ObjectId(discipline_id)
 
@@ -52,10 +163,17 @@ async def find_discipline(discipline_id: str):
         logger.info(message)
         return JSONResponse(status_code=404, content={"message": message})
 
-    discipline = await disciplines.get(id)
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    discipline = await disciplines.get(id, projection)
     if discipline:
         logger.info(f"Discipline {discipline_id}: {discipline}")
-        return discipline
+        return projected(disciplines.Discipline, projection, discipline, fast=FAST_JSON)
     else:
         message = "This discipline is not found"
         logger.info(message)
@@ -71,14 +189,14 @@ async def find_discipline(discipline_id: str):
     responses={409: {"model": Message}},
 )
 async def add_discipline(discipline: disciplines.Discipline, request: Request):
-    # Check if discipline with specified ObjectId is in the database
-    if await disciplines.get_by_cource_code(discipline.course_code):
+    # Discipline with the same code is rejected by the unique index
+    try:
+        return await disciplines.add(await request.json())
+    except DuplicateKeyError:
         message = f"Discipline with code: {discipline.course_code} already exists in the database"
         logger.info(message)
         return JSONResponse(status_code=409, content={"message": message})
 
-    return await disciplines.add(await request.json())
-
 
 @router.delete(
     "/disciplines/{discipline_id}",
@@ -95,11 +213,10 @@ async def delete_discipline(discipline_id: str):
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
-    if await disciplines.get(id):
-        await disciplines.remove(id)
+    if await disciplines.remove(id):
         message = f"Discipline: {discipline_id} deleted from the database"
         logger.info(message)
-        return {"message": "Room deleted successfully"}
+        return {"message": message}
     else:
         message = f"Discipline: {discipline_id} not found in the database"
         logger.info(message)
@@ -125,15 +242,10 @@ async def update_discipline(
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
-    if await disciplines.get(id):
-        await disciplines.remove(id)
-        await disciplines.add_empty(id)
-        await disciplines.patch_all(id, await request.json())
+    if await disciplines.put(id, await request.json()):
         message = f"Discipline: {discipline_id}  -  updated"
-        logger.info(
-            message
-        )  # Если ключа нет в обьекте, то будет добавлена новая пара ключ-значение к этому обьекту
-        return message
+        logger.info(message)
+        return {"message": message}
 
     else:
         message = f"Discipline: {discipline_id}  -  not found in the database"
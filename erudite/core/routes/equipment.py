@@ -1,25 +1,62 @@
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Query, Request, Response
 from fastapi.responses import JSONResponse
 from loguru import logger
+from pymongo.errors import DuplicateKeyError
 from typing import Optional, List
 
-from ..database.models import Message
-from ..database.utils import check_ObjectId, get_not_None_args
+from ..database.models import BatchGet, Message
+from ..database.filters import compile_filter
+from ..database.utils import (
+    check_ObjectId,
+    decode_id_cursor,
+    get_lookup,
+    get_not_None_args,
+    get_projection,
+    list_args,
+    page_headers,
+)
+from ..responses import (
+    NDJSON_MEDIA_TYPE,
+    accepts_ndjson,
+    batch_get,
+    fast_json,
+    ndjson_response,
+    projected,
+)
 from ..database import equipment
+from ..settings import settings
 
 router = APIRouter()
 
+FAST_JSON = fast_json("equipment")
+
 
 @router.get(
     "/equipment",
     summary="Get equipment",
     description=(
-        "Get a list of equipment in the database or an equipment by any of it's atributes, if provided"
+        "Get a page of equipment in the database or an equipment by any of it's atributes, "
+        "if provided. X-Total-Count header contains the number of found equipment, "
+        "X-Next-Cursor header contains a cursor for the next page. "
+        f"With stream=true or Accept: {NDJSON_MEDIA_TYPE} all found equipment are streamed"
     ),
     response_model=List[equipment.Equipment],
-    responses={404: {"model": Message}},
+    responses={400: {"model": Message}, 404: {"model": Message}},
 )
 async def list_equipments(
+    request: Request,
+    response: Response,
+    stream: bool = Query(
+        False, description=f"Stream all found documents as {NDJSON_MEDIA_TYPE}, without pages"
+    ),
+    page_size: int = Query(settings.page_size_default, ge=1, le=settings.page_size_max),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. ip,rtsp_main"
+    ),
+    expand: Optional[str] = Query(
+        None, description="Comma separated relations to embed, e.g. room"
+    ),
     name: Optional[str] = None,
     type: Optional[str] = None,
     room_name: Optional[str] = None,
@@ -28,38 +65,115 @@ async def list_equipments(
     port: Optional[int] = None,
     rtsp_main: Optional[str] = None,
 ):
-    if (
-        name is None
-        and type is None
-        and room_name is None
-        and room_id is None
-        and ip is None
-        and port is None
-        and rtsp_main is None
-    ):
-        return await equipment.get_all()
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    lookup = None
+    if expand is not None:
+        lookup = get_lookup(expand, equipment.relations)
+        if not lookup:
+            message = "Relations are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
 
     all_args = locals()
-    filter_args = get_not_None_args(all_args)
+    try:
+        filter_args = compile_filter(
+            request.query_params.multi_items(),
+            get_not_None_args(all_args, exclude=list_args),
+            all_args,
+            equipment.Equipment,
+            equipment.indexes,
+        )
+    except ValueError as error:
+        message = str(error)
+        logger.info(message)
+        return JSONResponse(status_code=400, content={"message": message})
+
+    if stream or accepts_ndjson(request):
+        logger.info(f"Equipment are streamed, filter: {filter_args}")
+        return ndjson_response(equipment.iter_many(filter_args, projection, lookup))
+
+    after = None
+    if cursor is not None:
+        after = decode_id_cursor(cursor)
+        if after is None:
+            message = "Cursor is written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    if not filter_args:
+        equipment_found = await equipment.get_all(page_size, after, projection, lookup)
+        response.headers.update(
+            page_headers(equipment_found, page_size, await equipment.count({}))
+        )
+        return projected(
+            equipment.Equipment, projection, equipment_found, response, fast=FAST_JSON
+        )
 
-    equipment_found = await equipment.sort_many(filter_args)
-    if equipment_found:
+    equipment_found = await equipment.sort_many(filter_args, page_size, after, projection, lookup)
+    if equipment_found or cursor is not None:
         logger.info("Equipment found")
-        return equipment_found
+        response.headers.update(
+            page_headers(equipment_found, page_size, await equipment.count(filter_args))
+        )
+        return projected(
+            equipment.Equipment, projection, equipment_found, response, fast=FAST_JSON
+        )
 
     message = "Equipment are not found"
     logger.info(message)
     return JSONResponse(status_code=404, content={"message": message})
 
 
+@router.post(
+    "/equipment/batch-get",
+    summary="Get equipment by ids",
+    description=(
+        "Get equipment by ObjectIds (ids) or by name (keys) with one query. "
+        "Documents are returned in the order of the request, null for the ones which aren't found"
+    ),
+    response_model=List[Optional[equipment.Equipment]],
+    responses={400: {"model": Message}},
+)
+async def batch_get_equipment(
+    body: BatchGet,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. ip,rtsp_main"
+    ),
+):
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    return await batch_get(
+        body,
+        "name",
+        equipment.get_many,
+        equipment.Equipment,
+        projection,
+        fast=FAST_JSON,
+    )
+
+
 @router.get(
     "/equipment/{equipment_id}",
     summary="Get equipment",
     description="Get an equipment specified by it's ObjectId",
     response_model=equipment.Equipment,
-    responses={404: {"model": Message}},
+    responses={400: {"model": Message}, 404: {"model": Message}},
 )
-async def find_equipment(equipment_id: str):
+async def find_equipment(
+    equipment_id: str,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. ip,rtsp_main"
+    ),
+):
     # Check if ObjectId is in the right format
     id = check_ObjectId(equipment_id)
 
@@ -69,11 +183,18 @@ async def find_equipment(equipment_id: str):
             content={"message": "ObjectId is written in the wrong format"},
         )
 
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
     # Check if equipment with specified ObjectId is in the database
-    equipment_obj = await equipment.get(id)
+    equipment_obj = await equipment.get(id, projection)
     if equipment_obj:
         logger.info(f"Equipment {equipment_id}: {equipment_obj}")
-        return equipment_obj
+        return projected(equipment.Equipment, projection, equipment_obj, fast=FAST_JSON)
     else:
         message = "This equipment is not found"
         logger.info(message)
@@ -90,13 +211,14 @@ async def find_equipment(equipment_id: str):
     responses={409: {"model": Message}},
 )
 async def create_equipment(val_equipment: equipment.Equipment, request: Request):
-    # Check if equipment with specified ObjectId is in the database
-    if await equipment.get_by_name(val_equipment.name):
+    # Equipment with the same name is rejected by the unique index
+    try:
+        new_equipment = await equipment.add(await request.json())
+    except DuplicateKeyError:
         message = f"Equipment with name: '{val_equipment.name}'  -  already exists in the database"
         logger.info(message)
         return JSONResponse(status_code=409, content={"message": message})
 
-    new_equipment = await equipment.add(await request.json())
     logger.info(f"Equipment: {val_equipment.name}  -  added to the database")
 
     return new_equipment
@@ -117,8 +239,7 @@ async def delete_equipment(equipment_id: str):
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
-    if await equipment.get(id):
-        await equipment.remove(id)
+    if await equipment.remove(id):
         message = f"Equipment: {equipment_id} deleted from the database"
         logger.info(message)
         return {"message": message}
@@ -143,8 +264,7 @@ async def patch_equipment(equipment_id: str, new_values: dict, request: Request)
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
-    if await equipment.get(id):
-        await equipment.patch(id, await request.json())
+    if await equipment.patch(id, await request.json()):
         message = f"Equipment {equipment_id} patched"
         logger.info(message)
         return {"message": message}
@@ -162,7 +282,7 @@ async def patch_equipment(equipment_id: str, new_values: dict, request: Request)
     responses={400: {"model": Message}, 404: {"model": Message}},
 )
 async def update_equipment(
-    equipment_id: str, equipment: equipment.Equipment, request: Request
+    equipment_id: str, val_equipment: equipment.Equipment, request: Request
 ):
     # Check if ObjectId is in the right format
     id = check_ObjectId(equipment_id)
@@ -171,10 +291,7 @@ async def update_equipment(
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
-    if await equipment.get(id):
-        await equipment.remove(id)
-        await equipment.add_empty(id)
-        await equipment.patch(id, await request.json())
+    if await equipment.put(id, await request.json()):
         message = f"Equipment {equipment_id} updated"
         logger.info(message)
         return {"message": message}
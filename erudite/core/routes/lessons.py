@@ -1,29 +1,69 @@
-from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from loguru import logger
+from pymongo.errors import DuplicateKeyError
 from typing import Optional, List
 from datetime import datetime
 
 from pydantic import EmailStr
 
-from ..database.models import Message
-from ..database.utils import check_ObjectId, get_not_None_args
+from ..database.models import BatchGet, BulkResult, Message
+from ..database.filters import compile_filter
+from ..database.utils import (
+    check_ObjectId,
+    decode_id_cursor,
+    get_lookup,
+    get_not_None_args,
+    get_projection,
+    list_args,
+    page_headers,
+)
+from ..responses import (
+    NDJSON_MEDIA_TYPE,
+    accepts_ndjson,
+    batch_get,
+    bulk_response,
+    bulk_write,
+    fast_json,
+    ndjson_response,
+    projected,
+)
 from ..database import lessons
+from ..settings import settings
 
 
 router = APIRouter()
 
+FAST_JSON = fast_json("lessons")
+
 
 @router.get(
     "/lessons",
     summary="Get all lessons or lesson by it's ruz id",
     description=(
-        "Get a list of all lessons in the database, or a lessons in specified room and datetime"
+        "Get a page of lessons in the database, or a lessons in specified room and datetime. "
+        "X-Total-Count header contains the number of found lessons, "
+        "X-Next-Cursor header contains a cursor for the next page. "
+        f"With stream=true or Accept: {NDJSON_MEDIA_TYPE} all found lessons are streamed"
     ),
     response_model=List[lessons.Lesson],
+    responses={400: {"model": Message}, 404: {"model": Message}},
 )
 async def get_lessons(
+    request: Request,
+    response: Response,
+    stream: bool = Query(
+        False, description=f"Stream all found documents as {NDJSON_MEDIA_TYPE}, without pages"
+    ),
+    page_size: int = Query(settings.page_size_default, ge=1, le=settings.page_size_max),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. date,start_time,ruz_url"
+    ),
+    expand: Optional[str] = Query(
+        None, description="Comma separated relations to embed, e.g. room,discipline"
+    ),
     ruz_auditorium: Optional[str] = None,
     ruz_auditorium_oid: Optional[int] = None,
     ruz_discipline: Optional[str] = None,
@@ -40,42 +80,131 @@ async def get_lessons(
     fromdate: Optional[datetime] = None,
     todate: Optional[datetime] = None,
 ):
-    if all(
-        p is None
-        for p in [
-            ruz_auditorium,
-            ruz_auditorium_oid,
-            ruz_discipline,
-            ruz_discipline_oid,
-            ruz_kind_of_work,
-            ruz_kind_of_work_oid,
-            ruz_lecturer_title,
-            ruz_lesson_oid,
-            ruz_url,
-            course_code,
-            gcalendar_event_id,
-            gcalendar_calendar_id,
-            ruz_lecturer_email,
-            fromdate,
-            todate,
-        ]
-    ):
-        logger.info("All lessons returned")
-        return await lessons.get_all()
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    lookup = None
+    if expand is not None:
+        lookup = get_lookup(expand, lessons.relations)
+        if not lookup:
+            message = "Relations are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
 
     all_args = locals()
-    filter_args = get_not_None_args(all_args)
+    try:
+        filter_args = compile_filter(
+            request.query_params.multi_items(),
+            get_not_None_args(all_args, exclude=list_args),
+            all_args,
+            lessons.Lesson,
+            lessons.indexes,
+            lessons.unindexed_filter_fields,
+        )
+    except ValueError as error:
+        message = str(error)
+        logger.info(message)
+        return JSONResponse(status_code=400, content={"message": message})
 
-    lessons_found = await lessons.sort_many(filter_args)
-    if lessons_found:
+    if stream or accepts_ndjson(request):
+        logger.info(f"Lessons are streamed, filter: {filter_args}")
+        return ndjson_response(lessons.iter_many(filter_args, projection, lookup))
+
+    after = None
+    if cursor is not None:
+        after = decode_id_cursor(cursor)
+        if after is None:
+            message = "Cursor is written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    if not filter_args:
+        logger.info("All lessons returned")
+        lessons_found = await lessons.get_all(page_size, after, projection, lookup)
+        response.headers.update(
+            page_headers(lessons_found, page_size, await lessons.count({}))
+        )
+        return projected(
+            lessons.Lesson, projection, lessons_found, response, fast=FAST_JSON
+        )
+
+    lessons_found = await lessons.sort_many(filter_args, page_size, after, projection, lookup)
+    if lessons_found or cursor is not None:
         logger.info("Lessons found")
-        return lessons_found
+        response.headers.update(
+            page_headers(lessons_found, page_size, await lessons.count(filter_args))
+        )
+        return projected(
+            lessons.Lesson, projection, lessons_found, response, fast=FAST_JSON
+        )
 
     message = "Lessons are not found"
     logger.info(message)
     return JSONResponse(status_code=404, content={"message": message})
 
 
+@router.get(
+    "/lessons/conflicts",
+    summary="Get conflicting lessons",
+    description=(
+        "Stream pairs of lessons in the same room which overlap in time, for lessons "
+        f"which start in the range, as {NDJSON_MEDIA_TYPE}. "
+        "Times are local, as date and start_time of lessons"
+    ),
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {NDJSON_MEDIA_TYPE: {}}},
+        400: {"model": Message},
+    },
+)
+async def get_lesson_conflicts(
+    from_: datetime = Query(..., alias="from", description="Start of the range"),
+    to: datetime = Query(..., description="End of the range"),
+):
+    start, end = from_.replace(tzinfo=None), to.replace(tzinfo=None)
+    if end <= start:
+        message = "End of the range should be after its start"
+        return JSONResponse(status_code=400, content={"message": message})
+
+    logger.info(f"Conflicts of lessons from {start} to {end} are streamed")
+    return ndjson_response(lessons.conflicts(start, end))
+
+
+@router.post(
+    "/lessons/batch-get",
+    summary="Get lessons by ids",
+    description=(
+        "Get lessons by ObjectIds (ids) or by ruz_lesson_oid (keys) with one query. "
+        "Documents are returned in the order of the request, null for the ones which aren't found"
+    ),
+    response_model=List[Optional[lessons.Lesson]],
+    responses={400: {"model": Message}},
+)
+async def batch_get_lessons(
+    body: BatchGet,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. date,start_time,ruz_url"
+    ),
+):
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    return await batch_get(
+        body,
+        "ruz_lesson_oid",
+        lessons.get_many,
+        lessons.Lesson,
+        projection,
+        fast=FAST_JSON,
+    )
+
+
 @router.get(
     "/lessons/{lesson_id}",
     summary="Get a lesson",
@@ -83,18 +212,30 @@ async def get_lessons(
     response_model=lessons.Lesson,
     responses={400: {"model": Message}, 404: {"model": Message}},
 )
-async def get_lesson_by_id(lesson_id: str):
+async def get_lesson_by_id(
+    lesson_id: str,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. date,start_time,ruz_url"
+    ),
+):
     # Check if ObjectId is in the right format
     id = check_ObjectId(lesson_id)
     if not id:
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
     # Check if lesson with specified ObjectId is in the database
-    lesson = await lessons.get_by_id(id)
+    lesson = await lessons.get_by_id(id, projection)
     if lesson:
         logger.info(f"Lesson {lesson_id}: {lesson}")
-        return lesson
+        return projected(lessons.Lesson, projection, lesson, fast=FAST_JSON)
     else:
         message = "This lesson is not found"
         logger.info(message)
@@ -109,13 +250,68 @@ async def get_lesson_by_id(lesson_id: str):
     response_model=lessons.Lesson,
     responses={409: {"model": Message}},
 )
-async def add_lesson(lesson: lessons.Lesson, request: Request):
-    if await lessons.get_by_ruz_id(lesson.ruz_lesson_oid):
+async def add_lesson(lesson: lessons.Lesson):
+    # Written as the model parsed it, so the content hash is the same as of bulk upserts.
+    # Lesson with the same ruz id is rejected by the unique index
+    try:
+        return await lessons.add(lesson.dict(exclude_unset=True))
+    except DuplicateKeyError:
         message = f"Lesson with ruz id: {lesson.ruz_lesson_oid}  -  already exists in the database"
         logger.info(message)
         return JSONResponse(status_code=409, content={"message": message})
 
-    return await lessons.add(await request.json())
+
+@router.post(
+    "/lessons/bulk",
+    summary="Create or update lessons",
+    description=(
+        "Create or update lessons by ruz_lesson_oid. Body is a JSON array of lessons, "
+        f"or one lesson per line with Content-Type: {NDJSON_MEDIA_TYPE}. "
+        "Result of every item is returned in the request order"
+    ),
+    response_model=BulkResult,
+    responses={400: {"model": Message}},
+)
+async def bulk_upsert_lessons(request: Request):
+    try:
+        items = await bulk_write(request, lessons.Lesson, lessons.upsert_many)
+    except ValueError as error:
+        message = str(error)
+        logger.info(message)
+        return JSONResponse(status_code=400, content={"message": message})
+
+    response = bulk_response(items)
+    logger.info(f"Lessons bulk upsert: {len(items)} items")
+    return response
+
+
+@router.post(
+    "/lessons/reconcile",
+    summary="Reconcile lessons with RUZ schedule",
+    description=(
+        "Make lessons of the building in the date range equal to the schedule: "
+        "new lessons are created, lessons with changed content are updated and lessons "
+        "missing in the schedule are deleted, other lessons are not written at all. "
+        "With dry_run=true changes are only returned"
+    ),
+    response_model=lessons.ReconcileResult,
+)
+async def reconcile_lessons(
+    schedule: lessons.Schedule,
+    dry_run: bool = Query(False, description="Return changes without applying them"),
+):
+    result = await lessons.reconcile(
+        schedule.fromdate,
+        schedule.todate,
+        schedule.ruz_building_oid,
+        [lesson.dict(exclude_unset=True) for lesson in schedule.lessons],
+        dry_run,
+    )
+    logger.info(
+        f"Lessons of building {schedule.ruz_building_oid} from {schedule.fromdate} "
+        f"to {schedule.todate} are reconciled, dry run: {dry_run}"
+    )
+    return result
 
 
 @router.delete(
@@ -133,13 +329,8 @@ async def delete_lesson(lesson_id: str):
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
-    # Check if lesson with specified ObjectId is in the database
-    if await lessons.get_by_id(id):
-        res = await lessons.remove(id)
-        if res.deleted_count == 0:
-            message = "Something went wrong..."
-            logger.info(message)
-            return {"message": message}
+    # Lesson which is not in the database isn't deleted
+    if await lessons.remove(id):
         message = f"Lesson: {lesson_id}  -  deleted from the database"
         logger.info(message)
         return {"message": message}
@@ -156,10 +347,10 @@ async def delete_lesson(lesson_id: str):
     response_model=lessons.Lesson,
     responses={400: {"model": Message}, 404: {"model": Message}},
 )
-async def update_lesson(lesson_id: str, lesson: lessons.Lesson, request: Request):
+async def update_lesson(lesson_id: str, lesson: lessons.Lesson):
     # Check if ObjectId is in the right format
     id = check_ObjectId(lesson_id)
-    new_values = await request.json()
+    new_values = lesson.dict(exclude_unset=True)
 
     if not id:
         message = "ObjectId is written in the wrong format"
@@ -169,14 +360,11 @@ async def update_lesson(lesson_id: str, lesson: lessons.Lesson, request: Request
         message = "Please fill the request body"
         return JSONResponse(status_code=400, content={"message": message})
 
-    if await lessons.get_by_id(id):
-        await lessons.remove(id)
-        await lessons.add_empty(id)
-        await lessons.put(id, new_values)
+    # Lesson which is not in the database isn't replaced
+    if await lessons.put(id, new_values):
         message = f"Lesson: {lesson_id} updated"
         logger.info(message)
-        return await request.json()
-    # Check if lesson with specified ObjectId is in the database
+        return new_values
     else:
         message = f"Lesson: {lesson_id}  -  not found in the database"
         logger.info(message)
@@ -1,61 +1,174 @@
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Query, Request, Response
 from fastapi.responses import JSONResponse
 
 from loguru import logger
+from pymongo.errors import DuplicateKeyError
 from typing import Optional, List
 from datetime import datetime
 
-from ..database.models import Message
-from ..database.utils import check_ObjectId, get_not_None_args
+from ..database.models import BatchGet, BulkResult, Message
+from ..database.filters import compile_filter
+from ..database.utils import (
+    check_ObjectId,
+    datetime_fields,
+    decode_cursor,
+    get_not_None_args,
+    get_projection,
+)
+from ..responses import (
+    NDJSON_MEDIA_TYPE,
+    batch_get,
+    bulk_response,
+    bulk_write,
+    fast_json,
+    projected,
+)
 from ..database import records
+from ..settings import settings
 
 
 router = APIRouter()
 
+FAST_JSON = fast_json("records")
+
 
 @router.get(
     "/records",
     summary="Get all records or filtered by query args",
+    description=(
+        "Get a page of records, newest first. If there are more records, "
+        "X-Next-Cursor header contains a cursor for the next page"
+    ),
     response_model=List[records.Record],
-    responses={404: {"model": Message}},
+    responses={400: {"model": Message}, 404: {"model": Message}},
 )
 async def get_records(
+    request: Request,
+    response: Response,
     fromdate: Optional[datetime] = None,
     todate: Optional[datetime] = None,
     room_name: Optional[str] = None,
     url: Optional[str] = None,
     page_number: int = 0,
+    page_size: int = Query(50, ge=1, le=settings.page_size_max),
+    cursor: Optional[str] = Query(
+        None, description="X-Next-Cursor of the previous page, page_number is ignored if set"
+    ),
     with_keywords_only: bool = False,
     ignore_autorec: bool = False,
     camera_ip: Optional[str] = None,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. url,room_name"
+    ),
 ):
-    if all(p is None for p in [fromdate, todate, room_name, url, camera_ip]):
-        return await records.get_all(
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    after = None
+    if cursor is not None:
+        after = decode_cursor(cursor, 2)
+        after = records.after_cursor(after) if after else None
+        if after is None:
+            message = "Cursor is written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    all_args = locals()
+    try:
+        filter_args = compile_filter(
+            request.query_params.multi_items(),
+            get_not_None_args(
+                {
+                    "fromdate": fromdate,
+                    "todate": todate,
+                    "room_name": room_name,
+                    "url": url,
+                    "camera_ip": camera_ip,
+                }
+            ),
+            all_args,
+            records.Record,
+            records.indexes,
+        )
+    except ValueError as error:
+        message = str(error)
+        logger.info(message)
+        return JSONResponse(status_code=400, content={"message": message})
+
+    if not filter_args:
+        records_found = await records.get_all(
             page_number,
+            page_size,
             with_keywords_only=with_keywords_only,
             ignore_autorec=ignore_autorec,
+            after=after,
+            projection=projection,
+        )
+        next_cursor = records.next_cursor(records_found, page_size)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return projected(
+            records.Record, projection, records_found, response, fast=FAST_JSON
         )
-
-    all_args = locals()
-    filter_args = get_not_None_args(all_args)
-    filter_args.pop("page_number")
-    filter_args.pop("with_keywords_only")
-    filter_args.pop("ignore_autorec")
 
     records_found = await records.sort_many(
         filter_args,
         page_number,
+        page_size,
         with_keywords_only=with_keywords_only,
         ignore_autorec=ignore_autorec,
+        after=after,
+        projection=projection,
     )
-    if records_found:
-        return records_found
+    if records_found or cursor is not None:
+        next_cursor = records.next_cursor(records_found, page_size)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return projected(
+            records.Record, projection, records_found, response, fast=FAST_JSON
+        )
 
     message = "Records not found"
     logger.info(message)
     return JSONResponse(status_code=404, content={"message": message})
 
 
+@router.post(
+    "/records/batch-get",
+    summary="Get records by ids",
+    description=(
+        "Get records by ObjectIds (ids) or by url (keys) with one query. "
+        "Documents are returned in the order of the request, null for the ones which aren't found"
+    ),
+    response_model=List[Optional[records.Record]],
+    responses={400: {"model": Message}},
+)
+async def batch_get_records(
+    body: BatchGet,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. url,room_name"
+    ),
+):
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    return await batch_get(
+        body,
+        "url",
+        records.get_many,
+        records.Record,
+        projection,
+        fast=FAST_JSON,
+    )
+
+
 @router.get(
     "/records/{record_id}",
     summary="Get a record",
@@ -63,18 +176,30 @@ async def get_records(
     response_model=records.Record,
     responses={400: {"model": Message}, 404: {"model": Message}},
 )
-async def get_record_by_id(record_id: str):
+async def get_record_by_id(
+    record_id: str,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. url,room_name"
+    ),
+):
     # Check if ObjectId is in the right format
     id = check_ObjectId(record_id)
     if not id:
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
     # Check if record with specified ObjectId is in the database
-    record = await records.get_by_id(id)
+    record = await records.get_by_id(id, projection)
     if record:
         logger.info(f"Record {record_id}: {record}")
-        return record
+        return projected(records.Record, projection, record, fast=FAST_JSON)
     else:
         message = "This record is not found"
         logger.info(message)
@@ -87,36 +212,58 @@ async def get_record_by_id(record_id: str):
     summary="Create record",
     description="Create record",
     response_model=records.Record,
-    responses={409: {"model": Message}},
+    responses={400: {"model": Message}, 409: {"model": Message}},
 )
 async def add_record(record: records.Record, request: Request):
-    if await records.get_by_url(record.url) and record.url is not None and record.url != "":
-        message = f"Record with url: {record.url}  -  already exists in the database"
-        logger.info(message)
-        return JSONResponse(status_code=409, content={"message": message})
-
     if record.type == "Autorecord":
-        str_from_date = f"{record.date} {record.start_time[:5]}"
-        str_to_date = f"{record.date} {record.end_time[:5]}"
+        capture = record.dict()
+        interval = datetime_fields(capture)
+        if not interval:
+            message = "Date or time is written in the wrong format"
+            logger.info(message)
+            return JSONResponse(status_code=400, content={"message": message})
 
-        from_date = datetime.strptime(str_from_date, "%Y-%m-%d %H:%M")
-        to_date = datetime.strptime(str_to_date, "%Y-%m-%d %H:%M")
+        if await records.is_captured({**capture, **interval}):
+            message = (
+                "Record that was done in the same room, by the same camera, "
+                "at the same time already exists in the database"
+            )
+            logger.info(message)
+            return JSONResponse(status_code=409, content={"message": message})
 
-        filter_args = {
-            "room_name": record.room_name,
-            "fromdate": from_date,
-            "todate": to_date,
-            "camera_ip": record.camera_ip,
-        }
+    # Record with the same non-empty url is rejected by the unique index
+    try:
+        return await records.add(await request.json())
+    except DuplicateKeyError:
+        message = f"Record with url: {record.url}  -  already exists in the database"
+        logger.info(message)
+        return JSONResponse(status_code=409, content={"message": message})
 
-        records_found = await records.sort_many(filter_args, page_number=0)
 
-        if records_found:
-            message = "Record that was done in the same room, by the same camera, at the same time already exists in the database"
-            logger.info(message)
-            return JSONResponse(status_code=409, content={"message": message})
+@router.post(
+    "/records/bulk",
+    summary="Create records",
+    description=(
+        "Create records, e.g. uploaded by a recorder after an outage. Body is a JSON array "
+        f"of records, or one record per line with Content-Type: {NDJSON_MEDIA_TYPE}. "
+        "Records with an existing url and Autorecords which overlap in time with another "
+        "record of the same room and camera are failed. "
+        "Result of every item is returned in the request order"
+    ),
+    response_model=BulkResult,
+    responses={400: {"model": Message}},
+)
+async def bulk_add_records(request: Request):
+    try:
+        items = await bulk_write(request, records.Record, records.add_many)
+    except ValueError as error:
+        message = str(error)
+        logger.info(message)
+        return JSONResponse(status_code=400, content={"message": message})
 
-    return await records.add(await request.json())
+    response = bulk_response(items)
+    logger.info(f"Records bulk add: {len(items)} items")
+    return response
 
 
 @router.delete(
@@ -134,9 +281,8 @@ async def delete_record(record_id: str):
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
-    # Check if Record with specified ObjectId is in the database
-    if await records.get_by_id(id):
-        await records.remove(id)
+    # Record which is not in the database isn't deleted
+    if await records.remove(id):
         message = f"Record: {record_id}  -  deleted from the database"
         logger.info(message)
         return {"message": message}
@@ -151,7 +297,7 @@ async def delete_record(record_id: str):
     summary="Patch record",
     description="Updates additional attributes of record specified by it's ObjectId",
     response_model=Message,
-    responses={400: {"model": Message}, 404: {"model": Message}},
+    responses={400: {"model": Message}, 404: {"model": Message}, 409: {"model": Message}},
 )
 async def update_record(record_id: str, new_values: dict, request: Request):
     # Check if ObjectId is in the right format
@@ -166,12 +312,18 @@ async def update_record(record_id: str, new_values: dict, request: Request):
         message = "Please fill the request body"
         return JSONResponse(status_code=400, content={"message": message})
 
-    if await records.get_by_id(id):
-        await records.patch(id, new_values)
+    # Record which is not in the database isn't patched
+    try:
+        patched = await records.patch(id, new_values)
+    except records.PatchConflict:
+        message = f"Record: {record_id}  -  is changed concurrently, try again"
+        logger.info(message)
+        return JSONResponse(status_code=409, content={"message": message})
+
+    if patched:
         message = f"Record: {record_id} patched"
         logger.info(message)
         return JSONResponse(status_code=200, content={"message": message})
-    # Check if Record with specified ObjectId is in the database
     else:
         message = f"Record: {record_id}  -  not found in the database"
         logger.info(message)
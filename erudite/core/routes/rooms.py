@@ -1,29 +1,68 @@
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Query, Request, Response
 from fastapi.responses import JSONResponse
 
 from loguru import logger
+from pymongo.errors import DuplicateKeyError
 from typing import Optional, List
+from datetime import datetime
 
 from ..database.models import (
+    BatchGet,
     Message,
 )
-from ..database import rooms, equipment
-from ..database.utils import check_ObjectId, get_not_None_args
+from ..database import rooms, equipment, lessons
+from ..database.filters import compile_filter
+from ..database.utils import (
+    check_ObjectId,
+    decode_id_cursor,
+    get_lookup,
+    get_not_None_args,
+    get_projection,
+    list_args,
+    page_headers,
+)
+from ..responses import (
+    NDJSON_MEDIA_TYPE,
+    accepts_ndjson,
+    batch_get,
+    fast_json,
+    ndjson_response,
+    projected,
+)
+from ..settings import settings
 
 
 router = APIRouter()
 
+FAST_JSON = fast_json("rooms")
+
 
 @router.get(
     "/rooms",
     summary="Get all rooms",
     description=(
-        "Get a list of all rooms in the database or a room by any of it's atributes, if provided"
+        "Get a page of rooms in the database or a room by any of it's atributes, if provided. "
+        "X-Total-Count header contains the number of found rooms, "
+        "X-Next-Cursor header contains a cursor for the next page. "
+        f"With stream=true or Accept: {NDJSON_MEDIA_TYPE} all found rooms are streamed"
     ),
     response_model=List[rooms.Room],
-    responses={404: {"model": Message}},
+    responses={400: {"model": Message}, 404: {"model": Message}},
 )
 async def list_rooms(
+    request: Request,
+    response: Response,
+    stream: bool = Query(
+        False, description=f"Stream all found documents as {NDJSON_MEDIA_TYPE}, without pages"
+    ),
+    page_size: int = Query(settings.page_size_default, ge=1, le=settings.page_size_max),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. ip,rtsp_main"
+    ),
+    expand: Optional[str] = Query(
+        None, description="Comma separated relations to embed, e.g. equipment"
+    ),
     ruz_type_of_auditorium_oid: Optional[int] = None,
     ruz_amount: Optional[int] = None,
     ruz_auditorium_oid: Optional[int] = None,
@@ -32,33 +71,132 @@ async def list_rooms(
     ruz_number: Optional[str] = None,
     ruz_type_of_auditorium: Optional[str] = None,
 ):
-    if all(
-        p is None
-        for p in [
-            ruz_auditorium_oid,
-            ruz_amount,
-            ruz_building,
-            ruz_building_gid,
-            ruz_number,
-            ruz_type_of_auditorium,
-        ]
-    ):
-        logger.info("All rooms returned")
-        return await rooms.get_all()
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    lookup = None
+    if expand is not None:
+        lookup = get_lookup(expand, rooms.relations)
+        if not lookup:
+            message = "Relations are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
 
     all_args = locals()
-    filter_args = get_not_None_args(all_args)
+    try:
+        filter_args = compile_filter(
+            request.query_params.multi_items(),
+            get_not_None_args(all_args, exclude=list_args),
+            all_args,
+            rooms.Room,
+            rooms.indexes,
+        )
+    except ValueError as error:
+        message = str(error)
+        logger.info(message)
+        return JSONResponse(status_code=400, content={"message": message})
+
+    if stream or accepts_ndjson(request):
+        logger.info(f"Rooms are streamed, filter: {filter_args}")
+        return ndjson_response(rooms.iter_many(filter_args, projection, lookup))
+
+    after = None
+    if cursor is not None:
+        after = decode_id_cursor(cursor)
+        if after is None:
+            message = "Cursor is written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
 
-    room_found = await rooms.sort_many(filter_args)
-    if room_found:
+    if not filter_args:
+        logger.info("All rooms returned")
+        room_found = await rooms.get_all(page_size, after, projection, lookup)
+        response.headers.update(page_headers(room_found, page_size, await rooms.count({})))
+        return projected(rooms.Room, projection, room_found, response, fast=FAST_JSON)
+
+    room_found = await rooms.sort_many(filter_args, page_size, after, projection, lookup)
+    if room_found or cursor is not None:
         logger.info("Room found")
-        return room_found
+        response.headers.update(
+            page_headers(room_found, page_size, await rooms.count(filter_args))
+        )
+        return projected(rooms.Room, projection, room_found, response, fast=FAST_JSON)
 
     message = "Rooms are not found"
     logger.info(message)
     return JSONResponse(status_code=404, content={"message": message})
 
 
+@router.get(
+    "/rooms/free",
+    summary="Get free rooms",
+    description=(
+        "Get rooms which have no lessons in the time range, optionally in the building "
+        "and with at least min_capacity places. Times are local, as date and start_time of lessons"
+    ),
+    response_model=List[rooms.Room],
+    responses={400: {"model": Message}},
+)
+async def get_free_rooms(
+    from_: datetime = Query(..., alias="from", description="Start of the range"),
+    to: datetime = Query(..., description="End of the range"),
+    building_gid: Optional[int] = Query(None, description="ruz_building_gid of the rooms"),
+    min_capacity: int = Query(0, ge=0, description="Minimal ruz_amount of the rooms"),
+):
+    start, end = from_.replace(tzinfo=None), to.replace(tzinfo=None)
+    if end <= start:
+        message = "End of the range should be after its start"
+        return JSONResponse(status_code=400, content={"message": message})
+
+    filter_args = {"ruz_amount": {"$gte": min_capacity}}
+    if building_gid is not None:
+        filter_args["ruz_building_gid"] = building_gid
+    rooms_found = [room async for room in rooms.iter_many(filter_args)]
+
+    busy = await lessons.busy_rooms(
+        start, end, {room["ruz_auditorium_oid"] for room in rooms_found}
+    )
+    free = [room for room in rooms_found if room["ruz_auditorium_oid"] not in busy]
+
+    logger.info(f"{len(free)} of {len(rooms_found)} rooms are free from {start} to {end}")
+    return projected(rooms.Room, None, free, fast=FAST_JSON)
+
+
+@router.post(
+    "/rooms/batch-get",
+    summary="Get rooms by ids",
+    description=(
+        "Get rooms by ObjectIds (ids) or by ruz_auditorium_oid (keys) with one query. "
+        "Documents are returned in the order of the request, null for the ones which aren't found"
+    ),
+    response_model=List[Optional[rooms.Room]],
+    responses={400: {"model": Message}},
+)
+async def batch_get_rooms(
+    body: BatchGet,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. ruz_number,ruz_building"
+    ),
+):
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    return await batch_get(
+        body,
+        "ruz_auditorium_oid",
+        rooms.get_many,
+        rooms.Room,
+        projection,
+        fast=FAST_JSON,
+    )
+
+
 @router.get(
     "/rooms/{room_id}",
     summary="Get a room",
@@ -66,7 +204,12 @@ async def list_rooms(
     response_model=rooms.Room,
     responses={400: {"model": Message}, 404: {"model": Message}},
 )
-async def find_room(room_id: str):
+async def find_room(
+    room_id: str,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. ip,rtsp_main"
+    ),
+):
     # Check if ObjectId is in the right format
     id = check_ObjectId(room_id)
 
@@ -74,11 +217,18 @@ async def find_room(room_id: str):
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
     # Check if room with specified ObjectId is in the database
-    room = await rooms.get(id)
+    room = await rooms.get(id, projection)
     if room:
         logger.info(f"Room {room_id}: {room}")
-        return room
+        return projected(rooms.Room, projection, room, fast=FAST_JSON)
 
     message = "This room is not found"
     logger.info(message)
@@ -91,15 +241,17 @@ async def find_room(room_id: str):
     description="Create a room specified by it's ObjectId",
     response_model=rooms.Room,
     status_code=201,
+    responses={409: {"model": Message}},
 )
 async def create_room(room: rooms.Room, request: Request):
-    # Check if room with specified ObjectId is in the database
-    if await rooms.get_by_ruz_id(room.ruz_auditorium_oid):
+    # Room with the same ruz id is rejected by the unique index
+    try:
+        new_room = await rooms.add(await request.json())
+    except DuplicateKeyError:
         message = f"Room with ruz_id: '{room.ruz_auditorium_oid}' already exists in the database"
         logger.info(message)
         return JSONResponse(status_code=409, content={"message": message})
 
-    new_room = await rooms.add(await request.json())
     logger.info(
         f"Room with ruz_id: {room.ruz_auditorium_oid}  -  added to the database"
     )
@@ -121,9 +273,8 @@ async def delete_room(room_id: str):
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
-    # Check if room with specified ObjectId is in the database
-    if await rooms.get(id):
-        await rooms.remove(id)
+    # Room which is not in the database isn't deleted
+    if await rooms.remove(id):
         message = f"Room: {room_id}  -  deleted from the database"
         logger.info(message)
         return {"message": message}
@@ -153,8 +304,7 @@ async def patch_room(room_id: str, new_values: dict, request: Request):
         message = "Please fill the request body"
         return JSONResponse(status_code=400, content={"message": message})
 
-    if await rooms.get(id):
-        await rooms.patch(id, new_values)
+    if await rooms.patch(id, new_values):
         message = f"Room: {room_id} patched"
         logger.info(message)
         return {"message": message}
@@ -184,14 +334,11 @@ async def update_room(room_id: str, room: rooms.Room, request: Request):
         message = "Please fill the request body"
         return JSONResponse(status_code=400, content={"message": message})
 
-    if await rooms.get(id):
-        await rooms.remove(id)
-        await rooms.add_empty(id)
-        await rooms.put(id, new_values)
+    # Room which is not in the database isn't replaced
+    if await rooms.put(id, new_values):
         message = f"Room: {room_id} updated"
         logger.info(message)
         return {"message": message}
-    # Check if room with specified ObjectId is in the database
     else:
         message = f"Room: {room_id}  -  not found in the database"
         logger.info(message)
@@ -205,7 +352,12 @@ async def update_room(room_id: str, room: rooms.Room, request: Request):
     response_model=List[equipment.Equipment],
     responses={400: {"model": Message}, 404: {"model": Message}},
 )
-async def list_room_equipments(room_id: str):
+async def list_room_equipments(
+    room_id: str,
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. ip,rtsp_main"
+    ),
+):
     # Check if ObjectId is in the right format
     id = check_ObjectId(room_id)
 
@@ -213,11 +365,18 @@ async def list_room_equipments(room_id: str):
         message = "ObjectId is written in the wrong format"
         return JSONResponse(status_code=400, content={"message": message})
 
-    room = await rooms.get(id)
+    projection = None
+    if fields is not None:
+        projection = get_projection(fields)
+        if not projection:
+            message = "Fields are written in the wrong format"
+            return JSONResponse(status_code=400, content={"message": message})
+
+    room = await rooms.get(id, {"_id": 1})
     if room:
-        data = await equipment.sort(id)
+        data = await equipment.sort(id, projection)
         logger.info(data)
-        return data
+        return projected(equipment.Equipment, projection, data, fast=FAST_JSON)
     # Check if equipment with specified room_id is in the database
     else:
         message = "This room is not found"
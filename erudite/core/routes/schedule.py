@@ -0,0 +1,85 @@
+from fastapi import APIRouter, Query
+from fastapi.responses import JSONResponse
+
+from loguru import logger
+from typing import List, Optional
+from datetime import datetime
+
+from ..database.models import Message
+from ..responses import fast_json, projected
+from ..database import lessons, schedule
+
+
+router = APIRouter()
+
+FAST_JSON = fast_json("schedule")
+
+
+def check_index(start: datetime, end: datetime) -> Optional[JSONResponse]:
+    """ Error response if the schedule index can't answer for [start, end] """
+
+    if not schedule.index.enabled:
+        message = "Schedule index is not built yet"
+        logger.info(message)
+        return JSONResponse(status_code=503, content={"message": message})
+
+    if not schedule.index.covers(start, end):
+        message = (
+            f"Schedule index has lessons from {schedule.index.start} to {schedule.index.end}, "
+            "use /lessons for other dates"
+        )
+        logger.info(message)
+        return JSONResponse(status_code=400, content={"message": message})
+
+
+@router.get(
+    "/schedule/now",
+    summary="Get current and next lessons of rooms",
+    description=(
+        "Get lessons which are going on at the moment and the next lesson of every room "
+        "which has lessons in the schedule index, or of the specified rooms. "
+        "Times are local, as date and start_time of lessons"
+    ),
+    response_model=List[lessons.RoomSchedule],
+    responses={400: {"model": Message}, 503: {"model": Message}},
+)
+async def get_schedule_now(
+    at: Optional[datetime] = Query(None, description="Moment to look at, now by default"),
+    ruz_auditorium_oid: Optional[List[int]] = Query(None, description="Rooms to look at"),
+):
+    moment = at.replace(tzinfo=None) if at is not None else schedule.local_now()
+
+    error = check_index(moment, moment)
+    if error is not None:
+        return error
+
+    rooms = schedule.index.at(moment, ruz_auditorium_oid)
+    return projected(lessons.RoomSchedule, None, rooms, fast=FAST_JSON)
+
+
+@router.get(
+    "/schedule",
+    summary="Get lessons in the time range",
+    description=(
+        "Get lessons which overlap the time range, sorted by room and start, "
+        "from the schedule index of the days around today"
+    ),
+    response_model=List[lessons.Lesson],
+    responses={400: {"model": Message}, 503: {"model": Message}},
+)
+async def get_schedule(
+    from_: datetime = Query(..., alias="from", description="Start of the range"),
+    to: datetime = Query(..., description="End of the range"),
+    ruz_auditorium_oid: Optional[List[int]] = Query(None, description="Rooms to look at"),
+):
+    start, end = from_.replace(tzinfo=None), to.replace(tzinfo=None)
+    if end < start:
+        message = "End of the range is before its start"
+        return JSONResponse(status_code=400, content={"message": message})
+
+    error = check_index(start, end)
+    if error is not None:
+        return error
+
+    lessons_found = schedule.index.between(start, end, ruz_auditorium_oid)
+    return projected(lessons.Lesson, None, lessons_found, fast=FAST_JSON)
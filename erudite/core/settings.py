@@ -27,6 +27,70 @@ class Settings(BaseSettings):
     mongo_url: str = Field(..., env="MONGO_DB_URL")
     mongo_db_name: str = Field(..., env="MONGO_DB_NAME")
 
+    mongo_max_pool_size: int = Field(env="MONGO_MAX_POOL_SIZE", default=100)
+    mongo_min_pool_size: int = Field(env="MONGO_MIN_POOL_SIZE", default=0)
+    # How long a query waits for a free connection of the pool, 0 means without limit
+    mongo_wait_queue_timeout_ms: int = Field(env="MONGO_WAIT_QUEUE_TIMEOUT_MS", default=0)
+    # Comma separated, e.g. zstd,snappy, they need the zstandard and python-snappy packages
+    mongo_compressors: str = Field(env="MONGO_COMPRESSORS", default="")
+    # Read preference of GET requests, other requests and GETs with ETags read from the primary
+    mongo_read_preference: typing.Literal[
+        "primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest"
+    ] = Field(env="MONGO_READ_PREFERENCE", default="secondaryPreferred")
+    # local, available, majority or linearizable, empty means the default of the server
+    mongo_read_concern: str = Field(env="MONGO_READ_CONCERN", default="")
+
+    psql_pool_min_size: int = Field(env="PSQL_POOL_MIN_SIZE", default=1)
+    psql_pool_max_size: int = Field(env="PSQL_POOL_MAX_SIZE", default=10)
+
+    api_key_cache_size: int = Field(env="API_KEY_CACHE_SIZE", default=1024)
+    api_key_cache_ttl: float = Field(env="API_KEY_CACHE_TTL", default=300)
+    api_key_negative_cache_ttl: float = Field(env="API_KEY_NEGATIVE_CACHE_TTL", default=30)
+
+    page_size_default: int = Field(env="PAGE_SIZE_DEFAULT", default=100)
+    page_size_max: int = Field(env="PAGE_SIZE_MAX", default=1000)
+    stream_batch_size: int = Field(env="STREAM_BATCH_SIZE", default=1000)
+    bulk_batch_size: int = Field(env="BULK_BATCH_SIZE", default=1000)
+
+    migration_batch_size: int = Field(env="MIGRATION_BATCH_SIZE", default=500)
+    # Documents per second, so that migrations don't slow down live queries, 0 means no limit
+    migration_rate_limit: float = Field(env="MIGRATION_RATE_LIMIT", default=2000)
+
+    # Lessons from schedule_days_before days ago to schedule_days_after days ahead are kept in
+    # memory of every worker, writes of other workers are seen after the refresh interval
+    schedule_index_enabled: bool = Field(env="SCHEDULE_INDEX_ENABLED", default=True)
+    schedule_days_before: int = Field(env="SCHEDULE_DAYS_BEFORE", default=1)
+    schedule_days_after: int = Field(env="SCHEDULE_DAYS_AFTER", default=14)
+    schedule_refresh_interval: float = Field(env="SCHEDULE_REFRESH_INTERVAL", default=600)
+    # Lesson times are stored in the local time of the university
+    schedule_utc_offset: int = Field(env="SCHEDULE_UTC_OFFSET", default=3)
+
+    entity_cache_size: int = Field(env="ENTITY_CACHE_SIZE", default=10000)
+    entity_cache_ttl: float = Field(env="ENTITY_CACHE_TTL", default=60)
+
+    # Queries which the db resolves with a collection scan over more than
+    # query_guard_docs_examined documents are off (not checked), log, cap or reject
+    query_guard_policy: typing.Literal["off", "log", "cap", "reject"] = Field(
+        env="QUERY_GUARD_POLICY", default="log"
+    )
+    query_guard_docs_examined: int = Field(env="QUERY_GUARD_DOCS_EXAMINED", default=10000)
+    query_guard_max_time_ms: int = Field(env="QUERY_GUARD_MAX_TIME_MS", default=2000)
+    query_guard_cache_size: int = Field(env="QUERY_GUARD_CACHE_SIZE", default=1000)
+    query_guard_plan_ttl: float = Field(env="QUERY_GUARD_PLAN_TTL", default=3600)
+
+    # maxTimeMS of read queries, by the first segment of the path, e.g. '{"records": 10000}',
+    # other paths use query_timeout_ms, 0 means no limit
+    query_timeout_ms: int = Field(env="QUERY_TIMEOUT_MS", default=10000)
+    query_timeouts: typing.Dict[str, int] = Field(env="QUERY_TIMEOUTS", default={})
+
+    # ETags are based on the versions collection, which is bumped by the write functions.
+    # With ETags GET requests read from the primary, so they are off by default to let
+    # GET requests read with mongo_read_preference
+    etag_enabled: bool = Field(env="ETAG_ENABLED", default=False)
+
+    # Routers which return documents without response_model validation, e.g. '["lessons"]'
+    fast_json_routers: typing.Set[str] = Field(env="FAST_JSON_ROUTERS", default=set())
+
     testing: typing.Optional[bool] = Field(env="TESTING", default=False)
     dev: typing.Optional[bool] = Field(env="DEV", default=False)
 
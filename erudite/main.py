@@ -1,4 +1,3 @@
-from starlette.middleware.base import BaseHTTPMiddleware
 from fastapi.openapi.utils import get_openapi
 
 from prometheus_fastapi_instrumentator import Instrumentator
@@ -15,23 +14,60 @@ def create_app():
         app = FastAPI()
     else:
         app = FastAPI(root_path="/api/erudite")
-        from core.middleware import authorization
+        from core.middleware import AuthorizationMiddleware, create_pool, close_pool
 
-        app.add_middleware(BaseHTTPMiddleware, dispatch=authorization)
+        app.add_middleware(AuthorizationMiddleware)
+        app.add_event_handler("startup", create_pool)
+        app.add_event_handler("shutdown", close_pool)
+
+    if settings.etag_enabled:
+        from core.middleware import ConditionalGetMiddleware
+
+        app.add_middleware(ConditionalGetMiddleware)
+
+    from core.middleware import ReadPreferenceMiddleware, TimeoutMiddleware
+    from core.responses import database_unavailable, query_timeout
+    from pymongo.errors import ConnectionFailure, ExecutionTimeout
+
+    app.add_middleware(ReadPreferenceMiddleware)
+    app.add_middleware(TimeoutMiddleware)
+    app.add_exception_handler(ExecutionTimeout, query_timeout)
+    app.add_exception_handler(ConnectionFailure, database_unavailable)
 
     Instrumentator().instrument(app).expose(app)
 
+    from core.database.indexes import ensure_indexes
+
+    app.add_event_handler("startup", ensure_indexes)
+
+    if settings.query_guard_policy != "off":
+        from core.database import guard
+        from core.responses import query_rejected
+
+        app.add_exception_handler(guard.QueryRejected, query_rejected)
+        app.add_event_handler("shutdown", guard.log_report)
+
+    if settings.schedule_index_enabled:
+        from core.database import schedule
+
+        app.add_event_handler("startup", schedule.start)
+        app.add_event_handler("shutdown", schedule.stop)
+
     from core.routes.rooms import router as room_router
     from core.routes.equipment import router as equipment_router
     from core.routes.disciplines import router as discipline_router
     from core.routes.lessons import router as lesson_router
     from core.routes.records import router as record_router
+    from core.routes.schedule import router as schedule_router
+    from core.routes.admin import router as admin_router
 
     app.include_router(room_router, tags=["rooms"])
     app.include_router(equipment_router, tags=["equipment"])
     app.include_router(discipline_router, tags=["disciplines"])
     app.include_router(lesson_router, tags=["lessons"])
     app.include_router(record_router, tags=["records"])
+    app.include_router(schedule_router, tags=["schedule"])
+    app.include_router(admin_router, tags=["admin"])
 
     return app
 
@@ -0,0 +1,26 @@
+import os
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+# Settings need the connection strings, clients connect on the first query, so
+# tests which don't use the databases run without them
+os.environ.setdefault("PSQL_DB_URL", "postgresql://localhost/erudite")
+os.environ.setdefault("MONGO_DB_URL", "mongodb://localhost:27017")
+os.environ.setdefault("MONGO_DB_NAME", "erudite")
+# Tests write to testDb, never to MONGO_DB_NAME
+os.environ["TESTING"] = "true"
+
+
+@pytest.fixture(scope="session")
+def mongo():
+    """ Skips the test if MongoDB of MONGO_DB_URL is not available """
+
+    client = MongoClient(os.environ["MONGO_DB_URL"], serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip("MongoDB is not available")
+    finally:
+        client.close()
@@ -0,0 +1,104 @@
+import pytest
+
+from core import cache
+from core.database.cache import EntityCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Current time of the caches, which is moved by the test """
+
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_ttl(clock):
+    ttl_cache = cache.TTLCache(maxsize=10, ttl=60)
+    ttl_cache.set("valid", True)
+    ttl_cache.set("invalid", False, ttl=5)
+
+    clock[0] += 10
+
+    assert ttl_cache.lookup("valid") == (True, True)
+    assert ttl_cache.lookup("invalid") == (False, None)
+    assert "invalid" not in ttl_cache
+
+    clock[0] += 60
+
+    assert ttl_cache.get("valid", "default") == "default"
+    assert len(ttl_cache) == 0
+
+
+def test_cached_none_is_told_from_a_miss(clock):
+    ttl_cache = cache.TTLCache(maxsize=10, ttl=60)
+    ttl_cache.set("key", None)
+
+    assert ttl_cache.lookup("key") == (True, None)
+    assert ttl_cache.lookup("other") == (False, None)
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+    ttl_cache.get("a")
+
+    assert ttl_cache.set("c", 3) == 1
+    assert "b" not in ttl_cache
+    assert ttl_cache.get("a") == 1
+    assert ttl_cache.pop("c") == 3
+    assert ttl_cache.pop("c", "default") == "default"
+
+
+def make_entity_cache() -> EntityCache:
+    return EntityCache("rooms", "ruz_auditorium_oid", maxsize=10, ttl=60)
+
+
+def test_document_is_found_by_id_and_by_natural_key(clock):
+    rooms = make_entity_cache()
+    rooms.set({"id": "5fd8a1", "ruz_auditorium_oid": 3308, "ruz_number": "504"})
+
+    assert rooms.get("5fd8a1") == (
+        True,
+        {"id": "5fd8a1", "ruz_auditorium_oid": 3308, "ruz_number": "504"},
+    )
+    assert rooms.get_by_key(3308)[1]["id"] == "5fd8a1"
+
+
+def test_cached_document_is_a_copy(clock):
+    rooms = make_entity_cache()
+    rooms.set({"id": "5fd8a1", "ruz_auditorium_oid": 3308})
+
+    rooms.get("5fd8a1")[1]["ruz_auditorium_oid"] = 1
+
+    assert rooms.get_by_key(3308)[0]
+
+
+def test_invalidated_document_is_missed_by_id_and_by_key(clock):
+    rooms = make_entity_cache()
+    rooms.set({"id": "5fd8a1", "ruz_auditorium_oid": 3308})
+
+    rooms.invalidate("5fd8a1")
+
+    assert rooms.get("5fd8a1") == (False, None)
+    assert rooms.get_by_key(3308) == (False, None)
+
+
+def test_changed_natural_key_is_missed(clock):
+    rooms = make_entity_cache()
+    rooms.set({"id": "5fd8a1", "ruz_auditorium_oid": 3308})
+    rooms.set({"id": "5fd8a1", "ruz_auditorium_oid": 3309})
+
+    assert rooms.get_by_key(3308) == (False, None)
+    assert rooms.get_by_key(3309)[0]
+
+
+def test_documents_expire_after_ttl(clock):
+    rooms = make_entity_cache()
+    rooms.set({"id": "5fd8a1", "ruz_auditorium_oid": 3308})
+
+    clock[0] += 61
+
+    assert rooms.get("5fd8a1") == (False, None)
+    assert rooms.get_by_key(3308) == (False, None)
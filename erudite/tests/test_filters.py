@@ -0,0 +1,136 @@
+from datetime import datetime
+
+import pytest
+from bson.objectid import ObjectId
+from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
+
+from core.database.filters import compile_filter, indexed_fields, merge
+
+
+class Room(BaseModel):
+    ruz_auditorium_oid: int
+    ruz_building_gid: int = None
+    ruz_number: str = None
+    start_at: datetime = None
+
+    class Config:
+        extra = "allow"
+
+
+indexes = [
+    IndexModel([("ruz_auditorium_oid", ASCENDING)], name="ruz_auditorium_oid", unique=True),
+    IndexModel([("ruz_building_gid", ASCENDING), ("ruz_number", ASCENDING)], name="building"),
+    IndexModel([("start_at", ASCENDING)], name="start_at"),
+]
+
+params = ["ruz_building_gid", "ruz_number", "ruz_amount", "page_size"]
+
+
+def compile_room_filter(query_params, attributes=None):
+    return compile_filter(query_params, attributes or {}, params, Room, indexes)
+
+
+def test_indexed_fields_are_leading_fields_and_id():
+    assert indexed_fields(indexes) == {"_id", "ruz_auditorium_oid", "ruz_building_gid", "start_at"}
+
+
+def test_route_parameters_are_kept_as_attributes():
+    query = compile_room_filter(
+        [("ruz_amount", "30"), ("page_size", "10")], {"ruz_amount": 30}
+    )
+
+    assert query == {"ruz_amount": 30}
+
+
+def test_unknown_parameters_without_operator_are_ignored():
+    assert compile_room_filter([("_", "1603000000"), ("ruz_building", "x")]) == {}
+
+
+def test_operators_are_parsed_in_type_of_the_field():
+    query = compile_room_filter(
+        [
+            ("ruz_auditorium_oid__in", "3308,3309"),
+            ("ruz_auditorium_oid__in", "3310"),
+            ("start_at__gte", "2020-12-15T09:30:00+03:00"),
+            ("ruz_building_gid__exists", "true"),
+            ("ruz_building_gid__eq", "92"),
+        ]
+    )
+
+    assert query == {
+        "ruz_auditorium_oid": {"$in": [3308, 3309, 3310]},
+        # Stored datetimes are naive
+        "start_at": {"$gte": datetime(2020, 12, 15, 9, 30)},
+        "ruz_building_gid": {"$exists": True, "$eq": 92},
+    }
+
+
+def test_prefix_is_anchored_and_escaped():
+    query = compile_room_filter([("ruz_auditorium_oid__prefix", "5.0")])
+
+    assert query == {"ruz_auditorium_oid": {"$regex": "^5\\.0"}}
+
+
+def test_id_is_parsed_as_object_id():
+    object_id = ObjectId()
+
+    assert compile_room_filter([("id__eq", str(object_id))]) == {"_id": object_id}
+
+
+def test_unindexed_fields_are_filtered_if_they_are_allowed():
+    query_params = [("ruz_number__gte", "500")]
+
+    with pytest.raises(ValueError):
+        compile_room_filter(query_params)
+    assert compile_filter(query_params, {}, params, Room, indexes, ["ruz_number"]) == {
+        "ruz_number": {"$gte": "500"}
+    }
+
+
+@pytest.mark.parametrize(
+    "query_params",
+    [
+        [("ruz_number__eq", "505")],
+        [("ruz_amount__gt", "10")],
+        [("ruz_auditorium_oid__like", "1")],
+        [("ruz_auditorium_oid__gt", "many")],
+        [("ruz_building_gid__exists", "yes")],
+        [("id__eq", "not an id")],
+        [("$where__eq", "1")],
+    ],
+)
+def test_wrong_filters_are_rejected(query_params):
+    with pytest.raises(ValueError):
+        compile_room_filter(query_params)
+
+
+def test_conditions_are_merged_with_structured_attributes():
+    fromdate, todate = datetime(2020, 12, 14), datetime(2020, 12, 20)
+    query = compile_room_filter(
+        [("start_at__lt", todate.isoformat()), ("ruz_auditorium_oid__in", "1,2")],
+        {"start_at": {"$gte": fromdate}, "ruz_auditorium_oid": 1},
+    )
+
+    assert query == {
+        "start_at": {"$gte": fromdate, "$lt": todate},
+        "ruz_auditorium_oid": 1,
+        "$and": [{"ruz_auditorium_oid": {"$in": [1, 2]}}],
+    }
+
+
+def test_merge_keeps_both_conditions_on_the_same_operator():
+    query = merge({"start_at": {"$gte": 1}}, {"start_at": {"$gte": 2}, "ruz_number": "505"})
+
+    assert query == {
+        "start_at": {"$gte": 1},
+        "ruz_number": "505",
+        "$and": [{"start_at": {"$gte": 2}}],
+    }
+
+
+def test_merge_doesnt_change_the_query():
+    query = {"start_at": {"$gte": 1}}
+    merge(query, {"start_at": {"$lt": 2}})
+
+    assert query == {"start_at": {"$gte": 1}}
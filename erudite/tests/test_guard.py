@@ -0,0 +1,32 @@
+import json
+
+from core.database.guard import plan_stages, shape
+
+
+def test_values_are_replaced():
+    query = {"ruz_auditorium_oid": 3308, "start_at": {"$gte": "2020-12-15", "$lt": "2020-12-16"}}
+
+    assert shape(query) == {"ruz_auditorium_oid": "?", "start_at": {"$gte": "?", "$lt": "?"}}
+
+
+def test_queries_with_other_values_have_the_same_shape():
+    first = {"ruz_auditorium_oid": {"$in": [1, 2, 3]}, "url": "a"}
+    second = {"url": "b", "ruz_auditorium_oid": {"$in": [4]}}
+
+    assert json.dumps(shape(first)) == json.dumps(shape(second))
+
+
+def test_lists_of_conditions_are_kept():
+    query = {"$or": [{"start_at": {"$lt": 1}}, {"start_at": 1, "_id": {"$lt": 2}}]}
+
+    assert shape(query) == {
+        "$or": [{"start_at": {"$lt": "?"}}, {"_id": {"$lt": "?"}, "start_at": "?"}]
+    }
+
+
+def test_stages_of_every_level_of_the_plan():
+    classic = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "keyPattern": {"url": 1}}}
+    sbe = {"queryPlan": {"stage": "OR", "inputStages": [{"stage": "COLLSCAN"}, classic]}}
+
+    assert plan_stages(classic) == {"FETCH", "IXSCAN"}
+    assert plan_stages(sbe) == {"OR", "COLLSCAN", "FETCH", "IXSCAN"}
@@ -0,0 +1,201 @@
+import asyncio
+from datetime import date, datetime
+
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, UpdateOne
+
+from core.database import lessons, schedule
+
+BUILDING_OID = 999001
+
+
+def make_lesson(ruz_lesson_oid: int, start_time: str, end_time: str) -> dict:
+    return {
+        "ruz_auditorium": "504",
+        "ruz_auditorium_oid": 999002,
+        "ruz_building": "Таллинская ул., д, 34",
+        "ruz_building_oid": BUILDING_OID,
+        "ruz_discipline": "Физика",
+        "ruz_discipline_oid": 1337,
+        "ruz_kind_of_work": "Практическое занятие on-line",
+        "ruz_kind_of_work_oid": 969,
+        "ruz_lecturer_title": "Даниил Мирталибов",
+        "ruz_lecturer_email": "dimirtalibov@hse.ru",
+        "ruz_lesson_oid": ruz_lesson_oid,
+        "ruz_url": "https://meet.miem.hse.ru/520",
+        "course_code": "Ф_Б2019_ИТСС_3",
+        "date": "2020-12-15",
+        "start_time": start_time,
+        "end_time": end_time,
+    }
+
+
+def test_content_hash_doesnt_depend_on_the_order_of_fields():
+    lesson = make_lesson(999101, "9:30", "10:50")
+
+    assert lessons.content_hash(lesson) == lessons.content_hash(dict(reversed(lesson.items())))
+
+
+def test_content_hash_ignores_fields_which_are_not_from_ruz():
+    lesson = make_lesson(999101, "9:30", "10:50")
+    stored = dict(
+        lesson,
+        id="5fd8a1",
+        content_hash="old",
+        start_at=datetime(2020, 12, 15, 9, 30),
+        gcalendar_event_id="event",
+    )
+
+    assert lessons.content_hash(stored) == lessons.content_hash(lesson)
+    assert lessons.content_hash(dict(lesson, ruz_auditorium="505")) != lessons.content_hash(lesson)
+
+
+def test_reconcile_plan():
+    unchanged = make_lesson(999101, "9:30", "10:50")
+    changed = make_lesson(999102, "11:10", "12:30")
+    new = make_lesson(999103, "13:00", "14:20")
+    removed_id = ObjectId()
+    stored = {
+        999101: (ObjectId(), lessons.content_hash(unchanged)),
+        999102: (ObjectId(), lessons.content_hash(dict(changed, ruz_auditorium="505"))),
+        999104: (removed_id, "hash"),
+    }
+    incoming = {lesson["ruz_lesson_oid"]: lesson for lesson in (unchanged, changed, new)}
+
+    result, operations = lessons.reconcile_plan(incoming, stored, dry_run=False)
+
+    assert result == {
+        "dry_run": False,
+        "inserted": [999103],
+        "updated": [999102],
+        "deleted": [999104],
+        "failed": [],
+        "unchanged": 1,
+    }
+    assert operations == [
+        (999102, upsert(changed)),
+        (999103, upsert(new)),
+        (999104, DeleteOne({"_id": removed_id})),
+    ]
+
+
+def upsert(lesson: dict) -> UpdateOne:
+    return UpdateOne(
+        {"ruz_lesson_oid": lesson["ruz_lesson_oid"]},
+        lessons.upsert_update(lesson, lessons.content_hash(lesson)),
+        upsert=True,
+    )
+
+
+def test_upsert_update_sets_hash_and_datetimes():
+    lesson = dict(make_lesson(999101, "9:30", "10:50"), id="5fd8a1")
+
+    update = lessons.upsert_update(lesson, "hash")
+
+    assert update == {
+        "$set": {
+            **make_lesson(999101, "9:30", "10:50"),
+            "content_hash": "hash",
+            "start_at": datetime(2020, 12, 15, 9, 30),
+            "end_at": datetime(2020, 12, 15, 10, 50),
+        }
+    }
+
+
+def test_upsert_update_unsets_datetimes_of_wrong_times():
+    update = lessons.upsert_update(make_lesson(999101, "9.30", "10:50"), "hash")
+
+    assert update["$unset"] == {"start_at": "", "end_at": ""}
+    assert "start_at" not in update["$set"]
+
+
+def test_upsert_update_drops_fields_of_the_client_which_are_made_on_write():
+    lesson = dict(
+        make_lesson(999101, "9.30", "10:50"),
+        start_at=datetime(2020, 12, 15, 9, 30),
+        end_at=datetime(2020, 12, 15, 10, 50),
+        content_hash="client",
+    )
+
+    update = lessons.upsert_update(lesson, "hash")
+
+    assert update["$set"]["content_hash"] == "hash"
+    assert not set(update["$set"]) & set(update["$unset"])
+
+
+async def collect(iterator) -> list:
+    return [item async for item in iterator]
+
+
+async def sorted_lessons(rows):
+    for oid, room, start, end in rows:
+        yield {
+            "ruz_lesson_oid": oid,
+            "ruz_auditorium_oid": room,
+            "start_at": datetime.fromisoformat(f"2020-12-15T{start}"),
+            "end_at": datetime.fromisoformat(f"2020-12-15T{end}"),
+        }
+
+
+def test_overlapping_pairs_are_found_in_every_room():
+    rows = [
+        (1, 504, "09:00", "10:00"),
+        (2, 505, "09:00", "11:00"),
+        (3, 504, "09:30", "10:30"),
+        (4, 505, "10:00", "10:30"),
+        (5, 504, "10:00", "11:00"),
+        (6, 505, "11:00", "12:00"),
+        (7, 504, "13:00", "14:00"),
+    ]
+
+    pairs = asyncio.run(collect(lessons.overlapping_pairs(sorted_lessons(rows))))
+
+    # Lessons which only touch (2 and 6, 1 and 5) don't overlap
+    assert [
+        (
+            pair["ruz_auditorium_oid"],
+            pair["first"]["ruz_lesson_oid"],
+            pair["second"]["ruz_lesson_oid"],
+        )
+        for pair in pairs
+    ] == [(504, 1, 3), (505, 2, 4), (504, 3, 5)]
+
+
+def test_every_pair_of_lessons_which_go_on_at_once():
+    rows = [(oid, 504, "09:00", "12:00") for oid in range(1, 4)]
+
+    pairs = asyncio.run(collect(lessons.overlapping_pairs(sorted_lessons(rows))))
+
+    assert [
+        (pair["first"]["ruz_lesson_oid"], pair["second"]["ruz_lesson_oid"]) for pair in pairs
+    ] == [(1, 2), (1, 3), (2, 3)]
+
+
+async def reconcile_with_deletion() -> dict:
+    await lessons.lessons_collection.delete_many({"ruz_building_oid": BUILDING_OID})
+    kept = await lessons.add(make_lesson(999101, "9:30", "10:50"))
+    removed = await lessons.add(make_lesson(999102, "11:10", "12:30"))
+
+    result = await lessons.reconcile(
+        date(2020, 12, 14),
+        date(2020, 12, 20),
+        BUILDING_OID,
+        [make_lesson(999101, "9:30", "10:50")],
+        dry_run=False,
+    )
+
+    remaining = await lessons.lessons_collection.count_documents(
+        {"ruz_building_oid": BUILDING_OID}
+    )
+    await lessons.lessons_collection.delete_many({"ruz_building_oid": BUILDING_OID})
+    return {"result": result, "remaining": remaining, "kept": kept, "removed": removed}
+
+
+def test_reconcile_deletes_lessons_missing_in_schedule(mongo):
+    data = asyncio.run(reconcile_with_deletion())
+
+    assert data["result"]["deleted"] == [999102]
+    assert data["result"]["failed"] == []
+    assert data["result"]["unchanged"] == 1
+    assert data["remaining"] == 1
+    assert data["removed"]["id"] not in schedule.index._lessons
@@ -0,0 +1,96 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from bson.objectid import ObjectId
+
+from core.database import records
+from core.database.utils import decode_cursor
+
+
+def test_next_cursor_is_made_of_the_last_record():
+    record_id = str(ObjectId())
+    page = [
+        {"id": str(ObjectId()), "start_at": datetime(2020, 12, 15, 13, 0)},
+        {"id": record_id, "start_at": datetime(2020, 12, 15, 9, 30)},
+    ]
+
+    cursor = records.next_cursor(page, 2)
+
+    assert decode_cursor(cursor, 2) == ["2020-12-15T09:30:00", record_id]
+    assert records.next_cursor(page, 3) is None
+
+
+def test_records_after_the_cursor():
+    record_id = ObjectId()
+    start_at = datetime(2020, 12, 15, 9, 30)
+
+    query = records.after_cursor([start_at.isoformat(), str(record_id)])
+
+    # Earlier records, records of the same start with a lower id and records without start_at
+    assert query == {
+        "$or": [
+            {"start_at": {"$lt": start_at}},
+            {"start_at": start_at, "_id": {"$lt": record_id}},
+            {"start_at": None},
+        ]
+    }
+
+
+def test_records_without_start_at_are_paged_by_id():
+    record_id = ObjectId()
+    page = [{"id": str(record_id), "start_at": None}]
+
+    after = decode_cursor(records.next_cursor(page, 1), 2)
+
+    assert records.after_cursor(after) == {"start_at": None, "_id": {"$lt": record_id}}
+
+
+def test_cursor_with_wrong_values_is_none():
+    assert records.after_cursor(["2020-12-15T09:30:00", "not an id"]) is None
+    assert records.after_cursor(["15.12.2020", str(ObjectId())]) is None
+    assert records.after_cursor([1, str(ObjectId())]) is None
+
+
+def test_same_capture_is_a_strict_overlap_of_the_same_camera():
+    record = {
+        "camera_ip": "172.18.191.21",
+        "start_at": datetime(2020, 12, 15, 9, 30),
+        "end_at": datetime(2020, 12, 15, 10, 50),
+    }
+
+    overlapping = dict(
+        record, start_at=datetime(2020, 12, 15, 10, 0), end_at=datetime(2020, 12, 15, 11, 0)
+    )
+    touching = dict(
+        record, start_at=datetime(2020, 12, 15, 10, 50), end_at=datetime(2020, 12, 15, 11, 0)
+    )
+
+    assert records.is_same_capture(record, overlapping)
+    assert not records.is_same_capture(record, touching)
+    assert not records.is_same_capture(record, dict(overlapping, camera_ip="172.18.191.22"))
+
+
+class ChangingRecords:
+    """ Collection of a record which is changed between every read and update """
+
+    def __init__(self):
+        self.updates = 0
+
+    async def find_one(self, query, projection):
+        return {"_id": query["_id"], "date": "2020-12-15", "start_time": "09:30"}
+
+    async def update_one(self, query, update):
+        self.updates += 1
+        return SimpleNamespace(matched_count=0)
+
+
+def test_patch_of_a_record_which_keeps_changing_is_a_conflict(monkeypatch):
+    collection = ChangingRecords()
+    monkeypatch.setattr(records, "records_collection", collection)
+
+    with pytest.raises(records.PatchConflict):
+        asyncio.run(records.patch(ObjectId(), {"end_time": "10:50"}))
+
+    assert collection.updates == records.PATCH_ATTEMPTS
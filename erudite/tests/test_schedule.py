@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+
+from core.database.schedule import ScheduleIndex
+
+
+def make_lesson(lesson_id: str, room: int, start: str, end: str) -> dict:
+    return {
+        "id": lesson_id,
+        "ruz_auditorium_oid": room,
+        "start_at": datetime.fromisoformat(f"2020-12-15T{start}"),
+        "end_at": datetime.fromisoformat(f"2020-12-15T{end}"),
+    }
+
+
+def at(time: str) -> datetime:
+    return datetime.fromisoformat(f"2020-12-15T{time}")
+
+
+def make_index(*lessons: dict) -> ScheduleIndex:
+    index = ScheduleIndex()
+    index.start, index.end = datetime(2020, 12, 14), datetime(2020, 12, 21)
+    index.enabled = True
+    for lesson in lessons:
+        index.set(lesson)
+    return index
+
+
+def ids(lessons) -> list:
+    return [lesson["id"] for lesson in lessons]
+
+
+def test_lessons_which_overlap_the_range():
+    index = make_index(
+        make_lesson("a", 504, "09:30", "10:50"),
+        make_lesson("b", 504, "11:10", "12:30"),
+        make_lesson("c", 505, "08:00", "12:00"),
+    )
+
+    assert ids(index.between(at("10:00"), at("11:00"))) == ["a", "c"]
+    # Lessons which only touch the range don't overlap it
+    assert ids(index.between(at("10:50"), at("11:10"), [504])) == []
+    assert ids(index.between(at("07:00"), at("20:00"), [504, 506])) == ["a", "b"]
+
+
+def test_current_and_next_lessons_of_rooms():
+    index = make_index(
+        make_lesson("a", 504, "09:30", "10:50"),
+        make_lesson("b", 504, "11:10", "12:30"),
+    )
+
+    assert index.at(at("10:00"), [504, 505]) == [
+        {"ruz_auditorium_oid": 504, "current": [index._lessons["a"]], "next": index._lessons["b"]},
+        {"ruz_auditorium_oid": 505, "current": [], "next": None},
+    ]
+    assert index.at(at("12:30"), [504]) == [
+        {"ruz_auditorium_oid": 504, "current": [], "next": None}
+    ]
+
+
+def test_moved_lesson_is_replaced():
+    index = make_index(make_lesson("a", 504, "09:30", "10:50"))
+
+    index.set(make_lesson("a", 505, "13:00", "14:20"))
+
+    assert len(index) == 1
+    assert index.between(at("09:00"), at("11:00")) == []
+    assert ids(index.between(at("13:00"), at("14:00"), [505])) == ["a"]
+
+
+def test_removed_lesson_is_not_found():
+    index = make_index(
+        make_lesson("a", 504, "09:30", "10:50"), make_lesson("b", 504, "09:30", "10:00")
+    )
+
+    index.remove("a")
+    index.remove("missing")
+
+    assert ids(index.between(at("09:00"), at("11:00"))) == ["b"]
+
+
+def test_lessons_out_of_the_window_or_without_times_are_not_kept():
+    lesson = make_lesson("a", 504, "09:30", "10:50")
+    index = make_index(
+        dict(lesson, id="early", start_at=datetime(2020, 12, 1)),
+        dict(lesson, id="late", start_at=datetime(2020, 12, 21)),
+        dict(lesson, id="no time", start_at=None),
+        dict(lesson, id="no room", ruz_auditorium_oid=None),
+    )
+
+    assert len(index) == 0
+    assert index.rooms() == []
+
+
+def test_long_lesson_which_started_before_the_range_is_found():
+    index = make_index(
+        dict(make_lesson("long", 504, "08:00", "08:00"), end_at=at("08:00") + timedelta(hours=6)),
+        make_lesson("short", 504, "09:00", "09:30"),
+    )
+
+    assert ids(index.between(at("13:00"), at("13:30"))) == ["long"]
+
+
+def test_covers_only_the_window_of_a_built_index():
+    index = make_index()
+
+    assert index.covers(datetime(2020, 12, 14), datetime(2020, 12, 21))
+    assert not index.covers(datetime(2020, 12, 13), datetime(2020, 12, 15))
+
+    index.enabled = False
+    assert not index.covers(datetime(2020, 12, 15), datetime(2020, 12, 16))
@@ -0,0 +1,94 @@
+import base64
+from datetime import datetime
+
+import pytest
+from bson.objectid import ObjectId
+
+from core.database.utils import (
+    datetime_fields,
+    datetime_filter,
+    decode_cursor,
+    decode_id_cursor,
+    encode_cursor,
+    next_id_cursor,
+    page_headers,
+)
+
+
+def test_cursor_is_decoded_to_encoded_values():
+    object_id = ObjectId()
+    cursor = encode_cursor(["2020-12-15T09:30:00", object_id, None])
+
+    assert decode_cursor(cursor, 3) == ["2020-12-15T09:30:00", str(object_id), None]
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not base64!",
+        base64.urlsafe_b64encode(b"not json").decode(),
+        base64.urlsafe_b64encode(b'{"id": 1}').decode(),
+        encode_cursor(["2020-12-15T09:30:00"]),
+    ],
+)
+def test_broken_cursor_is_none(cursor):
+    assert decode_cursor(cursor, 2) is None
+
+
+def test_id_cursor():
+    page = [{"id": str(ObjectId())} for _ in range(3)]
+    cursor = next_id_cursor(page, 3)
+
+    assert decode_id_cursor(cursor) == ObjectId(page[-1]["id"])
+    assert decode_id_cursor(encode_cursor(["not an id"])) is None
+
+
+def test_last_page_has_no_cursor():
+    page = [{"id": str(ObjectId())} for _ in range(2)]
+
+    assert next_id_cursor(page, 3) is None
+    assert next_id_cursor(page, 0) is None
+    assert page_headers(page, 3, 2) == {"X-Total-Count": "2"}
+    assert set(page_headers(page, 2, 5)) == {"X-Total-Count", "X-Next-Cursor"}
+
+
+def test_datetime_fields():
+    fields = datetime_fields({"date": "2020-12-15", "start_time": "9:30", "end_time": "10:50"})
+
+    assert fields == {
+        "start_at": datetime(2020, 12, 15, 9, 30),
+        "end_at": datetime(2020, 12, 15, 10, 50),
+    }
+
+
+def test_datetime_fields_of_lesson_which_ends_after_midnight():
+    fields = datetime_fields({"date": "2020-12-15", "start_time": "23:00", "end_time": "00:30"})
+
+    assert fields["end_at"] == datetime(2020, 12, 16, 0, 30)
+
+
+def test_seconds_of_times_are_ignored():
+    fields = datetime_fields({"date": "2020-12-15", "start_time": "13:00:00", "end_time": "13:30"})
+
+    assert fields["start_at"] == datetime(2020, 12, 15, 13, 0)
+
+
+@pytest.mark.parametrize(
+    "document",
+    [
+        {"date": "2020-12-15", "start_time": "9:30"},
+        {"date": "15.12.2020", "start_time": "9:30", "end_time": "10:50"},
+        {"date": "2020-12-15", "start_time": "9.30", "end_time": "10:50"},
+        {"date": "2020-12-15", "start_time": "25:00", "end_time": "10:50"},
+        {"date": None, "start_time": "9:30", "end_time": "10:50"},
+    ],
+)
+def test_datetime_fields_of_wrong_strings_are_empty(document):
+    assert datetime_fields(document) == {}
+
+
+def test_datetime_filter_is_naive():
+    fromdate = datetime.fromisoformat("2020-12-15T09:30:00+03:00")
+
+    assert datetime_filter(fromdate, None) == {"start_at": {"$gte": datetime(2020, 12, 15, 9, 30)}}
+    assert datetime_filter(None, None) == {}